@@ -0,0 +1,227 @@
+import re
+import zlib
+
+from unidecode import unidecode
+
+SHINGLE_SIZE = 4
+SIGNATURE_SIZE = 64
+DEFAULT_THRESHOLD = 0.8
+# Band sizes are picked so a pair at exactly the threshold still becomes a candidate this often
+TARGET_RECALL = 0.99
+# Kept questions indexed under one band. Bands made of shingles most questions share (" the", "what"...) would
+# otherwise collect a growing share of the corpus, and every question landing in them would be compared with all of it
+MAX_BUCKET_SIZE = 16
+# Candidates whose signatures agree on less than threshold - SKETCH_MARGIN of their bins are rejected without working
+# out their exact similarity. A 64 bin estimate is within 0.15 of the truth about 99% of the time
+SKETCH_MARGIN = 0.2
+
+EMPTY_BIN = 1 << 64
+MIX = 0x9E3779B97F4A7C15
+MASK = (1 << 64) - 1
+
+
+def normalize_text(text):
+    """ Lowercase ASCII words separated by single spaces, so punctuation, accents, case and italics don't matter """
+    return re.sub(r"[^a-z0-9]+", " ", unidecode(text).lower()).strip()
+
+
+def shingle_hashes(question, answers, shingle_size=SHINGLE_SIZE):
+    """
+    The set of hashes a question is compared by: every shingle_size character run of its normalized text, and each
+    normalized answer whole, so answers count regardless of their order.
+    """
+    text = f" {question} ".encode()
+    hashes = {zlib.crc32(text[i:i + shingle_size]) for i in range(max(len(text) - shingle_size + 1, 1))}
+    hashes.update(zlib.crc32(b"\x01" + answer.encode()) for answer in answers)
+    return hashes
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def signature(hashes, size=SIGNATURE_SIZE):
+    """
+    One permutation MinHash: every hash is mixed and dropped into one of size bins, which each keep their smallest
+    value, instead of taking the minimum under size separate hash functions. That's one pass over the shingles rather
+    than size of them. Empty bins borrow from the next bin along (offset by the distance, so they stay distinct), which
+    keeps the chance of two signatures agreeing at a position equal to the sets' Jaccard similarity.
+    """
+    bins = [EMPTY_BIN] * size
+    for h in hashes:
+        h = (h * MIX) & MASK
+        h ^= h >> 29
+        b = h % size
+        v = h // size
+        if v < bins[b]:
+            bins[b] = v
+    if hashes and EMPTY_BIN in bins:
+        original = bins[:]
+        # Every real value is below offset, so borrowed ones can't collide with them
+        offset = EMPTY_BIN // size
+        for i in range(size):
+            if original[i] == EMPTY_BIN:
+                distance = 1
+                while original[(i + distance) % size] == EMPTY_BIN:
+                    distance += 1
+                bins[i] = original[(i + distance) % size] + distance * offset
+    return bins
+
+
+def sketch(bins):
+    """ The low byte of every bin packed into an int, enough to estimate similarity from (see agreement) """
+    return int.from_bytes(bytes(v & 0xff for v in bins), "little")
+
+
+def agreement(a, b, size=SIGNATURE_SIZE):
+    """ Fraction of bins two sketches agree on, which estimates their sets' Jaccard similarity """
+    return (a ^ b).to_bytes(size, "little").count(0) / size
+
+
+def band_rows(threshold, size=SIGNATURE_SIZE, target_recall=TARGET_RECALL):
+    """
+    Rows per LSH band. A pair with similarity s shares at least one of size // rows bands with probability
+    1 - (1 - s ** rows) ** bands; the most rows that still reach target_recall at threshold are used, since more rows
+    means fewer dissimilar pairs to check.
+    """
+    best = 1
+    for rows in range(1, size + 1):
+        bands = size // rows
+        if 1 - (1 - threshold ** rows) ** bands >= target_recall:
+            best = rows
+    return best
+
+
+class NearDuplicateFilter:
+    """
+    Drops questions that are the same as, or nearly the same as, a question that came before them. Usable as a
+    Pipeline stage: Stage("near dedupe", NearDuplicateFilter(...)).
+
+    Questions are first compared by their normalized text, correct answer and other answers (in any order), which
+    catches exact copies with one lookup. The rest are compared by the Jaccard similarity of their shingle_hashes, and
+    are dropped if it's at least threshold against a kept question with the same correct answer. Rather than comparing
+    every pair, each kept question's MinHash signature is split into bands that index it in a table, and a new question
+    is only compared against kept questions that share a band with it, so the work grows with the number of questions
+    rather than its square. At most MAX_BUCKET_SIZE questions are indexed under any one band, and candidates are
+    screened by a one byte per bin sketch of their signature before their exact similarity is worked out. Only kept
+    questions are indexed, and only their normalized text and sketch are held on to.
+
+    Records with an "error" are passed on without being compared. clusters maps the index (in the stream) of each kept
+    question that had duplicates to its cluster: see report().
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, shingle_size=SHINGLE_SIZE, signature_size=SIGNATURE_SIZE):
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold must be between 0 and 1")
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.signature_size = signature_size
+        self.rows = band_rows(threshold, signature_size)
+        self.bands = signature_size // self.rows
+        self.exact = {}
+        self.buckets = {}
+        self.kept = {}
+        self.clusters = {}
+        self.count = 0
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.comparisons = 0
+        self.checked = 0
+
+    def __call__(self, records):
+        for index, record in enumerate(records):
+            if record.get("error"):
+                # Already rejected, so it's left for the sink to report rather than kept as an original
+                yield record
+                continue
+            question = normalize_text(record["question"])
+            # The first answer is the correct one, so the order is kept
+            answers = [normalize_text(answer) for answer in record["answers"]]
+            match = self.find(index, question, answers)
+            if match is None:
+                self.count += 1
+                yield record
+                continue
+            original, similarity = match
+            kept_text = self.kept[original][0]
+            cluster = self.clusters.setdefault(original, {"index": original, "question": kept_text.split("\0")[0],
+                                                          "duplicates": []})
+            cluster["duplicates"].append({"index": index, "category": record["category"],
+                                          "question": record["question"], "similarity": similarity})
+
+    def find(self, index, question, answers):
+        """
+        (index of the kept question this one duplicates, similarity), or None after keeping it. answers[0] is the
+        correct answer: questions with a different one aren't duplicates, however alike they are.
+        """
+        key = (question, answers[0], tuple(sorted(answers[1:])))
+        original = self.exact.get(key)
+        if original is not None:
+            self.exact_duplicates += 1
+            return original, 1.0
+
+        hashes = shingle_hashes(question, answers, self.shingle_size)
+        bins = signature(hashes, self.signature_size)
+        own_sketch = sketch(bins)
+        screen = self.threshold - SKETCH_MARGIN
+        # Bands take every bands'th bin rather than runs of neighbouring ones, since an empty bin is filled from its
+        # neighbour and a run of them can come down to a single shingle
+        band_keys = [hash((band,) + tuple(bins[band::self.bands][:self.rows])) for band in range(self.bands)]
+        checked = set()
+        for band_key in band_keys:
+            candidates = self.buckets.get(band_key)
+            if candidates is None:
+                continue
+            for candidate in candidates if isinstance(candidates, list) else [candidates]:
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                self.comparisons += 1
+                kept_text, kept_sketch = self.kept[candidate]
+                if agreement(own_sketch, kept_sketch, self.signature_size) < screen:
+                    continue
+                self.checked += 1
+                kept_question, *kept_answers = kept_text.split("\0")
+                if kept_answers[0] != answers[0]:
+                    continue
+                similarity = jaccard(hashes, shingle_hashes(kept_question, kept_answers, self.shingle_size))
+                if similarity >= self.threshold:
+                    self.near_duplicates += 1
+                    return candidate, similarity
+
+        self.exact[key] = index
+        # The normalized text is kept as one string, with the question and answers separated by NULs
+        self.kept[index] = ("\0".join([question] + answers), own_sketch)
+        for band_key in band_keys:
+            # Most bands only ever hold one question, so a plain index saves a list per band
+            candidates = self.buckets.get(band_key)
+            if candidates is None:
+                self.buckets[band_key] = index
+            elif isinstance(candidates, list):
+                if len(candidates) < MAX_BUCKET_SIZE:
+                    candidates.append(index)
+            else:
+                self.buckets[band_key] = [candidates, index]
+        return None
+
+    def report(self):
+        """
+        Every cluster of collapsed questions, largest first: dicts with the kept question's "index" and normalized
+        "question", and its "duplicates", each with the dropped question's "index", "category", "question" and
+        "similarity" to the kept one.
+        """
+        return sorted(self.clusters.values(), key=lambda cluster: (-len(cluster["duplicates"]), cluster["index"]))
+
+
+def format_report(dedupe_filter, limit=10):
+    """ Summary lines for a NearDuplicateFilter, with its largest clusters """
+    lines = [f"Dropped {dedupe_filter.exact_duplicates} exact and {dedupe_filter.near_duplicates} near duplicate "
+             f"questions in {len(dedupe_filter.clusters)} clusters (similarity threshold {dedupe_filter.threshold}, "
+             f"{dedupe_filter.comparisons} comparisons)"]
+    for cluster in dedupe_filter.report()[:limit]:
+        lines.append(f"  Kept #{cluster['index']} {cluster['question']}")
+        for duplicate in cluster["duplicates"]:
+            lines.append(f"    Dropped #{duplicate['index']} ({duplicate['similarity']:.2f}) {duplicate['question']}")
+    return lines
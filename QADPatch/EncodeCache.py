@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class EncodeCache:
+    """
+    On-disk cache of encoded question blocks, so a rebuild only encodes new or edited questions. Blocks are keyed by a
+    hash of the question text, the answers and a fingerprint of the dictionaries and encoder they were encoded with.
+    Changing the dictionaries therefore invalidates every entry automatically: stale entries can't be hit any more and
+    age out. When it's closed, the least recently used entries are evicted until the blocks and their keys add up to
+    no more than max_bytes. That doesn't count SQLite's own overhead (row headers, the index, free pages), so the file
+    itself ends up somewhat larger.
+    """
+
+    def __init__(self, filename, max_bytes=64 * 1024 * 1024):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.touched = []
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # A generous timeout lets concurrent builds share the cache
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS blocks (key TEXT PRIMARY KEY, block BLOB NOT NULL, "
+                        "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS blocks_last_used ON blocks (last_used)")
+
+    @staticmethod
+    def fingerprint(question_list, proper_noun_dictionary, main_dictionary):
+        """ Identifies everything besides the question itself that affects how it's encoded """
+        h = hashlib.sha256(b'optimal' if question_list.optimal else b'greedy')
+        h.update(bytes(question_list.byte_reference_table))
+        h.update(proper_noun_dictionary.fingerprint().encode("utf-8"))
+        h.update(main_dictionary.fingerprint().encode("utf-8"))
+        return h.hexdigest()
+
+    @staticmethod
+    def key(fingerprint, question):
+        h = hashlib.sha256(fingerprint.encode("utf-8"))
+        h.update(json.dumps([question.question_text, question.answers]).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key):
+        """ Cached block for key, or None """
+        row = self.db.execute("SELECT block FROM blocks WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched.append(key)
+        return bytearray(row[0])
+
+    def put(self, key, block):
+        self.db.execute("INSERT OR REPLACE INTO blocks (key, block, size, last_used) VALUES (?, ?, ?, ?)",
+                        (key, bytes(block), len(block) + len(key), time.time()))
+
+    def evict(self):
+        """ Delete least recently used entries until the blocks and keys left fit in max_bytes """
+        total = 0
+        stale = []
+        for key, size in self.db.execute("SELECT key, size FROM blocks ORDER BY last_used DESC"):
+            total += size
+            if total > self.max_bytes:
+                stale.append((key,))
+        self.db.executemany("DELETE FROM blocks WHERE key = ?", stale)
+        return len(stale)
+
+    def close(self):
+        """ Record which entries were used, evict, and write everything to disk """
+        now = time.time()
+        self.db.executemany("UPDATE blocks SET last_used = ? WHERE key = ?", [(now, key) for key in self.touched])
+        self.touched = []
+        self.evict()
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,164 @@
+from itertools import count
+
+from QADPatch.QuizQuestions import QuizQuestion, MAX_QUESTION_LIST_SIZE, MAX_CATEGORIES, MAX_CATEGORY_NAMES_SIZE
+from QADPatch.Validation import Validator, format_error
+
+
+class CapacityEstimator:
+    """
+    Live estimate of how much of the ROM's question list a set of questions takes, for editors and what-if planning,
+    without running a build. Questions are encoded one at a time against a fixed pair of dictionaries (e.g. from
+    build.make_dictionaries for the current question bank), so adding or removing one takes about a millisecond. A
+    build rebuilds the dictionaries for the questions it's given, so the estimate drifts as the set changes: make a
+    new estimator from time to time to catch up.
+
+    Each question is a dict with its "category", encoded "bytes" (including its length byte), wrapped "lines" and any
+    validation "errors" (formatted like build.py logs them). Questions with errors have no bytes and aren't counted.
+    """
+
+    def __init__(self, question_list, proper_noun_dictionary, main_dictionary, capacity=MAX_QUESTION_LIST_SIZE):
+        # question_list is only used to encode, so it can be empty
+        self.encoder = question_list
+        self.proper_noun_dictionary = proper_noun_dictionary
+        self.main_dictionary = main_dictionary
+        self.capacity = capacity
+        self.validator = Validator(question_list.byte_reference_table)
+        self.questions = {}
+        # {name: {key: bytes}}, in key order. Keys count up as questions are added, so that's the order they were added
+        # in, which is their order within a category in the ROM
+        self.categories = {}
+        self.question_bytes = 0
+        self.keys = count()
+
+    @classmethod
+    def for_question_list(cls, question_list, proper_noun_dictionary, main_dictionary, capacity=MAX_QUESTION_LIST_SIZE):
+        """ An estimator that starts with every question in a QuestionList """
+        estimator = cls(question_list, proper_noun_dictionary, main_dictionary, capacity)
+        for category, question_text, answers in question_list.store.rows():
+            estimator.add(category, question_text, answers)
+        return estimator
+
+    def estimate(self, category, question_text, answers):
+        """ The estimate for one question, without adding it """
+        estimate = {"category": category, "bytes": None, "lines": None, "errors": []}
+        errors = self.validator.validate(question_text, answers)
+        if errors:
+            estimate["errors"] = [format_error(error) for error in errors]
+            return estimate
+        question = QuizQuestion(category, question_text, answers)
+        estimate["lines"] = question.wrap().count("\n") + 1
+        block = self.encoder.encode_question(question, self.proper_noun_dictionary, self.main_dictionary)
+        estimate["bytes"] = len(block) + 1
+        return estimate
+
+    def add(self, category, question_text, answers):
+        """ Add a question. Returns (key, estimate), where key is None if the question has errors and wasn't added """
+        estimate = self.estimate(category, question_text, answers)
+        if estimate["errors"]:
+            return None, estimate
+        key = next(self.keys)
+        self.insert(key, estimate)
+        return key, estimate
+
+    def insert(self, key, estimate):
+        """ Count an estimate under key, in its place among its category's questions """
+        self.questions[key] = estimate
+        sizes = self.categories.setdefault(estimate["category"], {})
+        in_order = not sizes or key > next(reversed(sizes))
+        sizes[key] = estimate["bytes"]
+        if not in_order:
+            self.categories[estimate["category"]] = dict(sorted(sizes.items()))
+        self.question_bytes += estimate["bytes"]
+
+    def remove(self, key):
+        """ Remove a question added earlier. Returns its estimate """
+        estimate = self.questions.pop(key)
+        category = self.categories[estimate["category"]]
+        del category[key]
+        if not category:
+            del self.categories[estimate["category"]]
+        self.question_bytes -= estimate["bytes"]
+        return estimate
+
+    def replace(self, key, category, question_text, answers):
+        """
+        Swap a question for an edited version, e.g. as it's typed. It keeps its key, and so its place among its
+        category's questions, even if the category changes. Returns (key, estimate) like add: if the edit has errors,
+        key is None and the question is left as it was.
+        """
+        estimate = self.estimate(category, question_text, answers)
+        if estimate["errors"]:
+            return None, estimate
+        old = self.questions[key]
+        if old["category"] == category:
+            self.questions[key] = estimate
+            self.categories[category][key] = estimate["bytes"]
+            self.question_bytes += estimate["bytes"] - old["bytes"]
+        else:
+            self.remove(key)
+            self.insert(key, estimate)
+        return key, estimate
+
+    def used_bytes(self):
+        """ Bytes of the question list taken: every question's block, plus a terminator between categories """
+        return self.question_bytes + max(len(self.categories) - 1, 0)
+
+    def remaining_bytes(self):
+        """ Space left in the question list. Negative if it's over """
+        return self.capacity - self.used_bytes()
+
+    def fitted(self):
+        """
+        How many questions a build would write, and the key of the first one it would drop (or None). Builds write
+        categories in name order and stop at the first question that doesn't fit, like QuestionList.layout.
+        """
+        pos = 0
+        written = 0
+        for n, name in enumerate(sorted(self.categories)):
+            if n:
+                pos += 1
+            for key, size in self.categories[name].items():
+                if pos + size > self.capacity:
+                    return written, key
+                pos += size
+                written += 1
+        return written, None
+
+    def category_errors(self):
+        """ Why the categories wouldn't fit in the ROM's category table, like build.category_limit_error """
+        errors = []
+        if len(self.categories) > MAX_CATEGORIES:
+            errors.append(f"Too many categories. There can be a max of {MAX_CATEGORIES}")
+        if sum(len(name) + 1 for name in self.categories) > MAX_CATEGORY_NAMES_SIZE:
+            errors.append("Total category name length is too long")
+        return errors
+
+    def dictionary_budget(self):
+        """ {"proper" and "main": {"words", "max_words", "bytes", "max_bytes"}} for the dictionaries being used """
+        return {name: {"words": len(dictionary.words), "max_words": dictionary.max_word_count,
+                       "bytes": len(dictionary.serialize()), "max_bytes": dictionary.max_size}
+                for name, dictionary in [("proper", self.proper_noun_dictionary), ("main", self.main_dictionary)]}
+
+    def summary(self):
+        """ Everything above for the current set, as a JSON-serializable dict """
+        fitted, first_dropped = self.fitted()
+        return {"questions": len(self.questions), "fitted": fitted, "used_bytes": self.used_bytes(),
+                "remaining_bytes": self.remaining_bytes(), "capacity": self.capacity,
+                "fits": first_dropped is None and not self.category_errors(),
+                "category_errors": self.category_errors(),
+                "categories": {name: {"questions": len(sizes), "bytes": sum(sizes.values())}
+                               for name, sizes in sorted(self.categories.items())},
+                "dictionaries": self.dictionary_budget()}
+
+
+def format_summary(summary):
+    """ Lines describing a CapacityEstimator summary, for logging """
+    lines = [f"{summary['questions']} questions take {summary['used_bytes']} of {summary['capacity']} bytes "
+             f"({summary['remaining_bytes']} left). {summary['fitted']} would fit."]
+    for name, category in summary["categories"].items():
+        lines.append(f"  {name:<24} {category['questions']:>6} questions {category['bytes']:>8} bytes")
+    for name, budget in summary["dictionaries"].items():
+        lines.append(f"  {name.capitalize()} dictionary: {budget['words']} of {budget['max_words']} words, "
+                     f"{budget['bytes']} of {budget['max_bytes']} bytes")
+    lines.extend(f"  {error}" for error in summary["category_errors"])
+    return lines
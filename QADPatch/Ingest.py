@@ -0,0 +1,157 @@
+import json
+import sys
+
+from QADPatch.Validation import Validator
+
+READ_SIZE = 1 << 16
+
+
+class IngestError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def iter_json_lines(f):
+    """ Yield one record per line of a JSON Lines file. Blank lines are skipped """
+    for line_number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise IngestError(f"Line {line_number} isn't valid JSON: {e.msg}")
+
+
+def iter_json_array(f, read_size=READ_SIZE):
+    """
+    Yield the elements of a top-level JSON array one at a time, reading f in read_size chunks, so only the element being
+    parsed (rather than the whole document) is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        """ Drop what's been parsed and read another chunk. Returns False at the end of the file """
+        nonlocal buffer, pos, eof
+        chunk = f.read(read_size)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        eof = not chunk
+        return not eof
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return
+
+    skip_whitespace()
+    if buffer[pos:pos + 1] != "[":
+        raise IngestError("Expected a JSON array of questions")
+    pos += 1
+    skip_whitespace()
+    if buffer[pos:pos + 1] == "]":
+        return
+    while True:
+        # An element can span chunks, so keep reading until it parses or the file ends
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                if not fill():
+                    raise IngestError(f"Invalid JSON array: {e.msg}")
+                continue
+            # A number running up to the end of the buffer might continue in the next chunk
+            if end < len(buffer) or not fill():
+                break
+        pos = end
+        yield element
+        skip_whitespace()
+        separator = buffer[pos:pos + 1]
+        pos += 1
+        if separator == "]":
+            return
+        if separator != ",":
+            raise IngestError(f"Expected , or ] between questions, found {separator!r}")
+        skip_whitespace()
+
+
+def iter_records(filename):
+    """
+    Yield question records ({"category", "question", "answers"}) from filename, which is either a JSON array (like
+    questions.json) or JSON Lines with one record per line, told apart by its first character.
+    """
+    with open(filename, "r") as f:
+        first = ""
+        while True:
+            first = f.read(1)
+            if not first or not first.isspace():
+                break
+        f.seek(0)
+        if first == "[":
+            yield from iter_json_array(f)
+        else:
+            yield from iter_json_lines(f)
+
+
+def ingest(filename, question_list):
+    """
+    Stream the questions in filename into question_list, validating each one as it's read. Only the file is streamed:
+    the valid questions are kept in question_list's QuestionStore, since a build needs all of them to pick dictionaries.
+    Words aren't counted until the QuestionList's word counts are first needed (see QuestionList.count_words). Invalid
+    questions are skipped. Returns (added, errors), where errors is a list of Validation error records with the
+    "index" of the question in the file.
+    """
+    validator = Validator(question_list.byte_reference_table)
+    added = 0
+    errors = []
+    for index, q in enumerate(iter_records(filename)):
+        try:
+            category, question_text, answers = q["category"], q["question"], q["answers"]
+        except (KeyError, TypeError):
+            raise IngestError(f"Question {index + 1} needs a category, question and answers")
+
+        question_errors = validator.validate(question_text, answers)
+        if question_errors:
+            for error in question_errors:
+                error["index"] = index
+            errors.extend(question_errors)
+            continue
+        # Every question in a category shares one copy of its name
+        question_list.add(sys.intern(category), question_text, answers)
+        added += 1
+    return added, errors
+
+
+class JsonArrayWriter:
+    """
+    Write records to f one at a time as a JSON array, formatted the same as json.dump(records, f, indent=indent), so a
+    file can be written as records arrive instead of collected into a list first. close() ends the array and closes f.
+    """
+
+    def __init__(self, f, indent=4, ensure_ascii=True):
+        self.f = f
+        self.indent = indent
+        self.ensure_ascii = ensure_ascii
+        self.count = 0
+
+    def write(self, record):
+        self.f.write(",\n" if self.count else "[\n")
+        text = json.dumps(record, indent=self.indent, ensure_ascii=self.ensure_ascii)
+        self.f.write("\n".join(" " * self.indent + line for line in text.split("\n")))
+        self.count += 1
+
+    def close(self):
+        self.f.write("\n]" if self.count else "[]")
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
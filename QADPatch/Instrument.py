@@ -0,0 +1,90 @@
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from os.path import join
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where RSS and child CPU time aren't reported
+    resource = None
+
+
+def rusage():
+    """ (CPU seconds used by finished child processes, peak RSS of this process in MB, of its largest child in MB) """
+    if resource is None:
+        return 0.0, None, None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    scale = 1 << 20 if sys.platform == "darwin" else 1 << 10
+    return (children.ru_utime + children.ru_stime, round(own.ru_maxrss / scale, 1),
+            round(children.ru_maxrss / scale, 1))
+
+
+class BuildProfile:
+    """
+    Timings and counters for one build. Each stage runs in a span(), which records its wall time, CPU time (of this
+    process and of any worker processes that finished during it) and the peak RSS so far. Peak RSS never goes down, so
+    a stage that raised it shows up as the first one with the new value. Counters are any JSON-serializable values
+    stored with set(). With profile_dir, every span is also run under cProfile and its stats written to
+    profile_dir/NN-<span>.pstats, which covers this process only, not worker processes.
+    """
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.spans = []
+        self.counters = {}
+        self.started = time.time()
+        self.start = time.perf_counter()
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @contextmanager
+    def span(self, name):
+        """ Time the body of a with block as the stage called name. Spans don't nest """
+        profiler = cProfile.Profile() if self.profile_dir else None
+        child_cpu, _, _ = rusage()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            span = {"name": name, "wall_seconds": round(time.perf_counter() - wall, 4),
+                    "cpu_seconds": round(time.process_time() - cpu, 4)}
+            child_cpu_after, peak_rss, child_peak_rss = rusage()
+            span.update(child_cpu_seconds=round(child_cpu_after - child_cpu, 4), peak_rss_mb=peak_rss,
+                        child_peak_rss_mb=child_peak_rss)
+            if profiler:
+                span["pstats"] = join(self.profile_dir, f"{len(self.spans):02d}-{name.replace(' ', '_')}.pstats")
+                profiler.dump_stats(span["pstats"])
+            self.spans.append(span)
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def report(self):
+        """ Everything recorded, as a JSON-serializable dict """
+        return {"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "wall_seconds": round(time.perf_counter() - self.start, 4),
+                "spans": self.spans, "counters": self.counters}
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=4)
+
+    def format_spans(self):
+        """ One line per span, for logging """
+        lines = [f"{'Stage':<24} {'Wall':>8} {'CPU':>8} {'Workers':>8} {'Peak RSS':>10}"]
+        for span in self.spans:
+            rss = f"{span['peak_rss_mb']:.1f} MB" if span["peak_rss_mb"] is not None else "-"
+            lines.append(f"{span['name']:<24} {span['wall_seconds']:>7.3f}s {span['cpu_seconds']:>7.3f}s "
+                         f"{span['child_cpu_seconds']:>7.3f}s {rss:>10}")
+        return lines
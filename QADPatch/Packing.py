@@ -0,0 +1,128 @@
+import heapq
+from collections import OrderedDict
+
+from QADPatch.QuizQuestions import MAX_QUESTION_LIST_SIZE
+
+
+class PackingError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class PackingPlanner:
+    """
+    Chooses which encoded questions go in the question list once every block's size is known, instead of writing them
+    in order until the region is full. Categories stay contiguous and questions keep their order within a category.
+
+    Each category first gets its minimum number of questions (minimums maps category names to counts, default_minimum
+    covers the rest), smallest blocks first. The remaining space is then filled to maximize the total weight of the
+    questions packed, where every question in a category is worth weights[category] (default 1), so with no weights
+    this packs as many questions as possible. With balance set, the space is instead handed out a question at a time
+    to whichever category has the fewest questions per unit of weight, so categories fill evenly (in proportion to
+    their weights) until they run out of questions that fit.
+    """
+
+    def __init__(self, capacity=MAX_QUESTION_LIST_SIZE, minimums=None, default_minimum=0, weights=None,
+                 balance=False):
+        self.capacity = capacity
+        self.minimums = minimums or {}
+        self.default_minimum = default_minimum
+        self.weights = weights or {}
+        self.balance = balance
+
+    def weight(self, category):
+        return self.weights.get(category, 1)
+
+    def plan(self, questions, blocks):
+        """
+        questions is a category-sorted list of QuizQuestions and blocks their encoded blocks. Returns (indices, report):
+        the indices of the questions to write, in order, and a report as described in make_report.
+        """
+        by_category = OrderedDict()
+        for i, question in enumerate(questions):
+            by_category.setdefault(question.category, []).append(i)
+        for category, weight in self.weights.items():
+            if weight <= 0:
+                raise PackingError(f"Category {category} has a weight of {weight}. Weights must be positive")
+
+        # A block takes its length byte as well, and each category section ends with a null byte
+        sizes = [len(block) + 1 for block in blocks]
+        chosen = {category: [] for category in by_category}
+        remaining = {}
+        used = 0
+        for category, indices in by_category.items():
+            by_size = sorted(indices, key=lambda i: (sizes[i], i))
+            minimum = min(self.minimums.get(category, self.default_minimum), len(indices))
+            chosen[category] = by_size[:minimum]
+            remaining[category] = by_size[minimum:]
+            if minimum:
+                used += 1 + sum(sizes[i] for i in chosen[category])
+        if used > self.capacity:
+            raise PackingError(f"The per-category minimums need {used} bytes, but the question list only has "
+                               f"{self.capacity}. Lower the minimums")
+
+        if self.balance:
+            self.fill_balanced(chosen, remaining, sizes, used)
+        else:
+            self.fill_by_weight(chosen, remaining, sizes, used)
+
+        indices = sorted(i for category_indices in chosen.values() for i in category_indices)
+        return indices, self.make_report(by_category, chosen, sizes)
+
+    def fill_by_weight(self, chosen, remaining, sizes, used):
+        """ Take questions by weight per byte, best first, skipping any that no longer fit """
+        candidates = [(-self.weight(category) / sizes[i], sizes[i], i, category)
+                      for category, indices in remaining.items() for i in indices]
+        for _, size, i, category in sorted(candidates):
+            cost = size + (0 if chosen[category] else 1)
+            if used + cost <= self.capacity:
+                chosen[category].append(i)
+                used += cost
+
+    def fill_balanced(self, chosen, remaining, sizes, used):
+        """ Give the next smallest question to the least-filled category until nothing fits """
+        order = {category: n for n, category in enumerate(remaining)}
+        heap = [(len(chosen[category]) / self.weight(category), order[category], category)
+                for category, indices in remaining.items() if indices]
+        heapq.heapify(heap)
+        position = {category: 0 for category in remaining}
+        while heap:
+            _, n, category = heapq.heappop(heap)
+            i = remaining[category][position[category]]
+            cost = sizes[i] + (0 if chosen[category] else 1)
+            # Remaining questions are sorted by size, so if this one doesn't fit none of the category's others will
+            if used + cost > self.capacity:
+                continue
+            chosen[category].append(i)
+            used += cost
+            position[category] += 1
+            if position[category] < len(remaining[category]):
+                heapq.heappush(heap, (len(chosen[category]) / self.weight(category), n, category))
+
+    def make_report(self, by_category, chosen, sizes):
+        """
+        {"capacity": bytes, "bytes_used": bytes, "categories": {name: {"available", "packed", "dropped", "bytes"}}}.
+        A category's bytes include its blocks' length bytes and its null terminator.
+        """
+        report = {"capacity": self.capacity, "bytes_used": 0, "categories": OrderedDict()}
+        for category, indices in by_category.items():
+            packed = chosen[category]
+            category_bytes = sum(sizes[i] for i in packed) + (1 if packed else 0)
+            report["categories"][category] = {"available": len(indices), "packed": len(packed),
+                                              "dropped": len(indices) - len(packed), "bytes": category_bytes}
+            report["bytes_used"] += category_bytes
+        return report
+
+
+def format_report(report):
+    """ Lines of a table summarizing a PackingPlanner report """
+    lines = [f"{'Category':<30} {'Packed':>7} {'Dropped':>8} {'Bytes':>8}"]
+    packed = dropped = 0
+    for name, info in report["categories"].items():
+        lines.append(f"{name:<30} {info['packed']:>7} {info['dropped']:>8} {info['bytes']:>8}")
+        packed += info["packed"]
+        dropped += info["dropped"]
+    lines.append(f"{'Total':<30} {packed:>7} {dropped:>8} {report['bytes_used']:>8}")
+    lines.append(f"{report['bytes_used']} of {report['capacity']} bytes used, "
+                 f"{report['capacity'] - report['bytes_used']} free")
+    return lines
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+
+# Never put these in a dictionary entry: braces toggle italics, < and > render as symbols, newlines end a line
+EXCLUDED_CHARS = "{}<>\n"
+MAIN_CODE_SIZE = 2
+
+
+def baseline_costs(question_list, s_bytes, proper_noun_dictionary, main_dictionary):
+    """
+    Encode s_bytes the way question_list would and return (prefix, boundary). prefix[i] is the number of encoded bytes
+    spent on s_bytes[:i] and boundary[i] is 1 if i doesn't fall inside a dictionary lookup.
+    """
+    prefix = [0] * (len(s_bytes) + 1)
+    boundary = bytearray(b'\x01') * (len(s_bytes) + 1)
+    for start, stop, code in question_list.tokenize(s_bytes, proper_noun_dictionary, main_dictionary):
+        if code is None:
+            for i in range(start, stop):
+                prefix[i + 1] = prefix[i] + 1
+            continue
+        for i in range(start + 1, stop):
+            boundary[i] = 0
+            prefix[i] = prefix[start]
+        prefix[stop] = prefix[start] + len(code)
+    return prefix, boundary
+
+
+def mine_phrases(question_list, proper_noun_dictionary, main_dictionary, min_count=3, min_length=3, max_length=24,
+                 allow_spaces=True):
+    """
+    Find substrings that repeat across the question corpus: multi-word phrases ("Which of the") and sub-word fragments
+    ("tion", "ing "), rather than only whole words. Returns an ordered dict of {phrase: bytes saved} for
+    build_dictionaries, biggest savers first.
+
+    Savings are marginal over the word dictionaries passed in, encoded the way question_list encodes. Each occurrence
+    saves whatever that encoding spends on it minus the 2 byte main dictionary code, and nothing if it would cut a
+    dictionary lookup in half. That way a
+    phrase isn't credited with bytes its words already save, or with fragments that only occur inside words that are
+    already encoded.
+
+    Substrings are counted one length at a time, and only substrings seen min_count times are extended, since a
+    substring can't occur more often than its prefix. A substring is dropped if a longer one containing it occurs just
+    as often, because then it never appears on its own. Phrases only contain ASCII characters the ROM displays
+    verbatim. If allow_spaces is False they don't contain spaces either.
+    """
+    # The scan runs over the encoded bytes, which the costs are indexed by. Only ASCII characters are one byte each
+    allowed = {ord(c) for c in set(question_list.allowed_chars) - set(EXCLUDED_CHARS) if c.isascii()}
+    # Newlines are encoded as 0x01, which also ends an answer
+    allowed -= {0x00, 0x01}
+    if not allow_spaces:
+        allowed.discard(ord(" "))
+
+    texts = []
+    costs = []
+    for s in question_list.encodable_strings():
+        s_bytes = s.encode("utf-8").replace(b'\n', b'\x01')
+        texts.append(s_bytes)
+        costs.append(baseline_costs(question_list, s_bytes, proper_noun_dictionary, main_dictionary))
+
+    # Positions where a phrase of the current length can start. A phrase extends one byte at a time, so a disallowed
+    # byte cuts it off.
+    positions = [(t, i) for t, text in enumerate(texts) for i in range(len(text) - min_length + 1)
+                 if all(c in allowed for c in text[i:i + min_length])]
+    counts = {}
+    savings = {}
+    length = min_length
+    while positions and length <= max_length:
+        level_counts = {}
+        level_savings = {}
+        for t, i in positions:
+            phrase = texts[t][i:i + length]
+            level_counts[phrase] = level_counts.get(phrase, 0) + 1
+            prefix, boundary = costs[t]
+            if boundary[i] and boundary[i + length]:
+                saved = prefix[i + length] - prefix[i] - MAIN_CODE_SIZE
+                if saved > 0:
+                    level_savings[phrase] = level_savings.get(phrase, 0) + saved
+        frequent = {phrase for phrase, count in level_counts.items() if count >= min_count}
+        for phrase in frequent:
+            counts[phrase] = level_counts[phrase]
+            savings[phrase] = level_savings.get(phrase, 0)
+        positions = [(t, i) for t, i in positions
+                     if i + length < len(texts[t]) and texts[t][i + length] in allowed
+                     and texts[t][i:i + length] in frequent]
+        length += 1
+
+    # Drop substrings that only ever appear inside a longer phrase
+    for phrase, count in list(counts.items()):
+        if len(phrase) == min_length:
+            continue
+        for part in (phrase[:-1], phrase[1:]):
+            if counts.get(part) == count:
+                savings.pop(part, None)
+
+    existing = set(proper_noun_dictionary.words) | set(main_dictionary.words)
+    phrases = {phrase.decode("ascii"): saved for phrase, saved in savings.items() if saved > 0}
+    phrases = {phrase: saved for phrase, saved in phrases.items() if phrase not in existing}
+    return OrderedDict(sorted(phrases.items(), reverse=True, key=lambda kv: (kv[1], kv[0])))
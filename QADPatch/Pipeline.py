@@ -0,0 +1,394 @@
+import csv
+import re
+import sys
+import time
+from collections import deque
+from functools import partial
+from itertools import islice
+
+from unidecode import unidecode
+
+from QADPatch.Ingest import IngestError, JsonArrayWriter, iter_records
+from QADPatch.Validation import Validator, format_error
+
+# Chunks a MapStage keeps queued in its executor for every worker, so workers stay busy without the whole stream being
+# read ahead
+CHUNKS_IN_FLIGHT = 2
+
+
+class StageStats:
+    """ How many records went into and came out of a pipeline stage, and how long the stage itself spent on them """
+
+    def __init__(self, name):
+        self.name = name
+        self.records_in = 0
+        self.records_out = 0
+        self.seconds = 0.0
+        # Time spent pulling records through this stage, including every stage before it
+        self.elapsed = 0.0
+
+    def rate(self):
+        """ Records handled per second """
+        return self.records_in / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return (f"{self.name}: {self.records_in} in, {self.records_out} out, {self.seconds:.3f}s "
+                f"({self.rate():.0f} records/s)")
+
+
+class Source:
+    """ A named iterable of question records ({"category", "question", "answers"}) at the start of a Pipeline """
+
+    def __init__(self, name, records):
+        self.name = name
+        self.records = records
+
+
+class Stage:
+    """ A pipeline step: function takes an iterator of records and yields records. It can drop, add or reorder them """
+
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+
+    def __call__(self, records):
+        return self.function(records)
+
+
+class MapStage(Stage):
+    """
+    A stage that calls record_function on each record, which returns the record to pass on or None to drop it. With
+    an executor (a concurrent.futures thread or process pool) records are handed to it in chunks of chunk_size and come
+    back in their original order. 'workers' is the max_workers the executor was created with, which sets how many
+    chunks are kept queued. For a process pool, record_function has to be picklable: a module level function, or a
+    functools.partial of one.
+    """
+
+    def __init__(self, name, record_function, executor=None, workers=1, chunk_size=256):
+        super().__init__(name, None)
+        self.record_function = record_function
+        self.executor = executor
+        self.workers = max(workers, 1)
+        self.chunk_size = chunk_size
+
+    def __call__(self, records):
+        if self.executor is None:
+            for record in records:
+                record = self.record_function(record)
+                if record is not None:
+                    yield record
+            return
+
+        in_flight = CHUNKS_IN_FLIGHT * self.workers
+        pending = deque()
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, self.chunk_size))
+            if chunk:
+                pending.append(self.executor.submit(map_chunk, self.record_function, chunk))
+            if pending and (len(pending) >= in_flight or not chunk):
+                yield from pending.popleft().result()
+            elif not chunk:
+                return
+
+
+def map_chunk(record_function, chunk):
+    """ Apply a MapStage's function to a chunk of records in a worker """
+    return [record for record in map(record_function, chunk) if record is not None]
+
+
+def timed(records, stats):
+    """ Pass records through, counting them and the time spent waiting for each into stats """
+    records = iter(records)
+    while True:
+        start = time.perf_counter()
+        try:
+            record = next(records)
+        except StopIteration:
+            stats.elapsed += time.perf_counter() - start
+            return
+        stats.elapsed += time.perf_counter() - start
+        stats.records_out += 1
+        yield record
+
+
+class Pipeline:
+    """
+    Question records flow from a Source through each Stage in turn and into a sink, one record at a time, so nothing
+    is collected in memory unless a stage needs to. A sink is any callable that takes the final iterator of records and
+    returns a result (see JsonSink and QuestionListSink). After run(), stats holds a StageStats for the source, each
+    stage and the sink.
+    """
+
+    def __init__(self, source, stages=()):
+        self.source = source
+        self.stages = list(stages)
+        self.stats = []
+
+    def run(self, sink):
+        """ Pull every record through the pipeline into sink. Returns what sink returns """
+        self.stats = [StageStats(self.source.name)]
+        records = timed(self.source.records, self.stats[0])
+        for stage in self.stages:
+            stats = StageStats(stage.name)
+            self.stats.append(stats)
+            records = timed(stage(records), stats)
+        sink_stats = StageStats(getattr(sink, "name", "sink"))
+
+        start = time.perf_counter()
+        try:
+            result = sink(records)
+        finally:
+            sink_stats.elapsed = time.perf_counter() - start
+            self.stats.append(sink_stats)
+            # Each stage's own time is what it took beyond the stages feeding it
+            previous = None
+            for stats in self.stats:
+                if previous is None:
+                    stats.records_in = stats.records_out
+                    stats.seconds = stats.elapsed
+                else:
+                    stats.records_in = previous.records_out
+                    stats.seconds = max(stats.elapsed - previous.elapsed, 0.0)
+                previous = stats
+            sink_stats.records_out = getattr(sink, "count", 0)
+        return result
+
+    def report(self):
+        """ One line per stage of the last run's counters, for logging """
+        lines = [f"{'Stage':<20} {'In':>9} {'Out':>9} {'Seconds':>9} {'Records/s':>11}"]
+        for stats in self.stats:
+            lines.append(f"{stats.name:<20} {stats.records_in:>9} {stats.records_out:>9} {stats.seconds:>9.3f} "
+                         f"{stats.rate():>11.0f}")
+        return lines
+
+
+# Sources
+
+def json_source(filename):
+    """ Records from a JSON array (like questions.json) or JSON Lines file """
+    return Source(filename, iter_records(filename))
+
+
+def iter_csv(filename):
+    with open(filename, "r", newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        fields = reader.fieldnames or []
+        answer_fields = sorted((field for field in fields if re.fullmatch(r"answer\d+", field)),
+                               key=lambda field: int(field[6:]))
+        if "category" not in fields or "question" not in fields or not answer_fields:
+            raise IngestError("A CSV file needs category, question and answer1, answer2... columns")
+        for row in reader:
+            yield {"category": row["category"], "question": row["question"],
+                   "answers": [row[field] for field in answer_fields if row[field]]}
+
+
+def csv_source(filename):
+    """
+    Records from a CSV file with a header row naming its category, question and answer1, answer2... columns, the
+    first answer being the correct one. Other columns are ignored, as are empty answers.
+    """
+    return Source(filename, iter_csv(filename))
+
+
+# Transforms
+
+def check_text(text):
+    """Check the strings in the argument for invalid characters, which
+    can be a string (a question) or a list of strings (answers).
+    If no errors are found, returns an empty string. Otherwise, returns
+    a string that contains the text with invalid characters.
+    """
+
+    allowed_characters = re.compile('^[ !"$%&\'()+,-./0-9:;<=>?A-Z_a-z\\{\\}“”ʻ’…÷*~]*$')
+
+    if isinstance(text,str):
+        if allowed_characters.fullmatch(text) is None:
+            return f"Question {text} contains invalid characters"
+
+    elif isinstance(text,list):
+        errors = []
+        for a in text:
+            if allowed_characters.fullmatch(a) is None:
+                errors.append(a)
+        if len(errors) == 1:
+            return f"Answer {errors[0]} contains invalid characters"
+        elif len(errors) > 1:
+            return f"Answers {errors} contain invalid characters"
+
+    return ""
+
+
+def fix_str(s, question=False):
+    """ Remove/replace non-ascii chars """
+    s = unidecode(s)
+
+    # Replace pairs of quotes with { } to italicize
+    if question:
+        while True:
+            quotes = re.findall(r'(")', s)
+            ticks = re.findall(r'(`)', s)
+            if len(quotes) >= 2:
+                index = s.index('"')
+                s = s[0:index] + "{" + s[index+1:]
+                index = s.index('"')
+                s = s[0:index] + "}" + s[index + 1:]
+            elif len(ticks) >= 2:
+                index = s.index('`')
+                s = s[0:index] + "{" + s[index+1:]
+                index = s.index('`')
+                s = s[0:index] + "}" + s[index + 1:]
+            else:
+                break
+    return s
+
+
+def add_error(record, error):
+    record["error"] = record["error"] + "\n" + error if record.get("error") else error
+
+
+def normalize_record(record, check_questions=False, check_answers=True, print_invalid=False):
+    """
+    Strip the text of a record. A question is checked for characters Quiz & Dragons can't show if check_questions is
+    set, and otherwise has its accents removed and pairs of quotes turned into italics ({ }). Likewise the answers with
+    check_answers, minus the italics. Failed checks are recorded in the record's "error".
+    """
+    record = dict(record)
+    record["question"] = record["question"].strip()
+    record["answers"] = [answer.strip() for answer in record["answers"]]
+    if check_questions:
+        error = check_text(record["question"])
+        if error:
+            if print_invalid:
+                print(f"Warning: In category {record['category']}, question '{record['question']}' has invalid "
+                      f"characters.")
+            add_error(record, error)
+    else:
+        record["question"] = fix_str(record["question"], question=True)
+
+    if check_answers:
+        error = check_text(record["answers"])
+        if error:
+            if print_invalid:
+                print(f"Warning: In category {record['category']}, question '{record['question']}' has answers with "
+                      f"invalid characters.\nAnswers: {record['answers']}")
+            add_error(record, error)
+    else:
+        record["answers"] = [fix_str(answer) for answer in record["answers"]]
+    return record
+
+
+def shorten_category(record, shortened=None):
+    """ Keep the part of the category after any ":" (Entertainment: Film becomes Film), then apply shortened """
+    category = record["category"].split(":")[-1].strip()
+    category = (shortened or {}).get(category, category)
+    if category == record["category"]:
+        return record
+    return dict(record, category=category)
+
+
+def validate_record(record, validator):
+    """ Check a record against the ROM's characters and length limits, recording any problems in its "error" """
+    errors = validator.validate(record["question"], record["answers"])
+    if not errors:
+        return record
+    record = dict(record)
+    for error in errors:
+        add_error(record, format_error(error))
+    return record
+
+
+def normalize(check_questions=False, check_answers=True, print_invalid=False, executor=None, workers=1):
+    return MapStage("normalize", partial(normalize_record, check_questions=check_questions,
+                                         check_answers=check_answers, print_invalid=print_invalid), executor, workers)
+
+
+def shorten_categories(shortened=None, executor=None, workers=1):
+    return MapStage("shorten categories", partial(shorten_category, shortened=shortened), executor, workers)
+
+
+def validate(byte_reference_table, executor=None, workers=1):
+    return MapStage("validate", partial(validate_record, validator=Validator(byte_reference_table)), executor,
+                    workers)
+
+
+def dedupe(key=None):
+    """ Drop records whose key (by default the category and question text) has already been seen """
+    key = key or (lambda record: (record["category"], record["question"]))
+
+    def unique(records):
+        seen = set()
+        for record in records:
+            k = key(record)
+            if k not in seen:
+                seen.add(k)
+                yield record
+
+    return Stage("dedupe", unique)
+
+
+# Sinks
+
+class JsonSink:
+    """
+    Write records without an "error" to filename as a JSON array like questions.json. Records with one go to
+    errors_filename, created once the first one arrives, or are dropped if it's None. Returns (written, errors).
+    """
+
+    def __init__(self, filename, errors_filename=None):
+        self.name = f"write {filename}"
+        self.filename = filename
+        self.errors_filename = errors_filename
+        self.count = 0
+        self.errors = 0
+
+    def __call__(self, records):
+        errors_writer = None
+        with JsonArrayWriter(open(self.filename, "w"), indent=4) as writer:
+            try:
+                for record in records:
+                    if not record.get("error"):
+                        writer.write(record)
+                        self.count += 1
+                        continue
+                    self.errors += 1
+                    if self.errors_filename is not None:
+                        if errors_writer is None:
+                            errors_writer = JsonArrayWriter(open(self.errors_filename, "w", encoding="utf8"),
+                                                            indent=4, ensure_ascii=False)
+                        errors_writer.write(record)
+            finally:
+                if errors_writer is not None:
+                    errors_writer.close()
+        return self.count, self.errors
+
+
+class QuestionListSink:
+    """
+    Add records straight to a QuizQuestions.QuestionList, e.g. to build a ROM without writing questions.json first.
+    Every record is validated like Ingest.ingest does, and ones that fail, or that already carry an "error", are
+    skipped. Returns (added, errors) like ingest, with the "index" of each error's record in the stream.
+    """
+
+    def __init__(self, question_list):
+        self.name = "question list"
+        self.question_list = question_list
+        self.validator = Validator(question_list.byte_reference_table)
+        self.count = 0
+
+    def __call__(self, records):
+        errors = []
+        for index, record in enumerate(records):
+            if record.get("error"):
+                errors.append({"index": index, "field": "question", "text": record["question"], "kind": "source",
+                               "message": record["error"], "character": None, "position": None})
+                continue
+            question_errors = self.validator.validate(record["question"], record["answers"])
+            if question_errors:
+                for error in question_errors:
+                    error["index"] = index
+                errors.extend(question_errors)
+                continue
+            self.question_list.add(sys.intern(record["category"]), record["question"], record["answers"])
+            self.count += 1
+        return self.count, errors
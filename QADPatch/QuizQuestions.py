@@ -1,8 +1,19 @@
+import io
 import logging
-import re
+from array import array
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from QADPatch.WordDictionary import WordDictionary, flip_case
+from QADPatch.WordFrequency import count_words, count_words_parallel, iter_words
 
 MAX_QUESTION_LIST_SIZE = 0x56C90
+MAX_ANSWER_LENGTH = 22
+MAX_CATEGORIES = 14
+# Bytes for every category name, each null-terminated
+MAX_CATEGORY_NAMES_SIZE = 0x7c
+# Starting worker processes isn't worth it for fewer questions than this
+PARALLEL_MIN_QUESTIONS = 1000
 
 
 class BadStringError(Exception):
@@ -16,13 +27,113 @@ class QuestionTooLongError(Exception):
         self.message = message
 
 
+class QuestionStore:
+    """
+    Columnar storage for a large number of questions. Category names are interned to small ids, and every question's
+    text and answers are kept as UTF-8 in one contiguous buffer indexed by an offset array. Each question's encoded
+    length, once dump_bytes has encoded it, is kept alongside. Indexing or iterating a store gives QuestionViews onto
+    it rather than separate objects, and slicing it gives a list of them.
+    """
+
+    def __init__(self):
+        self.categories = []  # Category names by id
+        self.category_ids = {}
+        self.category_column = array('H')
+        self.text = bytearray()
+        # String k is text[string_offsets[k]:string_offsets[k + 1]]
+        self.string_offsets = array('L', [0])
+        # Question i is strings first_string[i] to first_string[i + 1] - 1: its question text, then its answers
+        self.first_string = array('L', [0])
+        # Bytes taken by the encoded block, or 0 if the question hasn't been encoded
+        self.encoded_lengths = array('L')
+
+    def __len__(self):
+        return len(self.category_column)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [QuestionView(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Question index out of range")
+        return QuestionView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield QuestionView(self, index)
+
+    def add(self, category, question_text, answers):
+        """ Append a question. Returns its index """
+        category_id = self.category_ids.get(category)
+        if category_id is None:
+            category_id = len(self.categories)
+            self.category_ids[category] = category_id
+            self.categories.append(category)
+        self.category_column.append(category_id)
+        for s in [question_text, *answers]:
+            self.text += s.encode("utf-8")
+            self.string_offsets.append(len(self.text))
+        self.first_string.append(len(self.string_offsets) - 1)
+        self.encoded_lengths.append(0)
+        return len(self) - 1
+
+    def string(self, k):
+        return self.text[self.string_offsets[k]:self.string_offsets[k + 1]].decode()
+
+    def strings(self):
+        """ Every question's text and answers, in order """
+        for k in range(len(self.string_offsets) - 1):
+            yield self.string(k)
+
+    def category(self, index):
+        return self.categories[self.category_column[index]]
+
+    def question_text(self, index):
+        return self.string(self.first_string[index])
+
+    def answers(self, index):
+        text = self.text
+        offsets = self.string_offsets
+        return [text[offsets[k]:offsets[k + 1]].decode()
+                for k in range(self.first_string[index] + 1, self.first_string[index + 1])]
+
+    def rows(self, indices=None):
+        """
+        Yield (category, question text, answers) for every question, or the ones at indices. Faster than going through
+        QuestionViews when every field is needed.
+        """
+        text = self.text
+        offsets = self.string_offsets
+        first_string = self.first_string
+        categories = self.categories
+        category_column = self.category_column
+        for index in range(len(self)) if indices is None else indices:
+            strings = [text[offsets[k]:offsets[k + 1]].decode()
+                       for k in range(first_string[index], first_string[index + 1])]
+            yield categories[category_column[index]], strings[0], strings[1:]
+
+    def indices_by_category(self):
+        """ Question indexes sorted by category name, keeping the order questions were added within each category """
+        by_category = [[] for _ in self.categories]
+        for index, category_id in enumerate(self.category_column):
+            by_category[category_id].append(index)
+        order = sorted(range(len(self.categories)), key=lambda category_id: self.categories[category_id])
+        return [index for category_id in order for index in by_category[category_id]]
+
+
 class QuizQuestion:
+    """
+    A question and its answers (the first answer is always the correct one). QuestionList.add_question copies it into
+    the list's QuestionStore, which hands out QuestionViews instead.
+    """
+    __slots__ = ("category", "question_text", "answers")
+    logger = logging.getLogger('QADPatch')
+
     def __init__(self, category, question_text, answers):
         self.category = category
         self.question_text = question_text
-        # First answer is always the correct one
         self.answers = answers
-        self.logger = logging.getLogger('QADPatch')
 
     def validate(self, allowed_chars):
         """ Validate a given question. Returns False if there is an issue """
@@ -41,7 +152,7 @@ class QuizQuestion:
             except BadStringError as e:
                 self.logger.warning(f"Text error in answer {answer}: {e.message}. {hex(ord(e.character))}")
                 return False
-            if len(answer) > 22:
+            if len(answer) > MAX_ANSWER_LENGTH:
                 self.logger.warning(f"Answer too long: {answer}")
                 return False
 
@@ -60,8 +171,16 @@ class QuizQuestion:
 
     def wrap(self):
         """ Add newlines to a question so that there are no more than 34 characters on a line. """
+        return self.wrap_text(self.question_text)
+
+    @staticmethod
+    def wrap_text(question_text):
+        """ QuizQuestion.wrap for question text that isn't in a QuizQuestion """
+        # Nothing to wrap if it all fits on one line
+        if len(question_text) <= 34:
+            return question_text.rstrip()
         out = ""
-        words = self.question_text.split(" ")
+        words = question_text.split(" ")
         current_line_length = 0
         current_line = 0
         for word in words:
@@ -78,150 +197,324 @@ class QuizQuestion:
         return out.rstrip()
 
 
+class QuestionView(QuizQuestion):
+    """ A QuizQuestion that reads one row of a QuestionStore rather than holding its own copy """
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def category(self):
+        return self.store.category(self.index)
+
+    @property
+    def question_text(self):
+        return self.store.question_text(self.index)
+
+    @property
+    def answers(self):
+        return self.store.answers(self.index)
+
+
 class QuestionList:
-    def __init__(self, byte_reference_table):
-        # question_list is a list of QuizQuestions
-        self.question_list = []
+    def __init__(self, byte_reference_table, optimal=False):
+        self.store = QuestionStore()
+        # Counter of every word in the questions, counted when first needed. See count_words
+        self._word_counts = None
+        # Use the minimum-byte encoder instead of the greedy longest-word-first one
+        self.optimal = optimal
         self.byte_reference_table = byte_reference_table
-        self.allowed_chars = []
+        self.allowed_chars = set()
         for i in range(0, len(self.byte_reference_table)):
             if self.byte_reference_table[i] == 0:
-                self.allowed_chars.append(chr(i))
+                self.allowed_chars.add(chr(i))
+        # Non-zero entries are 1-based proper noun dictionary indexes. The first byte mapping to an index is used.
+        self.proper_noun_bytes = {}
+        for i in reversed(range(0, len(self.byte_reference_table))):
+            if self.byte_reference_table[i] != 0:
+                self.proper_noun_bytes[self.byte_reference_table[i]] = i.to_bytes(1, 'big')
         self.logger = logging.getLogger('QADPatch')
 
+    @property
+    def question_list(self):
+        """ The QuestionStore, which indexes and iterates like a list of QuizQuestions """
+        return self.store
+
+    def subset(self, categories):
+        """ A new QuestionList with only the questions in the given categories """
+        categories = set(categories)
+        questions = QuestionList(self.byte_reference_table, optimal=self.optimal)
+        for category, question_text, answers in self.store.rows():
+            if category in categories:
+                questions.add(category, question_text, answers)
+        return questions
+
     def add_question(self, question):
-        """ Add a QuizQuestion to internal list """
-        self.question_list.append(question)
+        """ Copy a QuizQuestion into the store """
+        self.add(question.category, question.question_text, question.answers)
+
+    def add(self, category, question_text, answers):
+        """ add_question for a question that isn't in a QuizQuestion. Like add_question, this doesn't validate it """
+        self.store.add(category, question_text, answers)
+        self._word_counts = None
 
     def category_count(self):
         """ Count number of categories represented in the QuestionList """
-        categories = []
-        for q in self.question_list:
-            if q.category not in categories:
-                categories.append(q.category)
+        return len(self.store.categories)
 
-        return len(categories)
-    
     def category_names_size(self):
         """ 
         Returns the amount of bytes required to store all category names. Used for
         validation.
         """
-        categories = []
-        for q in self.question_list:
-            if q.category not in categories:
-                categories.append(q.category)
-
-        return sum(len(category)+1 for category in categories)
+        return sum(len(category) + 1 for category in self.store.categories)
 
-    def calculate_word_frequency(self):
-        """ Given a list of QuizQuestions, return an ordered frequency dict ({"word": <usage count>}) """
-        frequency_dict = {}
+    def encodable_strings(self):
+        """ Every string that dump encodes: each wrapped question, then its answers """
+        for category, question_text, answers in self.store.rows():
+            yield QuizQuestion.wrap_text(question_text).rstrip("?").rstrip()
+            yield from answers
 
-        for question in self.question_list:
-            question_str = question.question_text
-            frequency_dict = self.calculate_frequency_from_str(question_str, frequency_dict)
+    def count_words(self, workers=1):
+        """
+        Counter of every word in the questions' text and answers (see WordFrequency.iter_words). Counted once and kept
+        until another question is added. With enough questions, the counting is split into shards over 'workers'
+        processes and their counts merged.
+        """
+        if self._word_counts is None:
+            if workers > 1 and len(self.store) >= PARALLEL_MIN_QUESTIONS:
+                self._word_counts = count_words_parallel(self.store.strings(), workers)
+            else:
+                self._word_counts = count_words(self.store.strings())
+        return self._word_counts
 
-            for answer in question.answers:
-                frequency_dict = self.calculate_frequency_from_str(answer, frequency_dict)
+    @property
+    def word_counts(self):
+        return self.count_words()
 
-        return OrderedDict(sorted(frequency_dict.items(), reverse=True, key=
+    def calculate_word_frequency(self, workers=1):
+        """
+        Given a list of QuizQuestions, return an ordered frequency dict ({"word": <usage count>}), most frequent first.
+        This sorts the whole vocabulary; WordFrequency.ranked_words gets the most frequent words without doing so.
+        """
+        return OrderedDict(sorted(self.count_words(workers).items(), reverse=True, key=
         lambda kv: (kv[1], kv[0])))
 
     @staticmethod
     def calculate_frequency_from_str(s, frequency_dict):
         """ Split a string into words, then return a dict representing frequency of each str """
-        separators = r'[\s|"|!|#|$|%|&|\'|(|)|\+|,|-|\.|/|:|;|<|=|>|\?|{|}]+'
-        words = re.split(separators, s)
-        for word in words:
-            word = word.strip("{}")  # Remove stray braces which are used to indicate italics
-            # Only calculate frequency of words that contain some amount of alphanumeric and allowed special chars
-            # I'm not sure if other special chars would work, but these are the only ones in the original ROM's dictionary.
-            if not re.match(r'^[a-zA-Z\.\-\'\*]+$', word):
-                continue
-            if len(word) < 2:
-                continue
-            if word in frequency_dict:
-                frequency_dict[word] += 1
-            else:
-                frequency_dict[word] = 1
+        for word in iter_words(s):
+            frequency_dict[word] = frequency_dict.get(word, 0) + 1
         return frequency_dict
 
     def encode_str(self, s, proper_noun_dictionary, main_dictionary):
-        """ There's gotta be a better way to do this dear god """
-
+        """ Encode s, replacing dictionary words with their 1 byte (proper noun) or 2 byte (main dictionary) codes """
         s_bytes = s.encode("utf-8").replace(b'\n', b'\x01')
-        output = [{"type": "unencoded", "data": s_bytes}]
-
-        # First encode proper nouns
-        while True:
-            new_output = self.do_replacement(items=output, d=proper_noun_dictionary, proper=True, flip=False)
-            if new_output == output:
-                break
-            else:
-                output = new_output
-        # Now encode words from main_dictionary
-        while True:
-            new_output = self.do_replacement(items=output, d=main_dictionary, proper=False, flip=False)
-            if new_output == output:
-                break
-            else:
-                output = new_output
-        # Finally check if we can flip capitalization for any dictionary words
-        while True:
-            new_output = self.do_replacement(items=output, d=main_dictionary, proper=False, flip=True)
-            if new_output == output:
-                break
-            else:
-                output = new_output
         final_bytes = bytearray()
-        for item in output:
-            final_bytes.extend(item["data"])
+        for start, stop, code in self.tokenize(s_bytes, proper_noun_dictionary, main_dictionary):
+            final_bytes.extend(s_bytes[start:stop] if code is None else code)
 
         return final_bytes
 
-    def do_replacement(self, items, d, proper=False, flip=False):
+    def tokenize(self, s_bytes, proper_noun_dictionary, main_dictionary):
         """
-        When possible, replaces full words with 1-2 byte equivalents. Called until no additiona replacements can be
-        made.
-        items is a list of dictionaries in this format:
-        {"type": "unencoded", "data": b'\x41\x53\x53'}
-        If type is encoded, it should be skipped.
+        Split s_bytes into a list of (start, stop, code) tokens covering it, where code replaces s_bytes[start:stop].
+        code is None for text that is stored as is. Proper nouns are matched first, then main dictionary words in
+        whatever text is left over.
         """
-        new_items = []
-
-        replaced = False
-        for item in items:
-            if item["type"] == "encoded":
-                new_items.append(item)
-                continue
-            if replaced:
-                new_items.append(item)
+        if self.optimal:
+            return self.tokenize_optimal(s_bytes, proper_noun_dictionary, main_dictionary)
+
+        used = bytearray(len(s_bytes))
+        replacements = {}
+
+        for pos, length, d_index in proper_noun_dictionary.matcher().greedy_matches(s_bytes, used):
+            replacements[pos] = (length, self.proper_noun_byte(d_index))
+        for pos, length, d_index in main_dictionary.matcher().greedy_matches(s_bytes, used):
+            replacements[pos] = (length, self.encode_word(d_index))
+
+        tokens = []
+        pos = 0
+        for start in sorted(replacements):
+            length, replacement_bytes = replacements[start]
+            if start > pos:
+                tokens.append((pos, start, None))
+            tokens.append((start, start + length, replacement_bytes))
+            pos = start + length
+        if pos < len(s_bytes):
+            tokens.append((pos, len(s_bytes), None))
+
+        return tokens
+
+    def tokenize_optimal(self, s_bytes, proper_noun_dictionary, main_dictionary):
+        """
+        Minimum-byte tokenization of s_bytes. Dynamic programming over positions, weighing literal bytes (1 byte),
+        proper nouns (1 byte) and main dictionary words (2 bytes), which can also absorb a space either side of the
+        word and match with flipped capitalization.
+        """
+        n = len(s_bytes)
+        # options[i] is a list of (end position, encoded bytes) that can replace s_bytes[i:end]
+        options = [[] for _ in range(n)]
+
+        for pos, length, d_index in proper_noun_dictionary.matcher().matches(s_bytes):
+            options[pos].append((pos + length, self.proper_noun_byte(d_index)))
+
+        for flip in [False, True]:
+            for pos, length, d_index in main_dictionary.matcher(flipped=flip).matches(s_bytes):
+                end = pos + length
+                starts = [(pos, False)]
+                if pos > 0 and s_bytes[pos - 1] == 0x20:
+                    starts.append((pos - 1, True))
+                ends = [(end, False)]
+                if end < n and s_bytes[end] == 0x20:
+                    ends.append((end + 1, True))
+                for start, pre_space in starts:
+                    for stop, post_space in ends:
+                        options[start].append((stop, self.encode_word(d_index, pre_space, post_space, flip=flip)))
+
+        # cost[i] is the fewest bytes s_bytes[i:] can be encoded in, choice[i] is how to encode from i onwards
+        cost = [0] * (n + 1)
+        choice = [None] * n
+        for i in range(n - 1, -1, -1):
+            # Literals win ties so that nothing is encoded unless it saves space
+            best_cost = 1 + cost[i + 1]
+            best_choice = (i + 1, None)
+            for stop, code in options[i]:
+                if len(code) + cost[stop] < best_cost:
+                    best_cost = len(code) + cost[stop]
+                    best_choice = (stop, code)
+            cost[i] = best_cost
+            choice[i] = best_choice
+
+        tokens = []
+        i = 0
+        while i < n:
+            stop, code = choice[i]
+            tokens.append((i, stop, code))
+            i = stop
+
+        return tokens
+
+    def decode_str(self, data, proper_noun_dictionary, main_dictionary):
+        """ Opposite of encode_str """
+        return self.read_str(data, 0, None, proper_noun_dictionary, main_dictionary)[0]
+
+    def read_str(self, data, pos, terminator, proper_noun_dictionary, main_dictionary):
+        """
+        Decode data from pos up to a terminator byte (0x00 ends a question, 0x01 an answer) or the end of data.
+        Bytes are read one at a time the way the game does, since the second byte of a main dictionary lookup can be
+        anything. Returns (text, position after the terminator).
+        """
+        out = []
+        while pos < len(data):
+            b = data[pos]
+            if b > 0xbf:
+                # Main dictionary lookup. See encode_word for the flags in the first byte
+                word = main_dictionary.words[((b & 0x07) << 8) | data[pos + 1]]
+                if b & 0x08:
+                    word = flip_case(word)
+                if b & 0x20:
+                    out.append(" ")
+                out.append(word)
+                if b & 0x10:
+                    out.append(" ")
+                pos += 2
                 continue
-            for w in sorted(d.words, key=len, reverse=True):
-                word_encoded = w.encode("utf-8")
-                if word_encoded in item["data"]:
-                    d_index = d.words.index(w)
-                    word_index = item["data"].index(word_encoded)
-                    before = item["data"][0:word_index]
-                    after = item["data"][word_index + len(w):]
-                    if proper:
-                        replacement_bytes = self.byte_reference_table.index(d_index + 1).to_bytes(1, 'big')
+            pos += 1
+            if b == terminator:
+                break
+            if b == 0x01:
+                out.append("\n")
+            elif self.byte_reference_table[b] == 0:
+                out.append(chr(b))
+            else:
+                out.append(proper_noun_dictionary.words[self.byte_reference_table[b] - 1])
+        return "".join(out), pos
+
+    def decode_question(self, block, category, proper_noun_dictionary, main_dictionary):
+        """ Opposite of encode_question: a QuizQuestion from an encoded block (without its length byte) """
+        question_text, pos = self.read_str(block, 0, 0x00, proper_noun_dictionary, main_dictionary)
+        answers = []
+        while pos < len(block):
+            answer, pos = self.read_str(block, pos, 0x01, proper_noun_dictionary, main_dictionary)
+            answers.append(answer)
+        return QuizQuestion(category=category, question_text=question_text, answers=answers)
+
+    def decode(self, data, categories, proper_noun_dictionary, main_dictionary):
+        """
+        Stream QuizQuestions out of an encoded question list. categories is a list of (name, offset, count), with
+        offsets relative to the start of data like the metadata dump_bytes returns.
+        """
+        for name, offset, count in categories:
+            pos = offset
+            for _ in range(count):
+                # The length byte counts itself
+                block_length = data[pos]
+                yield self.decode_question(data[pos + 1:pos + block_length], name, proper_noun_dictionary,
+                                           main_dictionary)
+                pos += block_length
+
+    def encoding_stats(self, data, metadata, proper_noun_dictionary, main_dictionary):
+        """
+        How well the question list dump_bytes returned (data and metadata) is compressed. Each block is scanned the way
+        read_str decodes it, counting how many bytes it would take without the dictionaries. Returns
+        {"categories": {name: {"questions", "raw_bytes", "encoded_bytes", "ratio"}}, "dictionaries": {"proper" and
+        "main": {"words", "words_used", "hits", "bytes_covered", "bytes_saved", "coverage"}}}, where coverage is the
+        fraction of the raw text a dictionary's codes stand in for.
+        """
+        dictionaries = {"proper": {"words": len(proper_noun_dictionary.words), "hits": 0, "bytes_covered": 0,
+                                   "bytes_saved": 0},
+                        "main": {"words": len(main_dictionary.words), "hits": 0, "bytes_covered": 0,
+                                 "bytes_saved": 0}}
+        used = {"proper": set(), "main": set()}
+        categories = {}
+        total_raw = 0
+        for name, info in metadata["categories"].items():
+            raw = 0
+            encoded = 0
+            pos = info["offset"]
+            for _ in range(info["count"]):
+                block_length = data[pos]
+                end = pos + block_length
+                encoded += block_length - 1
+                pos += 1
+                while pos < end:
+                    b = data[pos]
+                    if b > 0xbf:
+                        d_index = ((b & 0x07) << 8) | data[pos + 1]
+                        length = len(main_dictionary.words[d_index]) + bool(b & 0x20) + bool(b & 0x10)
+                        stats, key, code_size = dictionaries["main"], "main", 2
+                        pos += 2
+                    elif b > 0x01 and self.byte_reference_table[b] != 0:
+                        d_index = self.byte_reference_table[b] - 1
+                        length = len(proper_noun_dictionary.words[d_index])
+                        stats, key, code_size = dictionaries["proper"], "proper", 1
+                        pos += 1
                     else:
-                        pre_space = (word_index != 0) and item["data"][word_index - 1] == " "
-                        post_space = (word_index != (len(item["data"]) - 1)) and item["data"][word_index - 1] == " "
-                        replacement_bytes = self.encode_word(d_index, pre_space, post_space, flip=flip)
-                    if len(before) != 0:
-                        new_items.append({"type": "unencoded", "data": before})
-                    new_items.append({"type": "encoded", "data": replacement_bytes})
-                    if len(after) != 0:
-                        new_items.append({"type": "unencoded", "data": after})
-                    replaced = True
-                    break
-            if not replaced:
-                new_items.append(item)
-
-        return new_items
+                        # Literals and terminators take the same space either way
+                        raw += 1
+                        pos += 1
+                        continue
+                    raw += length
+                    stats["hits"] += 1
+                    stats["bytes_covered"] += length
+                    stats["bytes_saved"] += length - code_size
+                    used[key].add(d_index)
+            categories[name] = {"questions": info["count"], "raw_bytes": raw, "encoded_bytes": encoded,
+                                "ratio": round(encoded / raw, 4) if raw else 1.0}
+            total_raw += raw
+        for key, stats in dictionaries.items():
+            stats["words_used"] = len(used[key])
+            stats["coverage"] = round(stats["bytes_covered"] / total_raw, 4) if total_raw else 0.0
+        return {"categories": categories, "dictionaries": dictionaries}
+
+    def proper_noun_byte(self, d_index):
+        """ The byte that the byte reference table maps to proper noun dictionary entry d_index """
+        if d_index + 1 not in self.proper_noun_bytes:
+            raise ValueError(f"Proper noun {d_index} is not in the byte reference table")
+        return self.proper_noun_bytes[d_index + 1]
 
     @staticmethod
     def encode_word(d_index, pre_space=False, post_space=False, flip=False):
@@ -241,15 +534,96 @@ class QuestionList:
         return b''.join([byte1, byte2])
 
     def dump(self, filename, proper_noun_dictionary, main_dictionary):
-        """ Write questions until we are at max length or out of questions"""
-        questions_sorted = sorted(self.question_list, key=lambda q: q.category)
+        """ Write the encoded question list to filename. Returns the same metadata as dump_bytes """
+        data, metadata = self.dump_bytes(proper_noun_dictionary, main_dictionary)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return metadata
+
+    def encode_question(self, question, proper_noun_dictionary, main_dictionary):
+        """ Encoded block for a question: the question null-terminated, then each answer terminated by 0x01 """
+        question_bin = bytearray()
+        question_wrapped = question.wrap().rstrip("?").rstrip()
+        question_bin.extend(
+            self.encode_str(question_wrapped, proper_noun_dictionary, main_dictionary))
+        question_bin += b'\x00'
+        for answer in question.answers:
+            question_bin.extend(self.encode_str(answer, proper_noun_dictionary, main_dictionary))
+            question_bin += b'\x01'
+        return question_bin
+
+    def encode_questions(self, questions, proper_noun_dictionary, main_dictionary, cache=None, workers=1):
+        """
+        Encoded blocks for a list of QuizQuestions, in the same order. Blocks in the EncodeCache (if given) are reused.
+        The rest are encoded in a pool of 'workers' processes when there are enough of them to be worth it.
+        """
+        blocks = [None] * len(questions)
+        keys = [None] * len(questions)
+        if cache:
+            fingerprint = cache.fingerprint(self, proper_noun_dictionary, main_dictionary)
+            for i, question in enumerate(questions):
+                keys[i] = cache.key(fingerprint, question)
+                blocks[i] = cache.get(keys[i])
+        missing = [i for i, block in enumerate(blocks) if block is None]
+
+        if workers > 1 and len(missing) >= PARALLEL_MIN_QUESTIONS:
+            self.logger.info(f"Encoding {len(missing)} questions in {workers} processes")
+            chunk_size = max(1, len(missing) // (workers * 8))
+            chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+            # Each worker compiles the dictionaries once, then encodes chunks of questions
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_encode_worker,
+                                     initargs=(bytes(self.byte_reference_table), self.optimal,
+                                               list(proper_noun_dictionary.words),
+                                               list(main_dictionary.words))) as executor:
+                results = executor.map(encode_chunk, [[(questions[i].category, questions[i].question_text,
+                                                        questions[i].answers) for i in chunk] for chunk in chunks])
+                for chunk, chunk_blocks in zip(chunks, results):
+                    for i, block in zip(chunk, chunk_blocks):
+                        blocks[i] = block
+        else:
+            for i in missing:
+                self.logger.debug(f"Encoding question {questions[i].question_text}")
+                blocks[i] = self.encode_question(questions[i], proper_noun_dictionary, main_dictionary)
+
+        if cache:
+            for i in missing:
+                cache.put(keys[i], blocks[i])
+        return blocks
+
+    def dump_bytes(self, proper_noun_dictionary, main_dictionary, cache=None, workers=1, planner=None):
+        """
+        Encode questions until we are at max length or out of questions. Returns (bytes, metadata). If an EncodeCache
+        is passed, blocks encoded by an earlier build with the same dictionaries are reused. Encoding can be spread over
+        'workers' processes, while laying the blocks out stays sequential. With a Packing.PackingPlanner, the planner
+        chooses which questions to write instead, and its report is kept in metadata["packing"].
+        """
+        questions_sorted = self.sorted_questions()
+        blocks = self.encode_questions(questions_sorted, proper_noun_dictionary, main_dictionary, cache=cache,
+                                       workers=workers)
+        for question, block in zip(questions_sorted, blocks):
+            self.store.encoded_lengths[question.index] = len(block)
+        return self.layout(questions_sorted, blocks, planner=planner)
+
+    def sorted_questions(self):
+        """ QuestionViews of every question, in the order dump_bytes writes them """
+        return [self.store[index] for index in self.store.indices_by_category()]
+
+    def layout(self, questions_sorted, blocks, planner=None):
+        """
+        The question list region for already encoded blocks of questions_sorted (see sorted_questions). Returns
+        (bytes, metadata) like dump_bytes.
+        """
+        metadata = {"question_count": 0, "categories": {}}
+        if planner:
+            indices, metadata["packing"] = planner.plan(questions_sorted, blocks)
+        else:
+            indices = range(len(questions_sorted))
+
         current_category = None
         current_category_index = -1
-        metadata = {"question_count": 0, "categories": {}}
-        f = open(filename, "wb")
-        for question in questions_sorted:
-            self.logger.info(f"Encoding question {question.question_text}")
-            question_bin = bytearray()
+        f = io.BytesIO()
+        for i in indices:
+            question, question_bin = questions_sorted[i], blocks[i]
             category = question.category
             if category != current_category:
                 if current_category:
@@ -257,26 +631,46 @@ class QuestionList:
                 current_category = category
                 current_category_index += 1
                 metadata["categories"][category] = {"name": category, "offset": f.tell(), "count": 0,
-                                                    "index": current_category_index}
-            question_wrapped = question.wrap().rstrip("?").rstrip()
-            question_bin.extend(
-                self.encode_str(question_wrapped, proper_noun_dictionary, main_dictionary))
-            question_bin += b'\x00'
-            for answer in question.answers:
-                question_bin.extend(self.encode_str(answer, proper_noun_dictionary, main_dictionary))
-                question_bin += b'\x01'
+                                                    "index": current_category_index, "questions": []}
             block_length = len(question_bin)
             if (block_length + 1 + f.tell()) > MAX_QUESTION_LIST_SIZE:
                 f.write(bytearray(MAX_QUESTION_LIST_SIZE - f.tell()))
                 self.logger.warning("Exiting early because we are at max length. ")
-                f.close()
-                return metadata
+                return f.getvalue(), metadata
 
             f.write((block_length + 1).to_bytes(1, 'big'))
             f.write(question_bin)
             metadata["categories"][category]["count"] += 1
+            metadata["categories"][category]["questions"].append(question)
             metadata["question_count"] += 1
 
         f.write(bytearray(MAX_QUESTION_LIST_SIZE - f.tell()))
-        f.close()
-        return metadata
+        return f.getvalue(), metadata
+
+
+# Per-process state for encode workers, set up once by init_encode_worker
+worker_state = {}
+
+
+def init_encode_worker(byte_reference_table, optimal, proper_noun_words, main_words):
+    """ ProcessPoolExecutor initializer: build a QuestionList and compile both dictionaries once per worker """
+    proper_noun_dict = WordDictionary(None, {}, 0, proper=True)
+    proper_noun_dict.words = proper_noun_words
+    main_dict = WordDictionary(None, {}, 0)
+    main_dict.words = main_words
+    proper_noun_dict.matcher()
+    main_dict.matcher()
+    if optimal:
+        main_dict.matcher(flipped=True)
+    worker_state["questions"] = QuestionList(byte_reference_table, optimal=optimal)
+    worker_state["dictionaries"] = (proper_noun_dict, main_dict)
+
+
+def encode_chunk(chunk):
+    """ Encode a list of (category, question text, answers) in a worker. Returns their blocks """
+    questions = worker_state["questions"]
+    proper_noun_dict, main_dict = worker_state["dictionaries"]
+    store = QuestionStore()
+    for category, question_text, answers in chunk:
+        store.add(category, question_text, answers)
+    return [questions.encode_question(question, proper_noun_dict, main_dict) for question in store]
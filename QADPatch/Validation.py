@@ -0,0 +1,95 @@
+import re
+
+from QADPatch.QuizQuestions import QuizQuestion, QuestionTooLongError, MAX_ANSWER_LENGTH
+
+# Characters the byte reference table allows, but which display as something else
+MISLEADING_CHARS = {
+    ">": "> char decodes to ★ which is probably unintended",
+    "<": "< char decodes to ♥ which is probably unintended",
+}
+
+
+class Validator:
+    """
+    Question validation compiled from the byte reference table. A byte the table maps to 0 is printed as itself, so
+    those are the allowed characters. They're compiled into a 256 entry lookup, and from that into a regex character
+    class, so checking a string is a single regex search rather than a membership test per character.
+
+    Errors are returned as records rather than logged: dicts with the question's "index" (in validate_batch), the
+    "field" ("question" or "answer N"), its "text", the "kind" of error ("character" or "length"), a "message", and for
+    character errors the offending "character" and its "position".
+    """
+
+    def __init__(self, byte_reference_table):
+        self.allowed = bytearray(256)
+        for i, value in enumerate(byte_reference_table[:256]):
+            if value == 0:
+                self.allowed[i] = 1
+        # Anything not allowed, plus the allowed characters that are probably mistakes
+        accepted = "".join(chr(i) for i in range(256) if self.allowed[i] and chr(i) not in MISLEADING_CHARS)
+        self.bad_char = re.compile(f"[^{re.escape(accepted)}]" if accepted else "(?s:.)")
+
+    def check_chars(self, s):
+        """ None if every character of s can be encoded, otherwise (position, character, message) for the first bad one """
+        match = self.bad_char.search(s)
+        if match is None:
+            return None
+        char = match.group()
+        if ord(char) < 256 and self.allowed[ord(char)]:
+            return match.start(), char, MISLEADING_CHARS[char]
+        return match.start(), char, "Disallowed character"
+
+    def validate(self, question_text, answers):
+        """ Every error in one question, as a list of error records (see Validator). Empty if the question is valid """
+        errors = []
+        bad = self.check_chars(question_text)
+        if bad:
+            errors.append(char_error("question", question_text, bad))
+        else:
+            try:
+                QuizQuestion.wrap_text(question_text)
+            except QuestionTooLongError:
+                errors.append({"field": "question", "text": question_text, "kind": "length",
+                               "message": "Question too long", "character": None, "position": None})
+        for n, answer in enumerate(answers):
+            field = f"answer {n + 1}"
+            bad = self.check_chars(answer)
+            if bad:
+                errors.append(char_error(field, answer, bad))
+            elif len(answer) > MAX_ANSWER_LENGTH:
+                errors.append({"field": field, "text": answer, "kind": "length",
+                               "message": f"Answer longer than {MAX_ANSWER_LENGTH} characters", "character": None,
+                               "position": None})
+        return errors
+
+    def validate_batch(self, questions):
+        """
+        Validate (question text, answers) pairs in one pass. Returns (valid, errors): a list of booleans, one per
+        question, and every error record with the "index" of the question it belongs to.
+        """
+        valid = []
+        errors = []
+        for index, (question_text, answers) in enumerate(questions):
+            question_errors = self.validate(question_text, answers)
+            for error in question_errors:
+                error["index"] = index
+            errors.extend(question_errors)
+            valid.append(not question_errors)
+        return valid, errors
+
+
+def char_error(field, text, bad):
+    position, char, message = bad
+    return {"field": field, "text": text, "kind": "character", "message": message, "character": char,
+            "position": position}
+
+
+def format_error(error):
+    """ One line description of an error record, worded like QuizQuestion.validate's warnings """
+    if error["kind"] == "character":
+        return f"Text error in {error['field']} {error['text']}: {error['message']}. {hex(ord(error['character']))}"
+    if error["kind"] != "length":
+        return error["message"]
+    if error["field"] == "question":
+        return f"Question {error['text']} too long"
+    return f"Answer too long: {error['text']}"
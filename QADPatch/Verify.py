@@ -0,0 +1,85 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from QADPatch.QuizQuestions import QuestionList
+from QADPatch.WordDictionary import WordDictionary
+
+
+def diff_position(expected, decoded):
+    """ Index of the first character that differs between two strings """
+    for i, (a, b) in enumerate(zip(expected, decoded)):
+        if a != b:
+            return i
+    return min(len(expected), len(decoded))
+
+
+def verify_category(byte_reference_table, proper_noun_words, main_words, category, data, offset, expected):
+    """
+    Decode one category's blocks from data, starting at offset, and compare them with the expected
+    [(question text, answers)]. Runs in a worker process, so it takes plain data rather than the build's objects.
+    Returns a list of mismatches (see verify).
+    """
+    questions = QuestionList(byte_reference_table)
+    proper_noun_dict = WordDictionary(None, {}, 0, proper=True)
+    proper_noun_dict.words = proper_noun_words
+    main_dict = WordDictionary(None, {}, 0)
+    main_dict.words = main_words
+
+    mismatches = []
+    pos = offset
+    for i, (question_text, answers) in enumerate(expected):
+        block_length = data[pos]
+        block = data[pos + 1:pos + block_length]
+        mismatch = {"category": category, "index": i, "offset": pos, "bytes": bytes(data[pos:pos + block_length])}
+        try:
+            decoded = questions.decode_question(block, category, proper_noun_dict, main_dict)
+        except (IndexError, UnicodeDecodeError) as e:
+            mismatches.append(dict(mismatch, field="block", expected=question_text, decoded=None, position=0,
+                                   error=f"Block doesn't decode: {e!r}"))
+            pos += block_length
+            continue
+
+        fields = [("question", question_text, decoded.question_text)]
+        if len(decoded.answers) != len(answers):
+            fields.append(("answers", repr(answers), repr(decoded.answers)))
+        else:
+            fields.extend((f"answer {n + 1}", a, b) for n, (a, b) in enumerate(zip(answers, decoded.answers)))
+        for field, want, got in fields:
+            if want != got:
+                mismatches.append(dict(mismatch, field=field, expected=want, decoded=got,
+                                       position=diff_position(want, got), error=None))
+        pos += block_length
+    return mismatches
+
+
+def verify(question_list, data, metadata, proper_noun_dictionary, main_dictionary, workers=1):
+    """
+    Decode every question block dump_bytes emitted and compare it with the questions it wrote, one category per worker
+    process when 'workers' is more than 1, otherwise in this process. Returns a list of mismatches, each a dict with
+    the category, the question's index in it, the block's offset in data and its bytes, the field that differs, the
+    expected and decoded text and where they first differ.
+    """
+    data = bytes(data)
+    table = bytes(question_list.byte_reference_table)
+    tasks = [(table, list(proper_noun_dictionary.words), list(main_dictionary.words), name, data, info["offset"],
+              [(q.wrap().rstrip("?").rstrip(), list(q.answers)) for q in info["questions"]])
+             for name, info in metadata["categories"].items()]
+    mismatches = []
+    if workers <= 1:
+        for task in tasks:
+            mismatches.extend(verify_category(*task))
+        return mismatches
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(verify_category, *task) for task in tasks]:
+            mismatches.extend(future.result())
+    return mismatches
+
+
+def format_mismatch(mismatch, base_address=0):
+    """ One line report of a mismatch. base_address is added to offsets, e.g. to show ROM addresses """
+    where = (f"{mismatch['category']} question {mismatch['index']} at {hex(base_address + mismatch['offset'])} "
+             f"({mismatch['field']})")
+    block = mismatch["bytes"].hex(" ")
+    if mismatch["error"]:
+        return f"{where}: {mismatch['error']}. Bytes: {block}"
+    return (f"{where}: expected {mismatch['expected']!r}, decoded {mismatch['decoded']!r}, differing from character "
+            f"{mismatch['position']}. Bytes: {block}")
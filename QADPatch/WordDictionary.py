@@ -1,3 +1,74 @@
+import hashlib
+import heapq
+
+from QADPatch.WordFrequency import ranked_words
+
+TRIE_END = -1  # Key of a trie node that holds the index of the word ending there
+
+
+def flip_case(word):
+    """ Flip capitalization of the first character. To -> to, the -> The, etc """
+    if word[0].isupper():
+        return word[0].lower() + word[1:]
+    return word[0].upper() + word[1:]
+
+
+class DictionaryMatcher:
+    """
+    Byte trie over a dictionary's words with a precomputed word -> index map. Compiled once per WordDictionary and
+    reused for every string that gets encoded. If flipped is set the trie matches each word with the capitalization of
+    its first character flipped, which the main dictionary can encode with its flip flag.
+    """
+
+    def __init__(self, words, flipped=False):
+        self.words = tuple(words)
+        self.flipped = flipped
+        self.word_index = {}
+        self.trie = {}
+        for i, word in enumerate(self.words):
+            if flipped:
+                word = flip_case(word)
+            # Duplicate words always resolve to the first index, same as list.index()
+            if word in self.word_index:
+                continue
+            self.word_index[word] = i
+            node = self.trie
+            for b in word.encode("utf-8"):
+                node = node.setdefault(b, {})
+            node[TRIE_END] = i
+
+    def matches(self, data):
+        """ Every occurrence of a dictionary word in data, as a list of (position, length, index) """
+        found = []
+        trie = self.trie
+        data_length = len(data)
+        for pos in range(data_length):
+            node = trie.get(data[pos])
+            i = pos + 1
+            while node is not None:
+                if TRIE_END in node:
+                    found.append((pos, i - pos, node[TRIE_END]))
+                if i == data_length:
+                    break
+                node = node.get(data[i])
+                i += 1
+        return found
+
+    def greedy_matches(self, data, used):
+        """
+        Pick words the way the encoder always has: the longest word (ties go to the earlier dictionary entry) at its
+        first occurrence, then the same again on the text either side of it. Matches overlapping bytes already set in
+        'used' are skipped, and 'used' is updated with the chosen matches. Returns a list of (position, length, index).
+        """
+        chosen = []
+        for pos, length, index in sorted(self.matches(data), key=lambda m: (-m[1], m[2], m[0])):
+            if any(used[pos:pos + length]):
+                continue
+            used[pos:pos + length] = b'\x01' * length
+            chosen.append((pos, length, index))
+        return chosen
+
+
 class WordDictionary:
     """
     Word dictionary used for compressing question text. QAD uses two dictionaries: one for capitalized proper nouns,
@@ -15,6 +86,21 @@ class WordDictionary:
         # self.words except each word's first character's capitalization is flipped. To -> to, the -> The, etc
         self.words_flipped = []
         self.exclusions = exclusions
+        self._matchers = {}
+
+    def matcher(self, flipped=False):
+        """ DictionaryMatcher for the current words (or their flipped forms). Only recompiled when the words change """
+        matcher = self._matchers.get(flipped)
+        if matcher is None or matcher.words != tuple(self.words):
+            matcher = DictionaryMatcher(self.words, flipped=flipped)
+            self._matchers[flipped] = matcher
+        return matcher
+
+    def fingerprint(self):
+        """ Hash of the dictionary contents. Changes whenever the words do """
+        h = hashlib.sha256(b'proper' if self.proper else b'main')
+        h.update(self.serialize())
+        return h.hexdigest()
 
     def serialize(self):
         """ Generate a bytearray object in the format that the word dictionary will take in the final ROM"""
@@ -26,23 +112,39 @@ class WordDictionary:
 
     def from_file(self, filename):
         with open(filename, "rb") as f:
-            data = f.read()
-            i = 0
-            while i < len(data):
-                word_length = data[i]
-                word = data[i + 1:i + word_length + 1].decode("utf-8")
-                self.words.append(word)
-                i += word_length + 1
-        for word in self.words:
-            if word[0].isupper():
-                flipped = word[0].lower() + word[1:]
-            else:
-                flipped = word[0].upper() + word[1:]
-            self.words_flipped.append(flipped)
+            self.parse(f.read())
+
+    @classmethod
+    def from_bytes(cls, data, proper=False, word_count=None):
+        """ Dictionary read back from the format it takes in the ROM (see parse) """
+        d = cls(None, {}, max_size=len(data), max_word_count=word_count or 0, proper=proper)
+        d.parse(data, word_count)
+        return d
+
+    def parse(self, data, word_count=None):
+        """ Append words from serialized dictionary data. Stops after word_count words, a 0 length or the end of data """
+        i = 0
+        while i < len(data) and (word_count is None or len(self.words) < word_count):
+            word_length = data[i]
+            if word_length == 0:
+                break
+            word = bytes(data[i + 1:i + word_length + 1]).decode("utf-8")
+            self.words.append(word)
+            self.words_flipped.append(flip_case(word))
+            i += word_length + 1
+
+    def fits(self, size, word):
+        """
+        Whether word's entry fits after 'size' bytes of entries. Padding entries take at least 2 bytes, so a word that
+        would leave exactly 1 byte free doesn't fit either (see serialize_padded)
+        """
+        remaining = self.max_size - size - len(word) - 1
+        return remaining >= 0 and remaining != 1
 
     def build(self):
-        # Words sorted highest frequency first, removing words which only appear once.
-        word_list = [k for k, v in self.word_frequency.items() if v > 1]
+        # Words highest frequency first, removing words which only appear once. They're ranked lazily, since only the
+        # first few thousand are usually looked at
+        word_list = (word for word, count in ranked_words(self.word_frequency, min_count=2))
         # If the word is too big we skip and try a few more times in case we have one small enough to fit.
         attempts = 10
         for word in word_list:
@@ -58,31 +160,143 @@ class WordDictionary:
             if len(self.words) == self.max_word_count:
                 break
 
-            if len(self.serialize()) + len(word) + 1 > self.max_size:
+            if not self.fits(len(self.serialize()), word):
                 attempts -= 1
                 continue
             elif word in self.words or word in self.words_flipped:
                 continue
 
             self.words.append(word)
-            if word[0].isupper():
-                flipped = word[0].lower() + word[1:]
-            else:
-                flipped = word[0].upper() + word[1:]
-            self.words_flipped.append(flipped)
+            self.words_flipped.append(flip_case(word))
 
-    def dump(self, filename):
-        """ Dump out of self.serialize to specified filename """
-        with open(filename, "wb") as f:
-            f.write(self.serialize())
+    def serialize_padded(self, max_entries=None):
+        """
+        self.serialize padded with dummy words to exactly max_size. Updates self.dummy_words. The dummy words are 1 or 2
+        letters, unless that would make more than max_entries words and dummy words in all, in which case fewer, longer
+        ones are used. Raises ValueError if the words leave exactly 1 byte, since the smallest dummy word takes 2, or if
+        the padding can't fit in max_entries
+        """
+        out = self.serialize()
+        self.dummy_words = 0
+        name = 'Proper noun' if self.proper else 'Main'
+        remaining = self.max_size - len(out)
+        if remaining < 0 or remaining == 1:
+            raise ValueError(f"{name} dictionary takes {len(out)} bytes, which can't be padded to {self.max_size}.")
+        if max_entries is None or len(self.words) + remaining // 2 <= max_entries:
             # pad if size isn't exactly right.
-            pos = f.tell()
-            while pos < self.max_size:
-                if self.max_size - pos == 3:
-                    f.write(b'\x02\x61\x62')
-                    pos += 3
+            while len(out) < self.max_size:
+                if self.max_size - len(out) == 3:
+                    out += b'\x02\x61\x62'
                 else:
-                    f.write(b'\x01\x61')
-                    pos += 2
+                    out += b'\x01\x61'
                 self.dummy_words += 1
-            f.close()
+        elif remaining:
+            # Dummy words of up to 255 letters, sharing the space as evenly as possible
+            dummy_words = -(-remaining // 256)
+            if len(self.words) + dummy_words > max_entries:
+                raise ValueError(f"{name} dictionary has {len(self.words)} words, which leaves {remaining} bytes to "
+                                 f"pad in at most {max_entries - len(self.words)} dummy words.")
+            for i in range(dummy_words):
+                length = remaining // dummy_words + (i < remaining % dummy_words) - 1
+                out += length.to_bytes(1, 'big') + b'\x61' * length
+            self.dummy_words = dummy_words
+        assert len(out) == self.max_size
+        return out
+
+    def code_size(self):
+        """ Bytes taken by one lookup from this dictionary """
+        return 1 if self.proper else 2
+
+    def word_savings(self, word, count):
+        """
+        Question bytes saved by adding word: each use shrinks to a code. The entry's own len(word) + 1 bytes come out of
+        the dictionary's fixed size region rather than the question list, so they're the knapsack weight, not a cost.
+        """
+        return count * (len(word) - self.code_size())
+
+    def build_by_savings(self, savings=None):
+        """
+        Choose words by byte savings instead of raw frequency. This is a 0/1 knapsack over the max_size byte budget
+        and the max_word_count slots. Words are taken greedily by savings per dictionary byte, skipping any that would
+        leave a gap too small to pad (see fits). If the slots run out before the bytes, the lowest-saving words are then
+        swapped for bigger savers that still fit. 'savings' can map words to custom values, otherwise word_savings is
+        used.
+        """
+        if savings is None:
+            savings = {word: self.word_savings(word, count) for word, count in self.word_frequency.items()}
+
+        candidates = {}
+        for word, value in savings.items():
+            if value <= 0 or word in self.exclusions:
+                continue
+            # Proper noun dict should only have capitalized words
+            if self.proper and (not word[0].isupper() or len(word) < 3):
+                continue
+            # Only one of a word and its flipped form is needed, so keep whichever saves more
+            flipped = flip_case(word)
+            if flipped in candidates:
+                if candidates[flipped] >= value:
+                    continue
+                del candidates[flipped]
+            candidates[word] = value
+
+        ranked = sorted(candidates, key=lambda w: (-candidates[w] / (len(w) + 1), w))
+        chosen = []
+        size = 0
+        for word in ranked:
+            if len(chosen) == self.max_word_count:
+                break
+            if self.fits(size, word):
+                chosen.append(word)
+                size += len(word) + 1
+
+        if len(chosen) == self.max_word_count:
+            # Out of slots, so a bigger saver is worth swapping in for the smallest one if its bytes still fit
+            chosen_set = set(chosen)
+            smallest = [(candidates[w], w) for w in chosen]
+            heapq.heapify(smallest)
+            for word in sorted(candidates, key=lambda w: (-candidates[w], w)):
+                if not smallest or candidates[word] <= smallest[0][0]:
+                    break
+                if word in chosen_set:
+                    continue
+                removed = smallest[0][1]
+                if self.fits(size - len(removed) - 1, word):
+                    heapq.heapreplace(smallest, (candidates[word], word))
+                    chosen_set.remove(removed)
+                    chosen_set.add(word)
+                    size += len(word) - len(removed)
+            chosen = chosen_set
+
+        self.words = sorted(chosen, key=lambda w: (-candidates[w], w))
+        self.words_flipped = [flip_case(word) for word in self.words]
+
+    def dump(self, filename):
+        """ Dump out of self.serialize_padded to specified filename """
+        with open(filename, "wb") as f:
+            f.write(self.serialize_padded())
+
+
+def build_dictionaries(question_list, word_frequency, main_max_size, main_max_word_count, proper_max_size,
+                       proper_max_word_count, phrase_savings=None):
+    """
+    Allocate words to the proper noun and main dictionaries together, by byte savings. The proper noun dictionary (1
+    byte codes) is filled first, ranking capitalized words by the bytes each would save there, count * (len - 1), per
+    byte of its entry. Then the main dictionary (2 byte codes) is filled from everything else. phrase_savings
+    ({phrase: bytes saved}, see PhraseMiner.mine_phrases) adds phrase candidates to the main dictionary. Returns
+    (main_dict, proper_noun_dict).
+    """
+    main_dict = WordDictionary(question_list, word_frequency, max_size=main_max_size,
+                               max_word_count=main_max_word_count, proper=False)
+    proper_noun_dict = WordDictionary(question_list, word_frequency, max_size=proper_max_size,
+                                      max_word_count=proper_max_word_count, proper=True)
+
+    proper_noun_dict.build_by_savings()
+
+    main_dict.exclusions = set(proper_noun_dict.words)
+    main_savings = {word: main_dict.word_savings(word, count) for word, count in word_frequency.items()}
+    if phrase_savings:
+        for phrase, value in phrase_savings.items():
+            main_savings[phrase] = max(value, main_savings.get(phrase, 0))
+    main_dict.build_by_savings(main_savings)
+    return main_dict, proper_noun_dict
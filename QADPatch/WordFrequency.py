@@ -0,0 +1,88 @@
+import heapq
+import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# What words are split on. The "|"s are separators too, and "-" isn't: it only appears in the range "|-|"
+SEPARATORS = re.compile(r'[\s|"|!|#|$|%|&|\'|(|)|\+|,|-|\.|/|:|;|<|=|>|\?|{|}]+')
+# Only words made of letters and the special characters in the original ROM's dictionary are counted
+WORD = re.compile(r"[a-zA-Z.\-'*]+")
+MIN_WORD_LENGTH = 2
+# Strings counted per worker task
+SHARD_SIZE = 4096
+# Shards each worker has queued, so workers stay busy without the whole corpus being read ahead
+SHARDS_IN_FLIGHT = 2
+# How many of the most frequent words ranked_words finds with a heap before falling back to a full sort
+TOP_K = 4096
+
+
+def iter_words(s):
+    """ The countable words of a string """
+    for word in SEPARATORS.split(s):
+        word = word.strip("{}")  # Remove stray braces which are used to indicate italics
+        if len(word) >= MIN_WORD_LENGTH and WORD.fullmatch(word):
+            yield word
+
+
+def count_words(strings):
+    """ Counter of the words in every string """
+    counts = Counter()
+    for s in strings:
+        counts.update(iter_words(s))
+    return counts
+
+
+def count_shard(strings):
+    """ Count one shard of strings in a worker """
+    return count_words(strings)
+
+
+def count_words_parallel(strings, workers, shard_size=SHARD_SIZE):
+    """
+    count_words split into shards of shard_size strings, each counted in one of 'workers' processes, with the shards'
+    Counters merged as they come back. strings can be any iterable, e.g. a generator over a file far larger than memory.
+    """
+    strings = iter(strings)
+    total = Counter()
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            shard = list(islice(strings, shard_size))
+            if shard:
+                pending.append(executor.submit(count_shard, shard))
+            if pending and (len(pending) >= SHARDS_IN_FLIGHT * workers or not shard):
+                total.update(pending.popleft().result())
+            elif not shard:
+                return total
+
+
+def record_strings(records):
+    """ The question text and answers of each question record, for counting """
+    for record in records:
+        yield record["question"]
+        yield from record["answers"]
+
+
+def rank_key(item):
+    """ Most frequent first, ties broken by the word, the same order sorting (word, count) by (count, word) gives """
+    word, count = item
+    return count, word
+
+
+def top_words(counts, k, min_count=1):
+    """ The k most frequent (word, count) pairs with at least min_count uses, found with a heap instead of a sort """
+    return heapq.nlargest(k, ((word, count) for word, count in counts.items() if count >= min_count), key=rank_key)
+
+
+def ranked_words(counts, min_count=1, first=TOP_K):
+    """
+    Every (word, count) with at least min_count uses, most frequent first. Dictionaries rarely need more than the
+    first few thousand, so those come from top_words, and the rest of the vocabulary is only sorted if the caller
+    reads that far.
+    """
+    items = [(word, count) for word, count in counts.items() if count >= min_count]
+    top = heapq.nlargest(first, items, key=rank_key)
+    yield from top
+    if len(top) < len(items):
+        yield from sorted(items, key=rank_key, reverse=True)[len(top):]
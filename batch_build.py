@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+""" Build several ROM variants from one manifest, sharing the clean ROM, questions and dictionaries between them """
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join
+
+import build
+from QADPatch.Packing import PackingPlanner, PackingError, format_report
+from QADPatch.WordDictionary import WordDictionary
+from util import RomImage
+
+VARIANT_OPTIONS = {"name", "categories", "seed", "optimal", "dictionaries", "phrases", "pack", "balance",
+                   "min_questions", "category_weights"}
+
+# Per-process state for batch workers, set up once by init_batch_worker
+worker_state = {}
+
+
+def load_manifest(fn):
+    """
+    Read a batch manifest: a JSON object with the "questions" file every variant draws from (default questions.json),
+    an "output_dir" (default patched/batch), optional "defaults" applied to every variant, and a list of "variants".
+    Each variant has a unique "name" (its output directory) and any of:
+        categories: categories to include (default: all of them)
+        seed: seed for the category shuffle at 0x25368 (default: random)
+        optimal, dictionaries, phrases: as build.py's --optimal, --dictionaries and --phrases
+        pack, balance: as build.py's --pack and --balance
+        min_questions: minimum questions per category, either one number or {"category": number}
+        category_weights: {"category": weight}, as build.py's --category-weight
+    Raises ValueError if the manifest doesn't make sense.
+    """
+    with open(fn, "r") as f:
+        manifest = json.load(f)
+    defaults = manifest.get("defaults", {})
+    variants = []
+    names = set()
+    for variant in manifest.get("variants", []):
+        variant = dict(defaults, **variant)
+        unknown = set(variant) - VARIANT_OPTIONS
+        if unknown:
+            raise ValueError(f"Unknown variant options: {', '.join(sorted(unknown))}")
+        name = variant.get("name")
+        if not name or name in names or os.path.basename(name) != name:
+            raise ValueError(f"Every variant needs a unique name that's usable as a directory name, not {name!r}")
+        names.add(name)
+        if variant.get("dictionaries", "frequency") not in ["frequency", "savings"]:
+            raise ValueError(f"Variant {name}: dictionaries must be frequency or savings")
+        if variant.get("phrases") and variant.get("dictionaries") != "savings":
+            raise ValueError(f"Variant {name}: phrases requires dictionaries savings")
+        if not variant.get("pack") and any(variant.get(option) for option in
+                                           ["balance", "min_questions", "category_weights"]):
+            raise ValueError(f"Variant {name}: balance, min_questions and category_weights require pack")
+        variants.append(variant)
+    if not variants:
+        raise ValueError("The manifest has no variants")
+    return {"questions": manifest.get("questions", "questions.json"),
+            "output_dir": manifest.get("output_dir", join(build.OUTPUT_DIR, "batch")),
+            "variants": variants}
+
+
+def dictionary_key(variant):
+    """ Variants with the same key share dictionaries and encoded questions """
+    categories = variant.get("categories")
+    return (tuple(sorted(categories)) if categories else None, bool(variant.get("optimal")),
+            variant.get("dictionaries", "frequency"), bool(variant.get("phrases")))
+
+
+def variant_questions(key):
+    """ The QuestionList a dictionary key's variants are built from. Made once per key in each worker """
+    cache = worker_state.setdefault("questions", {})
+    if key not in cache:
+        categories, optimal, _, _ = key
+        corpus = worker_state["corpus"]
+        questions = corpus.subset(categories) if categories else corpus.subset(corpus.store.categories)
+        questions.optimal = optimal
+        cache[key] = questions
+    return cache[key]
+
+
+def make_planner(variant):
+    if not variant.get("pack"):
+        return None
+    min_questions = variant.get("min_questions") or 0
+    if isinstance(min_questions, dict):
+        return PackingPlanner(minimums=min_questions, weights=variant.get("category_weights"),
+                              balance=variant.get("balance", False))
+    return PackingPlanner(default_minimum=min_questions, weights=variant.get("category_weights"),
+                          balance=variant.get("balance", False))
+
+
+def init_batch_worker(base_image, corpus):
+    """ ProcessPoolExecutor initializer: every worker gets the combined clean ROM image and the validated questions """
+    logging.getLogger('QADPatch').setLevel(logging.WARNING)
+    worker_state["base_image"] = base_image
+    worker_state["corpus"] = corpus
+
+
+def prepare_group(key):
+    """ Build the dictionaries for a dictionary key and encode its questions. Returns (main, proper, blocks, seconds) """
+    start = time.perf_counter()
+    questions = variant_questions(key)
+    main_dict, proper_noun_dict = build.make_dictionaries(questions, dictionary_strategy=key[2], phrases=key[3])
+    blocks = questions.encode_questions(questions.sorted_questions(), proper_noun_dict, main_dict)
+    return list(main_dict.words), list(proper_noun_dict.words), blocks, time.perf_counter() - start
+
+
+def build_variant(variant, key, output_dir, main_words, proper_noun_words, blocks, store_only=False):
+    """ Lay out, patch and write one variant from its group's encoded blocks. Returns a result dict """
+    start = time.perf_counter()
+    questions = variant_questions(key)
+    main_dict = WordDictionary(None, {}, max_size=build.MAX_MAIN_DICT_SIZE, max_word_count=2048)
+    main_dict.words = main_words
+    proper_noun_dict = WordDictionary(None, {}, max_size=build.MAX_PROPER_NOUN_DICT_SIZE_BYTES,
+                                      max_word_count=build.MAX_PROPER_NOUN_DICT_SIZE, proper=True)
+    proper_noun_dict.words = proper_noun_words
+
+    result = {"name": variant["name"], "error": None, "report": None}
+    try:
+        questions_bin, metadata = questions.layout(questions.sorted_questions(), blocks,
+                                                   planner=make_planner(variant))
+    except PackingError as e:
+        result.update(error=e.message, seconds=time.perf_counter() - start)
+        return result
+
+    rom = RomImage(bytearray(worker_state["base_image"]))
+    out_dir = join(output_dir, variant["name"])
+    try:
+        build.patch_rom(rom, questions_bin, metadata, proper_noun_dict, main_dict,
+                        rng=random.Random(variant.get("seed")))
+        rom.write_zip(build.CLEAN_ROM_DIR, build.ZIP_FILENAME, out_dir, store_only=store_only)
+    except (ValueError, OverflowError, OSError) as e:
+        result.update(error=str(e), seconds=time.perf_counter() - start)
+        return result
+    result.update(questions=metadata["question_count"], categories=len(metadata["categories"]),
+                  output=join(out_dir, build.ZIP_FILENAME), report=metadata.get("packing"),
+                  seconds=time.perf_counter() - start)
+    return result
+
+
+def batch_build(manifest, workers=None, store_only=False):
+    """
+    Build every variant in a manifest (see load_manifest). The clean ROM is read and deinterleaved once and the
+    questions read and validated once, then both are shared with a pool of worker processes. Dictionaries are built
+    and questions encoded once per distinct category set and encoder settings, and each variant is then laid out,
+    patched and written to its own zip, with its program ROMs left uncompressed if store_only is set. Returns a list
+    of per-variant result dicts. A variant that fails to build, or whose dictionaries couldn't be built, has the
+    reason in its "error" rather than stopping the batch.
+    """
+    logger = logging.getLogger('QADPatch')
+    rom = build.read_clean_rom()
+    corpus = build.read_questions(manifest["questions"], rom.read(build.BYTE_REFERENCE_TABLE_ADDRESS, 0xc0))
+
+    groups = {}
+    for variant in manifest["variants"]:
+        groups.setdefault(dictionary_key(variant), []).append(variant)
+    for key, variants in groups.items():
+        categories = key[0] or corpus.store.categories
+        missing = set(categories) - set(corpus.store.categories)
+        if missing:
+            logger.error(f"Variant {variants[0]['name']} uses categories with no questions: "
+                         f"{', '.join(sorted(missing))}. Exiting")
+            sys.exit(1)
+        error = build.category_limit_error(corpus.subset(categories))
+        if error:
+            logger.error(f"Variant {variants[0]['name']}: {error}. Exiting")
+            sys.exit(1)
+
+    logger.info(f"Building {len(manifest['variants'])} variants with {len(groups)} sets of dictionaries")
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker,
+                             initargs=(bytes(rom.data), corpus)) as executor:
+        group_futures = {key: executor.submit(prepare_group, key) for key in groups}
+        variant_futures = []
+        for key, future in group_futures.items():
+            try:
+                main_words, proper_noun_words, blocks, seconds = future.result()
+            except Exception as e:
+                logger.error(f"Couldn't build dictionaries for {', '.join(v['name'] for v in groups[key])}: {e}")
+                for variant in groups[key]:
+                    results[variant["name"]] = {"name": variant["name"], "error": f"Dictionaries failed: {e}",
+                                                "report": None, "seconds": 0.0, "shared_seconds": 0.0}
+                continue
+            logger.info(f"Built dictionaries and encoded {len(blocks)} questions for "
+                        f"{', '.join(v['name'] for v in groups[key])} in {seconds:.2f}s")
+            for variant in groups[key]:
+                variant_futures.append((variant, seconds,
+                                        executor.submit(build_variant, variant, key, manifest["output_dir"],
+                                                        main_words, proper_noun_words, blocks, store_only)))
+        for variant, shared_seconds, future in variant_futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"name": variant["name"], "error": str(e), "report": None, "seconds": 0.0}
+            result["shared_seconds"] = shared_seconds
+            results[variant["name"]] = result
+    return [results[variant["name"]] for variant in manifest["variants"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build several ROM variants described by a manifest")
+    parser.add_argument("manifest", help="JSON manifest of variants (see load_manifest in batch_build.py)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Processes to build variants in (default: one per CPU)")
+    parser.add_argument("--store", action="store_true",
+                        help="Store the patched program ROMs without compressing them. Faster, for test builds.")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    logger = logging.getLogger('QADPatch')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    try:
+        manifest = load_manifest(args.manifest)
+    except FileNotFoundError:
+        sys.exit(f"{args.manifest} not found.")
+    except (ValueError, TypeError) as e:
+        sys.exit(f"Bad manifest {args.manifest}: {e}")
+
+    start = time.perf_counter()
+    results = batch_build(manifest, workers=args.workers, store_only=args.store)
+
+    print(f"{'Variant':<24} {'Questions':>9} {'Shared':>9} {'Variant':>9}  Output")
+    for result in results:
+        if result["error"]:
+            print(f"{result['name']:<24} {'-':>9} {result['shared_seconds']:>8.2f}s {result['seconds']:>8.2f}s  "
+                  f"Failed: {result['error']}")
+            continue
+        print(f"{result['name']:<24} {result['questions']:>9} {result['shared_seconds']:>8.2f}s "
+              f"{result['seconds']:>8.2f}s  {result['output']}")
+        if result["report"]:
+            for line in format_report(result["report"]):
+                logger.debug(line)
+    print(f"Built {sum(1 for r in results if not r['error'])} of {len(results)} variants in "
+          f"{time.perf_counter() - start:.2f}s")
+    if any(result["error"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+""" Micro-benchmarks for the build pipeline. Run ./benchmark.py to print throughput for each stage. """
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from itertools import accumulate
+from os.path import join
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import build
+import util
+from QADPatch.QuizQuestions import QuestionList, MAX_ANSWER_LENGTH
+from QADPatch.Ingest import ingest
+from QADPatch.Instrument import BuildProfile
+from QADPatch.Validation import Validator
+from QADPatch.WordFrequency import count_words, count_words_parallel, record_strings, top_words
+from QADPatch.WordDictionary import WordDictionary, build_dictionaries
+from QADPatch.PhraseMiner import mine_phrases
+
+ROM_PAIR_SIZE = 0x20000  # Each program ROM file is 128KB
+# Category names for synthetic questions. 14 is the most the ROM has room for, and these fit its category name space
+SYNTHETIC_CATEGORIES = ["Geography", "History", "Science", "Film", "Music", "Books", "Sports", "Art", "Nature", "Games",
+                        "TV", "Food", "Myths", "Words"]
+SYLLABLES = ["an", "ar", "ba", "ber", "ca", "con", "da", "de", "el", "en", "er", "fa", "ga", "in", "is", "ka", "la",
+             "le", "lo", "ma", "mon", "na", "ne", "or", "pa", "per", "ra", "re", "ri", "sa", "se", "ta", "ter", "ti",
+             "to", "un", "va", "ver", "za"]
+QUESTION_OPENINGS = ["Which", "What", "Who", "Where", "When", "How many", "In which", "What is the"]
+# The clean zip's other members, which the zip stage copies across. Sizes are roughly the real ones
+FAKE_ROM_MEMBERS = {"qdu_01.bin": 0x80000, "qdu_02.bin": 0x80000, "qdu_03.bin": 0x20000, "qdu_04.bin": 0x10000}
+# Stages that got slower by less than this are never counted as regressions, however large the relative change
+MIN_REGRESSION_SECONDS = 0.005
+
+
+def legacy_deinterleave(fn1, fn2, outfn):
+    """ Byte at a time deinterleave, as util.deinterleave was originally written. Used as a baseline. """
+    fp1 = open(fn1, "rb")
+    fp2 = open(fn2, "rb")
+    fps = [fp1, fp2]
+    outfp = open(outfn, "wb")
+
+    i = 0
+    while True:
+        b = fps[i].read(1)
+        if not b:
+            break
+
+        outfp.write(b)
+
+        i = (i + 1) % 2
+
+    fp1.close()
+    fp2.close()
+    outfp.close()
+
+
+def legacy_interleave(fn, outfn1, outfn2):
+    """ Byte at a time interleave, as util.interleave was originally written. Used as a baseline. """
+    fp = open(fn, "rb")
+    outfp1 = open(outfn1, "wb")
+    outfp2 = open(outfn2, "wb")
+    outfps = [outfp1, outfp2]
+
+    i = 0
+    while True:
+        b = fp.read(1)
+        if not b:
+            break
+
+        outfps[i].write(b)
+        i = (i + 1) % 2
+
+    fp.close()
+    outfp1.close()
+    outfp2.close()
+
+
+def legacy_count_words(strings):
+    """ Word counting as QuestionList.calculate_frequency_from_str was originally written. Used as a baseline. """
+    frequency_dict = {}
+    for s in strings:
+        separators = r'[\s|"|!|#|$|%|&|\'|(|)|\+|,|-|\.|/|:|;|<|=|>|\?|{|}]+'
+        words = re.split(separators, s)
+        for word in words:
+            word = word.strip("{}")
+            if not re.match(r'^[a-zA-Z\.\-\'\*]+$', word):
+                continue
+            if len(word) < 2:
+                continue
+            if word in frequency_dict:
+                frequency_dict[word] += 1
+            else:
+                frequency_dict[word] = 1
+    return frequency_dict
+
+
+def stand_in_byte_reference_table():
+    """ Byte reference table to use when there's no clean ROM: printable ASCII is verbatim, 88 bytes are proper nouns """
+    table = bytearray(0xc0)
+    proper_noun_bytes = list(range(0x80, 0xc0)) + list(range(0x02, 0x1a))
+    for i, b in enumerate(proper_noun_bytes):
+        table[b] = i + 1
+    return bytes(table)
+
+
+def load_byte_reference_table():
+    """ The real byte reference table if clean_rom/qad.zip is available, otherwise a stand-in """
+    try:
+        rom = util.RomImage.from_zip(build.CLEAN_ROM_DIR, build.ZIP_FILENAME)
+        return rom.read(build.BYTE_REFERENCE_TABLE_ADDRESS, 0xc0)
+    except FileNotFoundError:
+        return stand_in_byte_reference_table()
+
+
+def load_questions(questions_fn, byte_reference_table, optimal=False):
+    """ QuestionList of every valid question in questions_fn """
+    questions = QuestionList(byte_reference_table, optimal=optimal)
+    ingest(questions_fn, questions)
+    return questions
+
+
+def encoded_size(questions, proper_noun_dict, main_dict):
+    """ Total bytes of every encoded question block, ignoring MAX_QUESTION_LIST_SIZE """
+    total = 0
+    for question in questions.question_list:
+        # Length byte, question null terminator and one terminator per answer
+        total += 2 + len(question.answers)
+        total += len(questions.encode_str(question.wrap().rstrip("?").rstrip(), proper_noun_dict, main_dict))
+        for answer in question.answers:
+            total += len(questions.encode_str(answer, proper_noun_dict, main_dict))
+    return total
+
+
+def frequency_dictionaries(questions, frequency):
+    """ Dictionaries chosen the way build_rom does by default """
+    main_dict = WordDictionary(questions, frequency, max_size=build.MAX_MAIN_DICT_SIZE, max_word_count=2048)
+    main_dict.build()
+    proper_noun_dict = WordDictionary(questions, frequency, max_size=build.MAX_PROPER_NOUN_DICT_SIZE_BYTES,
+                                      max_word_count=build.MAX_PROPER_NOUN_DICT_SIZE, proper=True,
+                                      exclusions=list(main_dict.words)[0:100])
+    proper_noun_dict.build()
+    return main_dict, proper_noun_dict
+
+
+def savings_dictionaries(questions, frequency):
+    return build_dictionaries(questions, frequency, build.MAX_MAIN_DICT_SIZE, 2048,
+                              build.MAX_PROPER_NOUN_DICT_SIZE_BYTES, build.MAX_PROPER_NOUN_DICT_SIZE)
+
+
+def phrase_dictionaries(questions, frequency):
+    main_dict, proper_noun_dict = savings_dictionaries(questions, frequency)
+    phrase_savings = mine_phrases(questions, proper_noun_dict, main_dict)
+    return build_dictionaries(questions, frequency, build.MAX_MAIN_DICT_SIZE, 2048,
+                              build.MAX_PROPER_NOUN_DICT_SIZE_BYTES, build.MAX_PROPER_NOUN_DICT_SIZE,
+                              phrase_savings=phrase_savings)
+
+
+def timed(fn, repeat=3):
+    """ Best wall time of 'repeat' calls to fn """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, seconds, size):
+    print(f"{name:<40} {seconds * 1000:10.2f} ms {size / seconds / 1024 / 1024:10.1f} MB/s")
+
+
+def bench_interleave():
+    """ Compare the original per-byte loops against the slicing and NumPy implementations """
+    even = os.urandom(ROM_PAIR_SIZE)
+    odd = os.urandom(ROM_PAIR_SIZE)
+    size = len(even) + len(odd)
+    with tempfile.TemporaryDirectory() as tmp:
+        fn1, fn2, combined = join(tmp, "a.bin"), join(tmp, "b.bin"), join(tmp, "combined.bin")
+        for fn, data in [(fn1, even), (fn2, odd)]:
+            with open(fn, "wb") as f:
+                f.write(data)
+
+        report("deinterleave (legacy, files)", timed(lambda: legacy_deinterleave(fn1, fn2, combined), 1), size)
+        report("deinterleave (slicing, files)", timed(lambda: util.deinterleave(fn1, fn2, combined)), size)
+        report("interleave (legacy, files)", timed(lambda: legacy_interleave(combined, fn1, fn2), 1), size)
+        report("interleave (slicing, files)", timed(lambda: util.interleave(combined, fn1, fn2)), size)
+
+    data = util.deinterleave(even, odd)
+    report("deinterleave (slicing, buffers)", timed(lambda: util.deinterleave(even, odd)), size)
+    report("interleave (slicing, buffers)", timed(lambda: util.interleave(data)), size)
+    if util.numpy is not None:
+        report("deinterleave (numpy, buffers)", timed(lambda: util.deinterleave(even, odd, use_numpy=True)), size)
+        report("interleave (numpy, buffers)", timed(lambda: util.interleave(data, use_numpy=True)), size)
+    else:
+        print("NumPy not installed, skipping NumPy benchmarks")
+
+
+def bench_dictionaries(questions_fn):
+    """ Total encoded size with frequency-ranked dictionaries against savings-ranked ones """
+    if not os.path.isfile(questions_fn):
+        print(f"{questions_fn} not found, skipping dictionary benchmarks")
+        return
+    byte_reference_table = load_byte_reference_table()
+    for optimal in [False, True]:
+        questions = load_questions(questions_fn, byte_reference_table, optimal=optimal)
+        frequency = questions.calculate_word_frequency()
+        for name, build_fn in [("frequency", frequency_dictionaries), ("savings", savings_dictionaries),
+                               ("phrase", phrase_dictionaries)]:
+            start = time.perf_counter()
+            main_dict, proper_noun_dict = build_fn(questions, frequency)
+            elapsed = time.perf_counter() - start
+            size = encoded_size(questions, proper_noun_dict, main_dict)
+            encoder = "optimal" if optimal else "greedy"
+            print(f"{name + ' dictionaries, ' + encoder + ' encoder':<40} {elapsed * 1000:10.2f} ms "
+                  f"{size:10} bytes encoded, {len(main_dict.words)} + {len(proper_noun_dict.words)} words")
+
+
+def synthetic_word(rng):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.choice([1, 2, 2, 3])))
+
+
+def synthetic_corpus(count, categories=8, skew=1.0, vocabulary=4000, seed=0):
+    """
+    count made-up trivia questions spread over the first 'categories' of SYNTHETIC_CATEGORIES, the same every time for
+    the same arguments. Words come from a vocabulary of pseudo-words, the n'th most common turning up 1 / n ** skew as
+    often as the most common one, so a higher skew makes a more repetitive corpus that compresses better. Every tenth
+    word is a capitalized proper noun. Returns records like the ones in questions.json.
+    """
+    rng = random.Random(seed)
+    words = []
+    seen = set()
+    while len(words) < vocabulary:
+        word = synthetic_word(rng)
+        if word not in seen:
+            seen.add(word)
+            words.append(word.capitalize() if len(words) % 10 == 0 else word)
+    cum_weights = list(accumulate(1 / (rank + 1) ** skew for rank in range(vocabulary)))
+    names = SYNTHETIC_CATEGORIES[:categories]
+
+    records = []
+    for _ in range(count):
+        question = " ".join([rng.choice(QUESTION_OPENINGS)] +
+                            rng.choices(words, cum_weights=cum_weights, k=rng.randint(3, 10))) + "?"
+        answers = []
+        while len(answers) < 4:
+            answer = " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(1, 3)))
+            answer = answer[:MAX_ANSWER_LENGTH].rstrip()
+            if answer not in answers:
+                answers.append(answer)
+        records.append({"category": rng.choice(names), "question": question, "answers": answers})
+    return records
+
+
+def fake_rom(directory, seed=0):
+    """
+    Write a stand-in for clean_rom/qad.zip to directory, so every build stage can be run without the real ROM: program
+    ROMs full of random bytes, with stand_in_byte_reference_table where build.py reads the byte reference table, and
+    some other members for the zip stage to copy. Returns the RomImage the program ROMs were made from.
+    """
+    rng = random.Random(seed)
+    data = bytearray(rng.randbytes(2 * util.SPLIT_ADDRESS))
+    data[build.BYTE_REFERENCE_TABLE_ADDRESS:build.BYTE_REFERENCE_TABLE_ADDRESS + 0xc0] = stand_in_byte_reference_table()
+    rom = util.RomImage(data)
+    with ZipFile(join(directory, build.ZIP_FILENAME), "w", ZIP_DEFLATED) as zf:
+        for fn, contents in rom.roms().items():
+            zf.writestr(fn, contents)
+        for fn, size in FAKE_ROM_MEMBERS.items():
+            # Half noise and half padding, so there's something to compress
+            zf.writestr(fn, rng.randbytes(size // 2) + bytes(size - size // 2))
+    return rom
+
+
+def run_stages(records, rom_dir, profile, optimal=False, dictionary_strategy="frequency", seed=0):
+    """
+    Build a ROM from records and the qad.zip in rom_dir the way build_rom does, timing each stage in a span of profile
+    (an Instrument.BuildProfile). The patched zip is written to rom_dir/patched. Returns the build's metrics.
+    """
+    with profile.span("read rom"):
+        rom = util.RomImage.from_zip(rom_dir, build.ZIP_FILENAME)
+    byte_reference_table = rom.read(build.BYTE_REFERENCE_TABLE_ADDRESS, 0xc0)
+
+    with profile.span("validate"):
+        valid, errors = Validator(byte_reference_table).validate_batch(
+            (record["question"], record["answers"]) for record in records)
+
+    with profile.span("count words"):
+        questions = QuestionList(byte_reference_table, optimal=optimal)
+        for record, ok in zip(records, valid):
+            if ok:
+                questions.add(record["category"], record["question"], record["answers"])
+        questions.calculate_word_frequency()
+
+    with profile.span("dictionaries"):
+        main_dict, proper_noun_dict = build.make_dictionaries(questions, dictionary_strategy)
+
+    with profile.span("encode"):
+        questions_bin, metadata = questions.dump_bytes(proper_noun_dict, main_dict)
+
+    with profile.span("patch"):
+        build.patch_rom(rom, questions_bin, metadata, proper_noun_dict, main_dict, rng=random.Random(seed))
+
+    with profile.span("interleave"):
+        rom.roms()
+
+    with profile.span("zip"):
+        rom.write_zip(rom_dir, build.ZIP_FILENAME, join(rom_dir, "patched"))
+
+    stats = questions.encoding_stats(questions_bin, metadata, proper_noun_dict, main_dict)
+    raw_bytes = sum(category["raw_bytes"] for category in stats["categories"].values())
+    encoded_bytes = sum(category["encoded_bytes"] for category in stats["categories"].values())
+    return {"questions": len(records), "valid": valid.count(True), "fitted": metadata["question_count"],
+            "raw_bytes": raw_bytes, "encoded_bytes": encoded_bytes,
+            "compression_ratio": round(encoded_bytes / raw_bytes, 4) if raw_bytes else 1.0,
+            "main_words": len(main_dict.words), "proper_nouns": len(proper_noun_dict.words)}
+
+
+def bench_stages(count=5000, categories=8, skew=1.0, vocabulary=4000, seed=0, repeat=3, optimal=False,
+                 dictionary_strategy="frequency"):
+    """
+    Time every build stage on a synthetic corpus and a fake ROM, keeping each stage's best time over 'repeat' builds.
+    Returns {"config", "stages": {name: seconds}, "metrics"}, which can be saved as a baseline for compare_baseline.
+    """
+    config = {"count": count, "categories": categories, "skew": skew, "vocabulary": vocabulary, "seed": seed,
+              "optimal": optimal, "dictionaries": dictionary_strategy}
+    start = time.perf_counter()
+    records = synthetic_corpus(count, categories, skew, vocabulary, seed)
+    print(f"{'generate corpus':<40} {(time.perf_counter() - start) * 1000:10.2f} ms {count:10} questions")
+
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        fake_rom(tmp, seed)
+        for _ in range(repeat):
+            profile = BuildProfile()
+            metrics = run_stages(records, tmp, profile, optimal, dictionary_strategy, seed)
+            for span in profile.spans:
+                stages[span["name"]] = min(stages.get(span["name"], span["wall_seconds"]), span["wall_seconds"])
+    metrics["peak_rss_mb"] = profile.spans[-1]["peak_rss_mb"]
+
+    for name, seconds in stages.items():
+        print(f"{name:<40} {seconds * 1000:10.2f} ms")
+    print(f"{metrics['fitted']} of {metrics['valid']} valid questions fitted, {metrics['encoded_bytes']} bytes encoded "
+          f"from {metrics['raw_bytes']} (ratio {metrics['compression_ratio']}), "
+          f"{metrics['main_words']} + {metrics['proper_nouns']} dictionary words")
+    return {"config": config, "stages": stages, "metrics": metrics}
+
+
+def compare_baseline(results, baseline, tolerance=0.25):
+    """
+    Lines comparing bench_stages results with a baseline from an earlier run, and whether anything regressed: a stage
+    over tolerance (a fraction) slower, fewer questions fitted, or a worse compression ratio. Timings only mean
+    something against a baseline from the same machine.
+    """
+    lines = []
+    regressed = False
+    if baseline.get("config") != results["config"]:
+        lines.append(f"Warning: the baseline was run with {baseline.get('config')}, not {results['config']}")
+    for name, seconds in results["stages"].items():
+        old = baseline.get("stages", {}).get(name)
+        if old is None:
+            lines.append(f"{name:<40} {seconds * 1000:10.2f} ms (not in baseline)")
+            continue
+        change = seconds / old - 1 if old else 0.0
+        flag = ""
+        if change > tolerance and seconds - old > MIN_REGRESSION_SECONDS:
+            flag = "  REGRESSION"
+            regressed = True
+        lines.append(f"{name:<40} {old * 1000:10.2f} -> {seconds * 1000:10.2f} ms {change:+8.1%}{flag}")
+
+    metrics, old_metrics = results["metrics"], baseline.get("metrics", {})
+    for name, worse in [("fitted", lambda new, old: new < old), ("compression_ratio", lambda new, old: new > old)]:
+        if name not in old_metrics:
+            continue
+        flag = ""
+        if worse(metrics[name], old_metrics[name]):
+            flag = "  REGRESSION"
+            regressed = True
+        lines.append(f"{name:<40} {old_metrics[name]:>10} -> {metrics[name]:>10}{flag}")
+    return lines, regressed
+
+
+def bench_frequency(count=50000, vocabulary=20000, seed=0, workers=None):
+    """ Word counting the original way against the precompiled and sharded counters, and a full sort against top-K """
+    strings = list(record_strings(synthetic_corpus(count, vocabulary=vocabulary, seed=seed)))
+    workers = workers or os.cpu_count() or 1
+    counts = count_words(strings)
+    if legacy_count_words(strings) != counts or count_words_parallel(strings, workers) != counts:
+        print("Word counts differ!")
+    size = sum(len(s) for s in strings)
+    report("count words (legacy)", timed(lambda: legacy_count_words(strings), 1), size)
+    report("count words (precompiled)", timed(lambda: count_words(strings)), size)
+    report(f"count words ({workers} processes)", timed(lambda: count_words_parallel(strings, workers), 1), size)
+    print(f"{'sort ' + str(len(counts)) + ' words':<40} "
+          f"{timed(lambda: sorted(counts.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)) * 1000:10.2f} ms")
+    print(f"{'top 2048 words':<40} {timed(lambda: top_words(counts, 2048, min_count=2)) * 1000:10.2f} ms")
+
+
+BENCHMARKS = ["interleave", "dictionaries", "frequency", "stages"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark build stages")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help=f"Benchmarks to run, from {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--questions", default="questions.json",
+                        help="Question bank used by the dictionary benchmarks")
+    stages_group = parser.add_argument_group("stages", "Build every stage from a synthetic corpus and a fake ROM")
+    stages_group.add_argument("--count", type=int, default=5000, help="Questions to generate (default: %(default)s)")
+    stages_group.add_argument("--categories", type=int, default=8,
+                              help=f"Categories to spread them over, up to {len(SYNTHETIC_CATEGORIES)} "
+                                   f"(default: %(default)s)")
+    stages_group.add_argument("--skew", type=float, default=1.0,
+                              help="How unevenly words are used. 0 uses every word equally, higher values make a few "
+                                   "words far more common (default: %(default)s)")
+    stages_group.add_argument("--vocabulary", type=int, default=4000,
+                              help="Distinct words to draw from (default: %(default)s)")
+    stages_group.add_argument("--seed", type=int, default=0, help="Seed for the corpus and fake ROM")
+    stages_group.add_argument("--repeat", type=int, default=3,
+                              help="Builds to run, keeping each stage's best time (default: %(default)s)")
+    stages_group.add_argument("--optimal", action="store_true", help="Use the optimal encoder")
+    stages_group.add_argument("--dictionaries", choices=["frequency", "savings"], default="frequency",
+                              help="Dictionary strategy (default: %(default)s)")
+    stages_group.add_argument("--output", metavar="FILE", help="Save the results as JSON, e.g. as a baseline")
+    stages_group.add_argument("--baseline", metavar="FILE",
+                              help="Compare the results with an earlier --output, exiting with status 1 if anything "
+                                   "regressed")
+    stages_group.add_argument("--tolerance", type=float, default=0.25,
+                              help="How much slower (as a fraction) a stage can get before it counts as a regression "
+                                   "(default: %(default)s)")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark {name}")
+    if not 1 <= args.categories <= len(SYNTHETIC_CATEGORIES):
+        parser.error(f"--categories must be between 1 and {len(SYNTHETIC_CATEGORIES)}")
+    if args.count < 1 or args.repeat < 1:
+        parser.error("--count and --repeat must be at least 1")
+    if args.vocabulary < 10:
+        parser.error("--vocabulary must be at least 10")
+    if args.skew < 0 or args.tolerance < 0:
+        parser.error("--skew and --tolerance can't be negative")
+    args.benchmarks = args.benchmarks or BENCHMARKS
+    if "interleave" in args.benchmarks:
+        bench_interleave()
+    if "dictionaries" in args.benchmarks:
+        bench_dictionaries(args.questions)
+    if "frequency" in args.benchmarks:
+        bench_frequency(seed=args.seed)
+    if "stages" in args.benchmarks:
+        # Read the baseline first, so a bad path doesn't waste a run
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        results = bench_stages(args.count, args.categories, args.skew, args.vocabulary, args.seed, args.repeat,
+                               args.optimal, args.dictionaries)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=4)
+        if baseline is not None:
+            lines, regressed = compare_baseline(results, baseline, args.tolerance)
+            print(f"Compared with {args.baseline}:")
+            for line in lines:
+                print(line)
+            if regressed:
+                sys.exit(1)
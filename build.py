@@ -1,113 +1,197 @@
 #!/usr/bin/env python3
+import argparse
 import json
 import logging
 import os
 import sys
-from os.path import join
-import shutil
 import random
+from os.path import join
+from zipfile import BadZipFile
 # from compress import Questions, WordDictionary, calculate_word_frequency, MAX_MAIN_DICT_SIZE, \
 #   MAX_PROPER_NOUN_DICT_SIZE_BYTES
-from QADPatch.QuizQuestions import QuizQuestion, QuestionList
-from QADPatch.WordDictionary import WordDictionary
-from util import check_zip_hash, extract_zip, deinterleave, concatenate, patch, split, interleave, build_zip
+from QADPatch.QuizQuestions import QuestionList, MAX_CATEGORIES, MAX_CATEGORY_NAMES_SIZE
+from QADPatch.Ingest import ingest, IngestError
+from QADPatch.Pipeline import Pipeline, Stage, QuestionListSink, csv_source, json_source, validate
+from QADPatch.Dedupe import NearDuplicateFilter, DEFAULT_THRESHOLD as DEFAULT_DEDUPE_THRESHOLD, \
+    format_report as format_dedupe_report
+from QADPatch.Validation import format_error
+from QADPatch.WordDictionary import WordDictionary, build_dictionaries
+from QADPatch.PhraseMiner import mine_phrases
+from QADPatch.EncodeCache import EncodeCache
+from QADPatch.Verify import verify, format_mismatch
+from QADPatch.Packing import PackingPlanner, PackingError, format_report
+from QADPatch.Instrument import BuildProfile
+from QADPatch.Estimator import CapacityEstimator, format_summary
+from util import check_zip_hash, RomImage
 
-WORKING_DIR = join(".", "temp")
 OUTPUT_DIR = join(".", "patched")
 CLEAN_ROM_DIR = "clean_rom"
 ZIP_FILENAME = "qad.zip"
-ROM1A = "qdu_36a.12f"
-ROM1B = "qdu_42a.12h"
-ROM2A = "qdu_37a.13f"
-ROM2B = "qdu_43a.13h"
+CACHE_FILE = join(".", "cache", "encode_cache.sqlite3")
 MAX_PROPER_NOUN_DICT_SIZE = 88
 MAX_PROPER_NOUN_DICT_SIZE_BYTES = 0x30e
+# PROPER_NOUN_COUNT_ADDRESS holds the proper noun dictionary's word count (dummy words included) + 1 in a single byte
+MAX_PROPER_NOUN_DICT_ENTRIES = 0xfe
 MAX_MAIN_DICT_SIZE = 0x3973
 
+# Addresses in the combined program ROM image. See notes.md
+BYTE_REFERENCE_TABLE_ADDRESS = 0x1DCB6
+CATEGORY_OFFSETS_ADDRESS = 0x1DBE6
+CATEGORY_NAMES_ADDRESS = 0x1DC1E
+CATEGORY_COUNTS_ADDRESS = 0x1DC9A
+PROPER_NOUN_DICT_ADDRESS = 0x256EE
+MAIN_DICT_ADDRESS = 0x259FC
+QUESTIONS_ADDRESS = 0x29370
+PROPER_NOUN_COUNT_ADDRESS = 0x5E09
 
-def build_rom():
+
+def read_clean_rom(profile=None, accept_repacked=False):
     """
-        Given qad.zip, extract out ROM files process as follows:
-        1. Extract zip
-        2. Deinterlace all 4 ROM files, one pair at a time
-        3. Concatenate deinterlaced ROMs
-        4. Apply patches
-        5. Work backwards through steps 3,2,1
+    Check clean_rom/qad.zip's hash and read it into a RomImage. Exits if it's missing or doesn't match. With
+    accept_repacked, a zip with the right program ROMs passes even if the zip itself was rewritten (see
+    util.check_zip_hash). Both steps are timed in profile (an Instrument.BuildProfile) if one is given
     """
     logger = logging.getLogger('QADPatch')
-    logger.setLevel(logging.INFO)
-    sh = logging.StreamHandler()
-    logger.addHandler(sh)
+    profile = profile or BuildProfile()
     try:
-        if not check_zip_hash(CLEAN_ROM_DIR, ZIP_FILENAME):
-            logger.error("qad.zip file hash does not match. Make sure you're using the most recent version of qad.zip")
-            sys.exit(1)
+        with profile.span("check hash"):
+            hash_ok = check_zip_hash(CLEAN_ROM_DIR, ZIP_FILENAME, by_member=accept_repacked)
     except FileNotFoundError:
         logger.error("qad.zip not found in clean_rom directory.")
         sys.exit(1)
-    logger.info("Extracting, deinterleaving, and combining ROM files")
-    extract_zip(CLEAN_ROM_DIR, ZIP_FILENAME)
-    deinterleave(ROM1A, ROM1B, "rom1.bin")
-    deinterleave(ROM2A, ROM2B, "rom2.bin")
-    concatenate("rom1.bin", "rom2.bin", "combined.bin")
-
-    with open(join(WORKING_DIR, "combined.bin"), "rb") as f:
-        f.seek(0x1dcb6)
-        byte_reference_table = f.read(0xc0)
-
-    questions = QuestionList(byte_reference_table)
+    except BadZipFile:
+        logger.error("qad.zip in the clean_rom directory isn't a valid zip file.")
+        sys.exit(1)
+    if not hash_ok:
+        logger.error("qad.zip file hash does not match. Make sure you're using the most recent version of qad.zip")
+        sys.exit(1)
+    logger.info("Reading, deinterleaving, and combining ROM files")
+    try:
+        with profile.span("read rom"):
+            return RomImage.from_zip(CLEAN_ROM_DIR, ZIP_FILENAME)
+    except BadZipFile as e:
+        logger.error(f"Couldn't read the program ROMs from qad.zip: {e}")
+        sys.exit(1)
 
-    with open("questions.json", "r") as f:
-        question_json = json.load(f)
 
-    logger.info("Validating questions")
+def read_questions(questions_fn, byte_reference_table, optimal=False, pipeline=None, dedupe=None,
+                   dedupe_report=None, profile=None):
+    """
+    QuestionList of the valid questions in questions_fn, or coming out of pipeline (a Pipeline.Pipeline) if one is
+    given. Invalid ones are logged. With a dedupe similarity threshold, questions that are near duplicates of an
+    earlier one are dropped (see Dedupe.NearDuplicateFilter), and the clusters dropped are written to dedupe_report
+    as JSON if it's given. How many questions were read and dropped is counted in profile, if given. Exits if the
+    questions can't be read
+    """
+    profile = profile or BuildProfile()
+    logger = logging.getLogger('QADPatch')
+    questions = QuestionList(byte_reference_table, optimal=optimal)
 
-    # Validate and add questions
-    for q in question_json:
-        question = QuizQuestion(category=q["category"],
-                                question_text=q["question"],
-                                answers=q["answers"])
+    logger.info("Reading and validating questions")
 
-        valid = question.validate(questions.allowed_chars)
-        if valid:
-            questions.add_question(question)
+    # Questions are validated and their words counted as they're read, without loading the whole file at once
+    dedupe_filter = None
+    try:
+        if pipeline is None and (dedupe or questions_fn.lower().endswith(".csv")):
+            pipeline = Pipeline(csv_source(questions_fn) if questions_fn.lower().endswith(".csv")
+                                else json_source(questions_fn))
+        if dedupe:
+            # Validate first, so nothing is dropped as a copy of a question that's about to be rejected
+            dedupe_filter = NearDuplicateFilter(dedupe)
+            pipeline = Pipeline(pipeline.source, pipeline.stages + [validate(byte_reference_table),
+                                                                    Stage("near dedupe", dedupe_filter)])
+        if pipeline is None:
+            added, errors = ingest(questions_fn, questions)
         else:
-            logger.info("Question failed validation. Skipping")
-
-    if questions.category_count() > 14:
-        logger.error(f"Too many categories. There can be a max of 14. Exiting")
+            added, errors = pipeline.run(QuestionListSink(questions))
+            for line in pipeline.report():
+                logger.debug(line)
+    except FileNotFoundError:
+        logger.error(f"{questions_fn} not found. Exiting")
         sys.exit(1)
-    if questions.category_names_size() > 0x7c:
-        logger.error(f"Total category name length is too long. Remove some categories, or shorten their names. Exiting")
+    except IngestError as e:
+        logger.error(f"Can't read {questions_fn}: {e.message}. Exiting")
         sys.exit(1)
+    for error in errors:
+        logger.warning(format_error(error))
+    skipped = len({error["index"] for error in errors})
+    profile.set("questions_valid", added)
+    profile.set("questions_invalid", skipped)
+    if dedupe_filter is None:
+        logger.info(f"Read {added + skipped} questions, {skipped} failed validation")
+        return questions
 
-    logger.info("Building main dictionary")
-    # Build both dictionaries
-    frequency = questions.calculate_word_frequency()
-    main_dict = WordDictionary(questions, frequency, max_size=MAX_MAIN_DICT_SIZE, max_word_count=2048,
-                               proper=False)
-    main_dict.build()
+    dropped = dedupe_filter.exact_duplicates + dedupe_filter.near_duplicates
+    profile.set("questions_duplicate", dropped)
+    logger.info(f"Read {added + skipped + dropped} questions, {skipped} failed validation")
+    summary, *clusters = format_dedupe_report(dedupe_filter)
+    logger.info(summary)
+    for line in clusters:
+        logger.debug(line)
+    if dedupe_report:
+        with open(dedupe_report, "w") as f:
+            json.dump(dedupe_filter.report(), f, indent=4)
+        logger.info(f"Wrote the duplicate clusters to {dedupe_report}")
+    return questions
 
-    logger.info("Building proper noun dictionary")
-    proper_noun_dict = WordDictionary(questions, frequency, max_size=MAX_PROPER_NOUN_DICT_SIZE_BYTES,
-                                      max_word_count=MAX_PROPER_NOUN_DICT_SIZE, proper=True,
-                                      exclusions=list(main_dict.words)[0:100])
-    proper_noun_dict.build()
 
-    logger.info("Encoding questions and dumping")
-    # Dump metadata includes things like offsets of categories, question, counts
-    dump_metadata = questions.dump(join(WORKING_DIR, "questions.bin"), proper_noun_dict, main_dict)
+def category_limit_error(questions):
+    """ Why a QuestionList's categories won't fit in the ROM, or None if they will """
+    if questions.category_count() > MAX_CATEGORIES:
+        return f"Too many categories. There can be a max of {MAX_CATEGORIES}"
+    if questions.category_names_size() > MAX_CATEGORY_NAMES_SIZE:
+        return "Total category name length is too long. Remove some categories, or shorten their names"
+    return None
 
-    logger.info("Dumping dictionaries")
-    main_dict.dump(join(WORKING_DIR, "main_dict.bin"))
-    proper_noun_dict.dump(join(WORKING_DIR, "proper_noun_dict.bin"))
 
-    logger.info("Patching binary")
+def make_dictionaries(questions, dictionary_strategy="frequency", phrases=False, workers=1):
+    """
+    Build (main_dict, proper_noun_dict) for a QuestionList, counting its words in 'workers' processes. See build_rom
+    for the options
+    """
+    logger = logging.getLogger('QADPatch')
+    if dictionary_strategy == "savings":
+        frequency = questions.calculate_word_frequency(workers)
+        logger.info("Building dictionaries by byte savings")
+        main_dict, proper_noun_dict = build_dictionaries(questions, frequency, MAX_MAIN_DICT_SIZE, 2048,
+                                                         MAX_PROPER_NOUN_DICT_SIZE_BYTES, MAX_PROPER_NOUN_DICT_SIZE)
+        if phrases:
+            logger.info("Mining phrases and rebuilding dictionaries")
+            phrase_savings = mine_phrases(questions, proper_noun_dict, main_dict)
+            main_dict, proper_noun_dict = build_dictionaries(questions, frequency, MAX_MAIN_DICT_SIZE, 2048,
+                                                             MAX_PROPER_NOUN_DICT_SIZE_BYTES,
+                                                             MAX_PROPER_NOUN_DICT_SIZE, phrase_savings=phrase_savings)
+    else:
+        logger.info("Building main dictionary")
+        # WordDictionary.build ranks the words itself, and only as far as it needs to
+        frequency = questions.count_words(workers)
+        # Build both dictionaries
+        main_dict = WordDictionary(questions, frequency, max_size=MAX_MAIN_DICT_SIZE, max_word_count=2048,
+                                   proper=False)
+        main_dict.build()
+
+        logger.info("Building proper noun dictionary")
+        proper_noun_dict = WordDictionary(questions, frequency, max_size=MAX_PROPER_NOUN_DICT_SIZE_BYTES,
+                                          max_word_count=MAX_PROPER_NOUN_DICT_SIZE, proper=True,
+                                          exclusions=list(main_dict.words)[0:100])
+        proper_noun_dict.build()
+    return main_dict, proper_noun_dict
+
+
+def patch_rom(rom, questions_bin, dump_metadata, proper_noun_dict, main_dict, rng=random):
+    """
+    Patch encoded questions (from QuestionList.dump_bytes) and their dictionaries into a RomImage, along with the
+    category table and question counts. rng shuffles the category seeds.
+    """
+    main_dict_bin = main_dict.serialize_padded()
+    proper_noun_dict_bin = proper_noun_dict.serialize_padded(max_entries=MAX_PROPER_NOUN_DICT_ENTRIES)
+
+    patch_plan = rom.plan()
     """ Offsets for changing total question count in the random pre-gen (0x1661 by default) """
-    patch("combined.bin", 0x6034, patch_value=dump_metadata["question_count"].to_bytes(2, "big"))
-    patch("combined.bin", 0x604c, patch_value=dump_metadata["question_count"].to_bytes(2, "big"))
-    patch("combined.bin", 0x60b8, patch_value=dump_metadata["question_count"].to_bytes(2, "big"))
-    patch("combined.bin", 0x60c0, patch_value=dump_metadata["question_count"].to_bytes(2, "big"))
+    patch_plan.add(0x6034, dump_metadata["question_count"].to_bytes(2, "big"))
+    patch_plan.add(0x604c, dump_metadata["question_count"].to_bytes(2, "big"))
+    patch_plan.add(0x60b8, dump_metadata["question_count"].to_bytes(2, "big"))
+    patch_plan.add(0x60c0, dump_metadata["question_count"].to_bytes(2, "big"))
 
     # Category random seeds. These should be random numbers from 1 to <number of categories>. 1 byte each"""
     # We want an even distribution of categories, just shuffled around.
@@ -115,62 +199,247 @@ def build_rom():
     total_categories = len(dump_metadata['categories'])
     for i in range(0, 59):
         category_id_rands.append((i % total_categories))
-    random.shuffle(category_id_rands)
+    rng.shuffle(category_id_rands)
 
     # Patch in the seeds
     for i, category_id in enumerate(category_id_rands):
-        patch("combined.bin", 0x25368 + i, patch_value=(category_id + 1).to_bytes(1, 'big'))
+        patch_plan.add(0x25368 + i, (category_id + 1).to_bytes(1, 'big'))
 
     """ Debugging patches for forcing certain categories/questions to be chosen """
-    #patch("combined.bin", 0x5b46, patch_value=b'\x30\x3C\x00\x00') # Always choose category 0
-    #patch("combined.bin", 0x6198, patch_value=b'\x30\x3C\x00\x00') # Always choose question 0 from selected category
+    #patch_plan.add(0x5b46, b'\x30\x3C\x00\x00') # Always choose category 0
+    #patch_plan.add(0x6198, b'\x30\x3C\x00\x00') # Always choose question 0 from selected category
 
-    current_category_name_offset = 0x1DC1E
+    current_category_name_offset = CATEGORY_NAMES_ADDRESS
     for name, info in dump_metadata["categories"].items():
         offset = info["offset"]
         index = info["index"]
         question_count = info["count"]
-        # Patch category offsets
-        patch("combined.bin", 0x1DBE6 + (4 * index), patch_value=(offset + 0x3C82).to_bytes(4, "big"))
+        # Patch category offsets, which are relative to the proper noun dictionary
+        patch_plan.add(CATEGORY_OFFSETS_ADDRESS + (4 * index),
+                       (offset + QUESTIONS_ADDRESS - PROPER_NOUN_DICT_ADDRESS).to_bytes(4, "big"))
         # Patch category question counts
-        patch("combined.bin", 0x1DC9A + (2 * index), patch_value=question_count.to_bytes(2, "big"))
+        patch_plan.add(CATEGORY_COUNTS_ADDRESS + (2 * index), question_count.to_bytes(2, "big"))
         # Patch category name and increase offset
-        patch("combined.bin", current_category_name_offset, patch_value=name.encode("utf-8") + b'\x00')
+        patch_plan.add(current_category_name_offset, name.encode("utf-8") + b'\x00')
         current_category_name_offset += len(name) + 1
 
     # Fill in unused categories with 0s
-    if len(dump_metadata["categories"]) < 14:
-        for i in range(len(dump_metadata["categories"]), 14):
-            patch("combined.bin", 0x1DC9A + (2 * i), patch_value=b'\x00\x00')
+    if len(dump_metadata["categories"]) < MAX_CATEGORIES:
+        for i in range(len(dump_metadata["categories"]), MAX_CATEGORIES):
+            patch_plan.add(CATEGORY_COUNTS_ADDRESS + (2 * i), b'\x00\x00')
 
-    # Patch in generated files
-    patch("combined.bin", 0x29370, patch_fn="questions.bin")
-    patch("combined.bin", 0x256EE, patch_fn="proper_noun_dict.bin")
-    patch("combined.bin", 0x259FC, patch_fn="main_dict.bin")
+    # Patch in generated data
+    patch_plan.add(QUESTIONS_ADDRESS, questions_bin)
+    patch_plan.add(PROPER_NOUN_DICT_ADDRESS, proper_noun_dict_bin)
+    patch_plan.add(MAIN_DICT_ADDRESS, main_dict_bin)
 
     # Value at this address *must* equal len(proper_noun_dict)+1. If there are stubbed out word(s) at the end,
     # those must be included in the count.
-    patch("combined.bin", 0x5E09,
-          patch_value=(len(proper_noun_dict.words) + proper_noun_dict.dummy_words + 1).to_bytes(1, 'big'))
+    patch_plan.add(PROPER_NOUN_COUNT_ADDRESS,
+                   (len(proper_noun_dict.words) + proper_noun_dict.dummy_words + 1).to_bytes(1, 'big'))
 
-    logger.info("Re-assembling qad.zip")
-    split('combined.bin', 'rom1.bin', 'rom2.bin', 0x40000)
-    interleave("rom1.bin", ROM1A, ROM1B)
-    interleave("rom2.bin", ROM2A, ROM2B)
+    rom.apply(patch_plan)
 
-    os.remove(join(WORKING_DIR, "rom1.bin"))
-    os.remove(join(WORKING_DIR, "rom2.bin"))
-    os.remove(join(WORKING_DIR, "combined.bin"))
-    os.remove(join(WORKING_DIR, "main_dict.bin"))
-    os.remove(join(WORKING_DIR, "proper_noun_dict.bin"))
-    os.remove(join(WORKING_DIR, "questions.bin"))
 
-    build_zip()
+def build_rom(optimal=False, dictionary_strategy="frequency", phrases=False, use_cache=True, verify_output=False,
+              workers=1, planner=None, questions_fn="questions.json", pipeline=None, dedupe=None, dedupe_report=None,
+              metrics_fn=None, profile_dir=None, accept_repacked=False, store_only=False, estimate_only=False):
+    """
+        Given qad.zip, process the ROM files as follows, entirely in memory:
+        1. Read the 4 program ROMs out of the zip
+        2. Deinterlace them, one pair at a time, and concatenate into a RomImage
+        3. Apply patches
+        4. Split, interleave and write a new zip alongside the untouched members of the original
 
+        If optimal is set, questions are encoded with the minimum-byte encoder rather than the greedy one.
+        dictionary_strategy "savings" picks dictionary words by byte savings instead of raw frequency. With phrases,
+        repeated multi-word phrases and word fragments are candidates as well as whole words. With use_cache, encoded
+        questions are kept in CACHE_FILE and reused by later builds with the same dictionaries. verify_output decodes
+        every encoded question and stops the build if any don't match their source. With a Packing.PackingPlanner,
+        the planner chooses which questions fill the question list instead of writing them in order until it's full.
+        Questions are read from questions_fn, a JSON array like questions.json, JSON Lines or CSV (see
+        Pipeline.csv_source), or if a Pipeline.Pipeline is given, taken from it as they come out of its last stage.
+        With a dedupe similarity threshold, near duplicate questions are dropped first (see read_questions).
+        Every stage is timed (see Instrument.BuildProfile). With metrics_fn, the timings are written there as JSON
+        along with counters: questions read, dictionary sizes, hits and savings, cache hits, and the compression of
+        each category. With profile_dir, each stage is profiled with cProfile into profile_dir.
+        With accept_repacked, a recompressed clean zip is accepted if its program ROMs match (see read_clean_rom).
+        With store_only, the patched program ROMs are stored in the zip uncompressed, which is faster.
+        With estimate_only, nothing is written: once the dictionaries are built, how much space the questions would
+        take is logged and returned (see Estimator.CapacityEstimator.summary).
+    """
+    logger = logging.getLogger('QADPatch')
+    logger.setLevel(logging.INFO)
+    # Callers like opentdb.py --build may have set up a handler already
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    profile = BuildProfile(profile_dir)
+    rom = read_clean_rom(profile, accept_repacked)
+    with profile.span("read questions"):
+        questions = read_questions(questions_fn, rom.read(BYTE_REFERENCE_TABLE_ADDRESS, 0xc0), optimal=optimal,
+                                   pipeline=pipeline, dedupe=dedupe, dedupe_report=dedupe_report, profile=profile)
+
+    error = category_limit_error(questions)
+    if error:
+        logger.error(f"{error}. Exiting")
+        sys.exit(1)
+
+    with profile.span("dictionaries"):
+        main_dict, proper_noun_dict = make_dictionaries(questions, dictionary_strategy, phrases, workers)
+
+    if estimate_only:
+        summary = CapacityEstimator.for_question_list(questions, proper_noun_dict, main_dict).summary()
+        for line in format_summary(summary):
+            logger.info(line)
+        return summary
+
+    logger.info("Encoding questions and dumping")
+    # Dump metadata includes things like offsets of categories, question, counts
+    cache = EncodeCache(CACHE_FILE) if use_cache else None
+    try:
+        with profile.span("encode"):
+            questions_bin, dump_metadata = questions.dump_bytes(proper_noun_dict, main_dict, cache=cache,
+                                                                 workers=workers, planner=planner)
+    except PackingError as e:
+        logger.error(f"{e.message}. Exiting")
+        sys.exit(1)
+    finally:
+        # Blocks encoded before a failure are still worth keeping for the next build
+        if cache:
+            cache.close()
+    if cache:
+        logger.info(f"Reused {cache.hits} encoded questions from the cache, encoded {cache.misses}")
+        profile.set("cache", {"hits": cache.hits, "misses": cache.misses})
+    if "packing" in dump_metadata:
+        for line in format_report(dump_metadata["packing"]):
+            logger.info(line)
+
+    if verify_output:
+        logger.info("Verifying encoded questions")
+        with profile.span("verify"):
+            mismatches = verify(questions, questions_bin, dump_metadata, proper_noun_dict, main_dict,
+                                workers=workers)
+        for mismatch in mismatches:
+            logger.error(format_mismatch(mismatch, base_address=QUESTIONS_ADDRESS))
+        if mismatches:
+            logger.error(f"Found {len(mismatches)} differences between the encoded questions and their source. Exiting")
+            sys.exit(1)
+
+    logger.info("Patching binary")
+    with profile.span("patch"):
+        patch_rom(rom, questions_bin, dump_metadata, proper_noun_dict, main_dict)
+
+    logger.info("Re-assembling qad.zip")
+    with profile.span("write zip"):
+        rom.write_zip(CLEAN_ROM_DIR, ZIP_FILENAME, OUTPUT_DIR, store_only=store_only)
 
     logger.info(
         f"Build complete. Inserted {dump_metadata['question_count']} questions from {len(dump_metadata['categories'])} categories")
+    for line in profile.format_spans():
+        logger.debug(line)
+
+    if metrics_fn:
+        with profile.span("encoding stats"):
+            stats = questions.encoding_stats(questions_bin, dump_metadata, proper_noun_dict, main_dict)
+        profile.set("questions_inserted", dump_metadata["question_count"])
+        profile.set("dictionaries", stats["dictionaries"])
+        profile.set("categories", stats["categories"])
+        profile.write(metrics_fn)
+        logger.info(f"Wrote build metrics to {metrics_fn}")
 
 
 if __name__ == "__main__":
-    build_rom()
+    parser = argparse.ArgumentParser(description="Build a patched qad.zip from questions.json")
+    parser.add_argument("--questions", default="questions.json",
+                        help="Questions to build from: a JSON array like questions.json, JSON Lines with one "
+                             "question per line, or a .csv file with category, question, answer1, answer2... columns "
+                             "(default: questions.json)")
+    parser.add_argument("--dedupe", type=float, nargs="?", const=DEFAULT_DEDUPE_THRESHOLD, metavar="THRESHOLD",
+                        help="Drop questions that are near duplicates of an earlier one: at least THRESHOLD (0 to 1, "
+                             f"default {DEFAULT_DEDUPE_THRESHOLD}) similar by their text and answers, ignoring case, "
+                             "punctuation and answer order.")
+    parser.add_argument("--dedupe-report", metavar="FILE",
+                        help="With --dedupe, write every cluster of duplicates dropped to FILE as JSON.")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="Write how long each build stage took, peak memory, and dictionary and compression "
+                             "statistics to FILE as JSON.")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="Profile each build stage with cProfile, writing DIR/NN-stage.pstats files.")
+    parser.add_argument("--accept-repacked", action="store_true",
+                        help="Accept a clean qad.zip whose hash doesn't match because it was recompressed, as long as "
+                             "its program ROMs have the clean ROMs' CRC32s.")
+    parser.add_argument("--store", action="store_true",
+                        help="Store the patched program ROMs in qad.zip without compressing them. Faster, for test "
+                             "builds.")
+    parser.add_argument("--estimate", action="store_true",
+                        help="Only estimate how much space the questions take and how many fit, without writing "
+                             "anything.")
+    parser.add_argument("--optimal", action="store_true",
+                        help="Find the smallest encoding of each question instead of greedily replacing the longest "
+                             "dictionary words. Slower, but fits more questions.")
+    parser.add_argument("--dictionaries", choices=["frequency", "savings"], default="frequency",
+                        help="How dictionary words are chosen: by how often they occur (default), or by how many "
+                             "bytes they save.")
+    parser.add_argument("--phrases", action="store_true",
+                        help="Also consider repeated phrases and word fragments for the dictionaries. Requires "
+                             "--dictionaries savings.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Encode every question from scratch instead of reusing ones encoded by earlier builds.")
+    parser.add_argument("--verify", action="store_true",
+                        help="Decode every encoded question and check it matches questions.json before writing the "
+                             "ROM.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes used to count words and encode and verify questions, e.g. "
+                             f"{os.cpu_count() or 1} for one per CPU (default: 1, which does everything in this "
+                             "process)")
+    parser.add_argument("--pack", action="store_true",
+                        help="Choose which questions to include once all of them are encoded, fitting as many as "
+                             "possible, instead of stopping at the first one that doesn't fit.")
+    parser.add_argument("--balance", action="store_true",
+                        help="With --pack, spread the space evenly across categories rather than maximizing the "
+                             "total question count.")
+    parser.add_argument("--min-questions", action="append", default=[], metavar="[CATEGORY=]N",
+                        help="With --pack, include at least N questions from CATEGORY, or from every category if no "
+                             "name is given. Can be repeated.")
+    parser.add_argument("--category-weight", action="append", default=[], metavar="CATEGORY=W",
+                        help="With --pack, count each question from CATEGORY as W (default 1) when choosing what to "
+                             "include. With --balance, categories fill in proportion to their weights. Can be "
+                             "repeated.")
+    args = parser.parse_args()
+    if args.phrases and args.dictionaries != "savings":
+        parser.error("--phrases requires --dictionaries savings")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.dedupe is not None and not 0 < args.dedupe <= 1:
+        parser.error("--dedupe threshold must be between 0 and 1")
+    if args.dedupe_report and args.dedupe is None:
+        parser.error("--dedupe-report requires --dedupe")
+
+    planner = None
+    if args.pack:
+        default_minimum = 0
+        minimums = {}
+        weights = {}
+        try:
+            for value in args.min_questions:
+                category, _, count = value.rpartition("=")
+                if category:
+                    minimums[category] = int(count)
+                else:
+                    default_minimum = int(count)
+            for value in args.category_weight:
+                category, _, weight = value.rpartition("=")
+                if not category:
+                    parser.error(f"--category-weight needs a category name: {value}")
+                weights[category] = float(weight)
+        except ValueError as e:
+            parser.error(f"Bad packing option: {e}")
+        planner = PackingPlanner(minimums=minimums, default_minimum=default_minimum, weights=weights,
+                                 balance=args.balance)
+    elif args.balance or args.min_questions or args.category_weight:
+        parser.error("--balance, --min-questions and --category-weight require --pack")
+    build_rom(optimal=args.optimal, dictionary_strategy=args.dictionaries, phrases=args.phrases,
+              use_cache=not args.no_cache, verify_output=args.verify, workers=args.workers,
+              planner=planner, questions_fn=args.questions, dedupe=args.dedupe, dedupe_report=args.dedupe_report,
+              metrics_fn=args.metrics, profile_dir=args.profile, accept_repacked=args.accept_repacked,
+              store_only=args.store, estimate_only=args.estimate)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+""" Dump the questions (and optionally the dictionaries) of a clean or patched qad.zip to JSON """
+import argparse
+import json
+import os
+import sys
+from zipfile import BadZipFile
+
+from build import BYTE_REFERENCE_TABLE_ADDRESS, CATEGORY_OFFSETS_ADDRESS, CATEGORY_NAMES_ADDRESS, \
+    CATEGORY_COUNTS_ADDRESS, PROPER_NOUN_DICT_ADDRESS, MAIN_DICT_ADDRESS, QUESTIONS_ADDRESS, PROPER_NOUN_COUNT_ADDRESS
+from QADPatch.QuizQuestions import QuestionList, MAX_QUESTION_LIST_SIZE, MAX_CATEGORIES
+from QADPatch.WordDictionary import WordDictionary
+from util import RomImage
+
+
+def read_categories(rom):
+    """ List of (name, offset, count) for every category with questions. Offsets are relative to QUESTIONS_ADDRESS """
+    names_data = rom.read(CATEGORY_NAMES_ADDRESS, CATEGORY_COUNTS_ADDRESS - CATEGORY_NAMES_ADDRESS)
+    names = names_data.split(b'\x00')
+    categories = []
+    for i in range(MAX_CATEGORIES):
+        count = int.from_bytes(rom.read(CATEGORY_COUNTS_ADDRESS + 2 * i, 2), "big")
+        if count == 0:
+            continue
+        # Stored offsets are relative to the proper noun dictionary
+        offset = (int.from_bytes(rom.read(CATEGORY_OFFSETS_ADDRESS + 4 * i, 4), "big") + PROPER_NOUN_DICT_ADDRESS -
+                  QUESTIONS_ADDRESS)
+        categories.append((names[i].decode("utf-8"), offset, count))
+    return categories
+
+
+def read_rom(rom):
+    """ Returns (QuestionList, categories, proper_noun_dict, main_dict) read from a RomImage """
+    questions = QuestionList(rom.read(BYTE_REFERENCE_TABLE_ADDRESS, 0xc0))
+    # The count byte is the number of proper nouns (including dummy padding words) plus one
+    proper_noun_dict = WordDictionary.from_bytes(
+        rom.read(PROPER_NOUN_DICT_ADDRESS, MAIN_DICT_ADDRESS - PROPER_NOUN_DICT_ADDRESS), proper=True,
+        word_count=rom.read(PROPER_NOUN_COUNT_ADDRESS, 1)[0] - 1)
+    main_dict = WordDictionary.from_bytes(rom.read(MAIN_DICT_ADDRESS, QUESTIONS_ADDRESS - MAIN_DICT_ADDRESS),
+                                          word_count=2048)
+    return questions, read_categories(rom), proper_noun_dict, main_dict
+
+
+def dump_questions(rom, keep_line_breaks=False, contents=None):
+    """ Yield every question in the ROM in the same format as questions.json. contents is read_rom(rom), if read """
+    questions, categories, proper_noun_dict, main_dict = contents or read_rom(rom)
+    data = rom.read(QUESTIONS_ADDRESS, MAX_QUESTION_LIST_SIZE)
+    for question in questions.decode(data, categories, proper_noun_dict, main_dict):
+        text = question.question_text
+        if not keep_line_breaks:
+            text = text.replace("\n", " ")
+        yield {"category": question.category, "question": text, "answers": question.answers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dump the questions in a clean or patched qad.zip to JSON")
+    parser.add_argument("zip", nargs="?", default=os.path.join("clean_rom", "qad.zip"),
+                        help="ROM to read (default: clean_rom/qad.zip)")
+    parser.add_argument("-o", "--output", default="questions_dump.json", help="Where to write the questions")
+    parser.add_argument("--keep-line-breaks", action="store_true",
+                        help="Keep the line breaks the questions were wrapped with")
+    parser.add_argument("--dictionaries", help="Also write the proper noun and main dictionaries to this file")
+    args = parser.parse_args()
+
+    try:
+        rom = RomImage.from_zip(os.path.dirname(args.zip), os.path.basename(args.zip))
+    except FileNotFoundError:
+        sys.exit(f"{args.zip} not found.")
+    except (BadZipFile, KeyError) as e:
+        sys.exit(f"Couldn't read the program ROMs from {args.zip}: {e}")
+
+    contents = read_rom(rom)
+    questions = list(dump_questions(rom, keep_line_breaks=args.keep_line_breaks, contents=contents))
+    with open(args.output, "w") as f:
+        json.dump(questions, f, indent=4)
+    print(f"Wrote {len(questions)} questions to {args.output}")
+
+    if args.dictionaries:
+        _, _, proper_noun_dict, main_dict = contents
+        with open(args.dictionaries, "w") as f:
+            json.dump({"proper_nouns": proper_noun_dict.words, "main": main_dict.words}, f, indent=4)
+        print(f"Wrote {len(proper_noun_dict.words)} proper nouns and {len(main_dict.words)} words to "
+              f"{args.dictionaries}")
+
+
+if __name__ == "__main__":
+    main()
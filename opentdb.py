@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import logging
+import os
+import queue
 import requests
+import sqlite3
 import sys
+import threading
 import time
-import re
-from unidecode import unidecode
-import json
 from urllib.parse import unquote
-from typing import List
+
+from QADPatch.Pipeline import Pipeline, Source, Stage, MapStage, JsonSink, normalize, shorten_categories, dedupe
+from QADPatch.Dedupe import NearDuplicateFilter, DEFAULT_THRESHOLD, format_report
 
 # Grab a ton of questions from openTDB
 '''
@@ -53,10 +60,29 @@ SHORTENED_CATEGORIES = {
 # The OpenTDB API allows downloading up to 50 questions per request.
 QUESTION_REQUEST_AMOUNT = 50
 
-# The OpenTDB API limits requests to 1 per IP every 5 seconds.
-# Set this delay (in seconds) longer if you get frequent API rate limit
-# errors.
-API_REQUEST_INTERVAL = 6
+# The OpenTDB API limits requests to 1 per IP every 5 seconds. Requests
+# from every category go through one rate limiter that allows a request
+# every API_REQUEST_INTERVAL seconds. Set this longer if you get frequent
+# API rate limit errors.
+API_REQUEST_INTERVAL = 5.5
+
+# Connection errors and rate limit responses are retried this many times
+# in a row before giving up, waiting CONNECTION_RETRY_DELAY seconds the
+# first time and twice as long each time after that, up to
+# MAX_CONNECTION_RETRY_DELAY.
+MAX_CONNECTION_RETRIES = 5
+CONNECTION_RETRY_DELAY = 5
+MAX_CONNECTION_RETRY_DELAY = 60
+
+# Categories downloaded at the same time. They share the rate limit, so
+# this mostly overlaps waiting on responses with waiting for the limiter.
+CONCURRENT_CATEGORIES = 4
+
+# Raw API responses and download progress are kept here, so an interrupted
+# download picks up where it stopped. Pass --fresh to start over.
+CACHE_FILE = os.path.join("cache", "opentdb.sqlite3")
+
+API_BASE_URL = "https://opentdb.com"
 
 # Some questions in the OpenTDB dataset have accented letters and other
 # characters that are not supported in the Quiz & Dragons font.
@@ -78,208 +104,387 @@ PRINT_INVALID_QUESTIONS = False
 ### No more configurable options after this point.
 
 
-def check_text(text: str | List[str]) -> str:
-    """Check the strings in the argument for invalid characters, which
-    can be a string (a question) or a list of strings (answers).
-    If no errors are found, returns an empty string. Otherwise, returns
-    a string that contains the text with invalid characters.
-    """
+class FetchError(Exception):
+    def __init__(self, message):
+        self.message = message
 
-    allowed_characters = re.compile('^[ !"$%&\'()+,-./0-9:;<=>?A-Z_a-z\{\}“”ʻ’…÷*~]*$')
 
-    if isinstance(text,str):
-        if allowed_characters.fullmatch(text) is None:
-            return f"Question {text} contains invalid characters"
+class TokenBucket:
+    """
+    Token bucket rate limiter. Holds up to 'capacity' requests and refills at 'rate' requests per second, so requests
+    are spaced at least 1 / rate seconds apart once the bucket is empty.
+    """
 
-    elif isinstance(text,list):
-        errors = []
-        for a in text:
-            if allowed_characters.fullmatch(a) is None:
-                errors.append(a)
-        if len(errors) == 1:
-            return f"Answer {errors[0]} contains invalid characters"
-        elif len(errors) > 1:
-            return f"Answers {errors} contain invalid characters"
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
 
-    return ""
+    async def acquire(self):
+        """ Wait until a request is allowed """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
+    def drain(self):
+        """ Empty the bucket, e.g. after being rate limited, so the next request waits a full interval """
+        self.tokens = 0
+        self.updated = time.monotonic()
 
-def fix_str(s, question=False):
-    """ Remove/replace non-ascii chars """
-    s = unidecode(s)
 
-    # Replace pairs of quotes with { } to italicize
-    if question:
-        while True:
-            quotes = re.findall(r'(")', s)
-            ticks = re.findall(r'(`)', s)
-            if len(quotes) >= 2:
-                index = s.index('"')
-                s = s[0:index] + "{" + s[index+1:]
-                index = s.index('"')
-                s = s[0:index] + "}" + s[index + 1:]
-            elif len(ticks) >= 2:
-                index = s.index('`')
-                s = s[0:index] + "{" + s[index+1:]
-                index = s.index('`')
-                s = s[0:index] + "}" + s[index + 1:]
-            else:
-                break
-    return s
+class ResponseCache:
+    """
+    SQLite store of raw API responses, keyed by (category, difficulty, page) where page counts the requests made with
+    the session token for that category and difficulty. Also keeps the session token and each category and
+    difficulty's progress, committed after every page so a download can resume after a crash.
+    """
 
+    def __init__(self, filename):
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (category INTEGER, difficulty TEXT, page INTEGER, "
+                        "body TEXT, PRIMARY KEY (category, difficulty, page))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def get_response(self, category, difficulty, page):
+        row = self.db.execute("SELECT body FROM responses WHERE category = ? AND difficulty = ? AND page = ?",
+                              (category, difficulty, page)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_response(self, category, difficulty, page, response):
+        self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                        (category, difficulty, page, json.dumps(response)))
+        self.db.commit()
+
+    def get_state(self, key, default=None):
+        row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put_state(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, json.dumps(value)))
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute("DELETE FROM responses")
+        self.db.execute("DELETE FROM state")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def opentdb_record(result):
+    """ A question record from an API result, or None for true/false questions, which Quiz & Dragons can't ask """
+    if result["type"] != "multiple":
+        return None
+    record = {
+        "category": unquote(result["category"]),
+        "question": unquote(result["question"].strip()),
+        "answers": [unquote(result["correct_answer"].strip())] +
+                   [unquote(i.strip()) for i in result["incorrect_answers"]]
+    }
+    return record
+
+
+class Fetcher:
+    """
+    Downloads every selected category and difficulty concurrently. Every request waits on one TokenBucket, and every
+    page is cached in a ResponseCache along with how far each category and difficulty has got. Pages cached by earlier
+    runs are replayed instead of requested again, so the output is complete after a resume. Each page's results are
+    passed to on_results(key, results) as they arrive, where key is (category id, difficulty, page), and
+    on_category(category id), if given, is called once all of a category's pages have been. Progress and retries are
+    logged to the QADPatch logger.
+    """
 
-def main():
-    print("Downloading questions")
-    try:
-        r = requests.get("https://opentdb.com/api_token.php?command=request")
-    except requests.ConnectionError as e:
-        print("Cannot connect to OpenTDB API. Wait a few moments and try again.")
-        exit(1)
-    session_token = r.json()["token"]
-
-    questions = []
-    questions_error = []
-    for id in SELECTED_CATEGORY_IDS:
-
-        # Get total number of questions in easy and medium difficulties.
-        url = f"https://opentdb.com/api_count.php?category={id}"
+    def __init__(self, cache, on_results, base_url=API_BASE_URL, interval=API_REQUEST_INTERVAL,
+                 retry_delay=CONNECTION_RETRY_DELAY, max_retries=MAX_CONNECTION_RETRIES, on_category=None):
+        self.cache = cache
+        self.base_url = base_url.rstrip("/")
+        self.bucket = TokenBucket(1 / interval) if interval > 0 else None
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.logger = logging.getLogger('QADPatch')
+        self.token = cache.get_state("token")
+        self.token_lock = asyncio.Lock()
+        self.on_results = on_results
+        self.on_category = on_category
+        self.downloaded = 0
+        self.requests = 0
+
+    async def get(self, path, params=None):
+        """
+        GET an API endpoint as JSON. Connection errors and rate limit responses are each retried up to max_retries
+        times in a row, backing off exponentially (see retry_wait), then raise FetchError
+        """
+        failures = 0
+        rate_limited = 0
         while True:
+            if self.bucket:
+                await self.bucket.acquire()
+            self.requests += 1
             try:
-                r = requests.get(url)
+                r = await asyncio.to_thread(requests.get, f"{self.base_url}/{path}", params=params, timeout=30)
                 j = r.json()
-                print(f"\nDownloading category ID {j['category_id']}.")
-                easy_questions = j["category_question_count"]["total_easy_question_count"]
-                medium_questions = j["category_question_count"]["total_medium_question_count"]
-                print(f"{str(easy_questions)} easy questions and {str(medium_questions)} medium questions in this category.")
-                time.sleep(API_REQUEST_INTERVAL)
-            except requests.ConnectionError as e:
-                print(e)
-                print("Cannot connect to OpenTDB API. Retrying in 5 seconds.")
-                time.sleep(5)
+            except (requests.RequestException, ValueError) as e:
+                failures += 1
+                if failures > self.max_retries:
+                    raise FetchError(f"Cannot connect to OpenTDB API after {failures} attempts: {e}")
+                delay = self.retry_wait(failures)
+                self.logger.warning(f"Cannot connect to OpenTDB API ({e}). Retrying in {delay} seconds.")
+                await asyncio.sleep(delay)
+                continue
+            if j.get("response_code") == 5:
+                rate_limited += 1
+                if rate_limited > self.max_retries:
+                    raise FetchError(f"OpenTDB API is still rate limiting after {rate_limited} attempts")
+                delay = self.retry_wait(rate_limited)
+                self.logger.warning(f"API rate limit reached. Retrying in {delay} seconds.")
+                # Every other request waits out a full interval as well
+                if self.bucket:
+                    self.bucket.drain()
+                await asyncio.sleep(delay)
                 continue
-            break
+            return j
+
+    def retry_wait(self, attempts):
+        """ Seconds to wait before retrying after 'attempts' failures in a row """
+        return min(self.retry_delay * 2 ** (attempts - 1), MAX_CONNECTION_RETRY_DELAY)
+
+    async def new_token(self, expired=None):
+        """ Request a session token, unless another task already replaced the expired one """
+        async with self.token_lock:
+            if self.token is None or self.token == expired:
+                j = await self.get("api_token.php", {"command": "request"})
+                if j.get("response_code") != 0:
+                    raise FetchError(f"Can't get a session token: {j.get('response_message', j.get('response_code'))}")
+                self.token = j["token"]
+                self.cache.put_state("token", self.token)
+        return self.token
+
+    async def fetch_category(self, category_id, semaphore):
+        async with semaphore:
+            # Get total number of questions in easy and medium difficulties.
+            j = self.cache.get_response(category_id, "count", 0)
+            if j is None:
+                j = await self.get("api_count.php", {"category": category_id})
+                if j.get("response_code") == 2:
+                    # An invalid category shouldn't stop the others from downloading
+                    self.logger.warning(f"Skipping category ID {category_id}: "
+                                        f"{j.get('response_message', 'Invalid Parameter')}")
+                    return
+                if "category_question_count" not in j:
+                    raise FetchError(f"Can't count the questions in category {category_id}")
+                self.cache.put_response(category_id, "count", 0, j)
+            counts = j["category_question_count"]
+            self.logger.info(f"Downloading category ID {category_id}: {counts['total_easy_question_count']} easy "
+                             f"questions and {counts['total_medium_question_count']} medium questions.")
+            await asyncio.gather(
+                self.fetch_difficulty(category_id, "easy", counts["total_easy_question_count"]),
+                self.fetch_difficulty(category_id, "medium", counts["total_medium_question_count"]))
+
+    async def fetch_difficulty(self, category_id, difficulty, total):
+        progress_key = f"progress/{category_id}/{difficulty}"
+        # The total number of questions per difficulty reported by the
+        # API is not always accurate. When response code 1 or 4 is returned,
+        # try one more time with 1 fewer question up to twice before
+        # moving on.
+        progress = self.cache.get_state(progress_key, {"page": 0, "remaining": total, "retries": 2, "done": False})
+        for page in range(progress["page"]):
+            j = self.cache.get_response(category_id, difficulty, page)
+            if j:
+                self.on_results((category_id, difficulty, page), j["results"])
+
+        while not progress["done"] and progress["remaining"] > 0:
+            token = self.token or await self.new_token()
+            if progress.get("token") != token:
+                # A new token starts a new session that can return any question again, so start this category and
+                # difficulty over. Questions that were already written are skipped.
+                if progress.get("token"):
+                    self.logger.info(f"Session token changed, restarting category ID {category_id} ({difficulty}).")
+                    progress.update(remaining=total, retries=2)
+                progress["token"] = token
+            amount = min(progress["remaining"], QUESTION_REQUEST_AMOUNT)
+            params = {
+                "token": token,
+                "category": category_id,
+                "difficulty": difficulty,
+                "amount": amount,
+                "encode": "url3986",
+                # "type": "multiple"
+            }
+            j = await self.get("api.php", params)
+            code = j.get("response_code")
+            if code == 3:
+                await self.new_token(token)
+                continue
+            elif code in [1, 4]:
+                if progress["retries"] > 0 and progress["remaining"] > progress["retries"]:
+                    progress["retries"] -= 1
+                    progress["remaining"] -= 1
+                else:
+                    progress["done"] = True
+                self.cache.put_state(progress_key, progress)
+                continue
+            elif code == 2:
+                self.logger.warning(f"Skipping category ID {category_id} ({difficulty}): "
+                                    f"{j.get('response_message', 'Invalid Parameter')}")
+                break
+            elif code != 0:
+                raise FetchError(f"Error from OpenTDB: {j.get('response_message', code)}")
+
+            page = progress["page"]
+            self.cache.put_response(category_id, difficulty, page, j)
+            progress["page"] += 1
+            progress["remaining"] -= amount
+            self.cache.put_state(progress_key, progress)
+            self.on_results((category_id, difficulty, page), j["results"])
+            self.downloaded += len(j["results"])
+            self.logger.info(f"{self.downloaded} questions downloaded.")
+        progress["done"] = True
+        self.cache.put_state(progress_key, progress)
+
+    async def fetch_all(self, category_ids=SELECTED_CATEGORY_IDS):
+        """ Download every category """
+        if self.token is None:
+            await self.new_token()
+        semaphore = asyncio.Semaphore(CONCURRENT_CATEGORIES)
+
+        async def fetch(category_id):
+            await self.fetch_category(category_id, semaphore)
+            if self.on_category:
+                self.on_category(category_id)
+
+        await asyncio.gather(*(fetch(category_id) for category_id in category_ids))
+
+
+def iter_opentdb(cache_fn, fresh, category_ids, base_url, interval):
+    # The download runs in its own thread, with its own event loop and cache connection, and hands each page of
+    # results over as soon as it arrives. Pages come in whatever order their requests finish, so they're held until
+    # their category is complete, and categories are passed on in the order of category_ids, each with its pages in
+    # order. That keeps the output (and which questions fit in the ROM) the same from run to run, while only holding on
+    # to the categories that finish ahead of an earlier one.
+    events = queue.Queue()
+
+    def download():
+        cache = ResponseCache(cache_fn)
+        try:
+            if fresh:
+                cache.clear()
+            fetcher = Fetcher(cache, lambda key, results: events.put((key, results)), base_url=base_url,
+                              interval=interval, on_category=lambda category_id: events.put((category_id, None)))
+            asyncio.run(fetcher.fetch_all(category_ids))
+            events.put(None)
+        except BaseException as e:
+            events.put(e)
+        finally:
+            cache.close()
+
+    threading.Thread(target=download, daemon=True).start()
+    pages = {category_id: [] for category_id in category_ids}
+    complete = set()
+    position = 0
+    while True:
+        event = events.get()
+        if event is None:
+            return
+        if isinstance(event, BaseException):
+            raise event
+        key, results = event
+        if results is not None:
+            pages[key[0]].append((key, results))
+            continue
+        complete.add(key)
+        while position < len(category_ids) and category_ids[position] in complete:
+            # Keys are (category id, difficulty, page), and "easy" sorts before "medium"
+            for _, results in sorted(pages.pop(category_ids[position]), key=lambda page: page[0]):
+                yield from results
+            position += 1
+
+
+def opentdb_source(cache_fn=CACHE_FILE, fresh=False, category_ids=SELECTED_CATEGORY_IDS, base_url=API_BASE_URL,
+                   interval=API_REQUEST_INTERVAL):
+    """
+    Raw API results for every category in category_ids, downloaded (or replayed from cache_fn) by a Fetcher, one
+    whole category at a time in the order of category_ids
+    """
+    return Source("opentdb", iter_opentdb(cache_fn, fresh, category_ids, base_url, interval))
 
-        for difficulty in ["easy","medium"]:
-            if difficulty == "easy":
-                remaining_questions = easy_questions
-            elif difficulty == "medium":
-                remaining_questions = medium_questions
 
-            # The total number of questions per difficulty reported by the
-            # API is not always accurate. When response code 4 is returned,
-            # try one more time with 1 fewer question up to twice before
-            # continuing with the next difficulty.
-            retries = 2
+def opentdb_pipeline(source, dedupe_filter=None):
+    """ The stages that turn API results into questions.json records, optionally ending with a NearDuplicateFilter """
+    stages = [
+        MapStage("decode", opentdb_record),
+        shorten_categories(SHORTENED_CATEGORIES),
+        normalize(check_questions=FILTER_INVALID_CHARACTERS_IN_QUESTIONS,
+                  check_answers=FILTER_INVALID_CHARACTERS_IN_ANSWERS, print_invalid=PRINT_INVALID_QUESTIONS),
+        # After a new session token the API can return questions again
+        dedupe(),
+    ]
+    if dedupe_filter is not None:
+        stages.append(Stage("near dedupe", dedupe_filter))
+    return Pipeline(source, stages)
 
-            while True:
-                if remaining_questions == 0:
-                    break
-                if remaining_questions >= QUESTION_REQUEST_AMOUNT:
-                    next_questions = QUESTION_REQUEST_AMOUNT
-                else:
-                    next_questions = remaining_questions
-
-                params = {
-                    "token": session_token,
-                    "category": id,
-                    "difficulty": difficulty,
-                    "amount": next_questions,
-                    "encode": "url3986",
-                    # "type": "multiple"
-                }
-                url = "https://opentdb.com/api.php"
-                try:
-                    r = requests.get(url, params=params)
-                except requests.ConnectionError as e:
-                    print(e)
-                    print("Cannot connect to OpenTDB API. Retrying in 5 seconds.")
-                    time.sleep(5)
-                    continue
 
-                j = r.json()
-                if j["response_code"] in [1, 2, 3]:
-                    sys.exit("Error from OpenTDB: %s" % j["response_message"])
-                elif j["response_code"] == 4:
-                    time.sleep(API_REQUEST_INTERVAL)
-                    if retries > 0 and remaining_questions > retries:
-                        retries -= 1
-                        remaining_questions -= 1
-                        continue
-                    else:
-                        break
-
-                # If a rate limit is reached, wait 5 seconds before the next request.
-                elif j["response_code"] == 5:
-                    print("API rate limit reached. Waiting 5 seconds.")
-                    time.sleep(5)
-                    continue
-
-                for question in j["results"]:
-                    if question["type"] != "multiple":
-                        continue
-
-                    error = ""
-                    error2 = ""
-                    category = unquote(question["category"])
-                    # Category needs to be short
-                    category = category.split(":")[-1].strip()
-                    # For some categories, shorten them even more
-                    if category in SHORTENED_CATEGORIES:
-                        category = SHORTENED_CATEGORIES[category]
-                    text = unquote(question["question"].strip())
-                    if FILTER_INVALID_CHARACTERS_IN_QUESTIONS:
-                        error = check_text(text)
-                        if error != "" and PRINT_INVALID_QUESTIONS:
-                            print(f"Warning: In category {category}, question '{text}' has invalid characters.")
-                    else:
-                        text = fix_str(text,question=True)
-
-                    answers = [unquote(question["correct_answer"].strip())] + [unquote(i.strip()) for i in question["incorrect_answers"]]
-                    if FILTER_INVALID_CHARACTERS_IN_ANSWERS:
-                        error2 = check_text(answers)
-                        if error2 != "" and PRINT_INVALID_QUESTIONS:
-                            print(f"Warning: In category {category}, question '{text}' has answers with invalid characters.\nAnswers: {answers}")
-                            if error != "":
-                                error += "\n" + error2
-                            else:
-                                error = error2
-                    else:
-                        answers = [fix_str(i) for i in answers]
-
-                    if error == "":
-                        question_dict = {
-                            "category": category,
-                            "question": text,
-                            "answers": answers
-                        }
-                    else:
-                        question_dict = {
-                            "category": category,
-                            "question": text,
-                            "answers": answers,
-                            "error" : error
-                        }
-
-                    if error == "":
-                        questions.append(question_dict)
-                    else:
-                        questions_error.append(question_dict)
-
-                print(f"{len(questions)} questions added.")
-                remaining_questions -= next_questions
-                time.sleep(API_REQUEST_INTERVAL)
-
-    with open("questions.json", "w") as f:
-        questions_sorted = sorted(questions, key=lambda q: q['category'])
-        json.dump(questions_sorted, f, indent=4)
-    if questions_error:
-        with open("questions_error.json", "w", encoding="utf8") as f:
-            questions_sorted = sorted(questions_error, key=lambda q: q['category'])
-            json.dump(questions_sorted, f, ensure_ascii=False, indent=4)
-
-    print(f"\nWrote {len(questions)} questions to questions.json.")
-    print(f"Wrote {len(questions_error)} questions with errors to questions_error.json. You can review these questions, manually correct them, and insert them into questions.json.")
+def main():
+    parser = argparse.ArgumentParser(description="Download questions from OpenTDB into questions.json")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Ignore responses cached by earlier runs and download everything again")
+    parser.add_argument("--cache", default=CACHE_FILE, help=f"Response cache (default: {CACHE_FILE})")
+    parser.add_argument("--base-url", default=API_BASE_URL,
+                        help="API to download from, e.g. a local opentdb_stub.py server")
+    parser.add_argument("--interval", type=float, default=API_REQUEST_INTERVAL,
+                        help=f"Seconds between requests (default: {API_REQUEST_INTERVAL})")
+    parser.add_argument("--build", action="store_true",
+                        help="Build patched/qad.zip straight from the downloaded questions instead of writing "
+                             "questions.json. Questions with errors are skipped.")
+    parser.add_argument("--dedupe", type=float, nargs="?", const=DEFAULT_THRESHOLD, metavar="THRESHOLD",
+                        help="Also drop questions that are near duplicates of an earlier one, at least THRESHOLD (0 to "
+                             f"1, default {DEFAULT_THRESHOLD}) similar")
+    parser.add_argument("--stats", action="store_true", help="Print how many questions each step handled, and how fast")
+    args = parser.parse_args()
+    if args.dedupe is not None and not 0 < args.dedupe <= 1:
+        parser.error("--dedupe threshold must be between 0 and 1")
+
+    logger = logging.getLogger('QADPatch')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    print("Downloading questions")
+    dedupe_filter = NearDuplicateFilter(args.dedupe) if args.dedupe else None
+    pipeline = opentdb_pipeline(opentdb_source(args.cache, fresh=args.fresh, base_url=args.base_url,
+                                               interval=args.interval), dedupe_filter)
+    try:
+        if args.build:
+            import build
+            build.build_rom(pipeline=pipeline)
+        else:
+            question_count, error_count = pipeline.run(JsonSink("questions.json", "questions_error.json"))
+    except FetchError as e:
+        sys.exit(f"{e.message}. Downloaded pages are cached in {args.cache}, run again to resume.")
+    except KeyboardInterrupt:
+        sys.exit(f"Stopped. Downloaded pages are cached in {args.cache}, run again to resume.")
+
+    if dedupe_filter is not None:
+        print()
+        for line in format_report(dedupe_filter, limit=5):
+            print(line)
+    if args.stats:
+        print()
+        for line in pipeline.report():
+            print(line)
+    if not args.build:
+        print(f"\nWrote {question_count} questions to questions.json.")
+        print(f"Wrote {error_count} questions with errors to questions_error.json. You can review these questions, manually correct them, and insert them into questions.json.")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenTDB API, for running opentdb.py offline. It serves generated questions from the same
+endpoints and simulates the API's response codes:
+    0 Success
+    1 No Results: more questions asked for than exist for the category and difficulty
+    2 Invalid Parameter: unknown category or difficulty, or more than 50 questions asked for
+    3 Token Not Found: unknown token, or one that has been idle too long (see --token-timeout)
+    4 Token Empty: fewer unseen questions left for the token than asked for
+    5 Rate Limit: a request less than --interval seconds after the last one, or at random (see --fail-rate)
+
+    ./opentdb_stub.py --port 8000 --interval 0.1 &
+    ./opentdb.py --base-url http://localhost:8000 --interval 0.1
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote
+
+CATEGORY_NAMES = {
+    9: "General Knowledge", 10: "Entertainment: Books", 11: "Entertainment: Film", 12: "Entertainment: Music",
+    13: "Entertainment: Musicals & Theatres", 14: "Entertainment: Television", 15: "Entertainment: Video Games",
+    16: "Entertainment: Board Games", 17: "Science & Nature", 18: "Science: Computers", 19: "Science: Mathematics",
+    20: "Mythology", 21: "Sports", 22: "Geography", 23: "History", 24: "Politics", 25: "Art", 26: "Celebrities",
+    27: "Animals", 28: "Vehicles", 29: "Entertainment: Comics", 30: "Science: Gadgets",
+    31: "Entertainment: Japanese Anime & Manga", 32: "Entertainment: Cartoon & Animations",
+}
+DIFFICULTIES = ["easy", "medium", "hard"]
+MAX_AMOUNT = 50
+
+
+def generate_questions(per_difficulty, seed=0):
+    """ {(category id, difficulty): [API result]}. About one in five is a true/false question """
+    rng = random.Random(seed)
+    words = ["river", "castle", "planet", "Dragon", "wizard", "ocean", "Paris", "engine", "melody", "island", "tower",
+             "Einstein", "forest", "crown", "galaxy", "Mozart", "desert", "knight", "volcano", "library"]
+    questions = {}
+    for category_id, name in CATEGORY_NAMES.items():
+        for difficulty in DIFFICULTIES:
+            results = []
+            for n in range(per_difficulty):
+                text = f"Which {rng.choice(words)} is linked to the {rng.choice(words)} #{category_id}-{difficulty}-{n}?"
+                if rng.random() < 0.2:
+                    answers = ["True", ["False"]]
+                    question_type = "boolean"
+                else:
+                    answers = [rng.choice(words), rng.sample(words, 3)]
+                    question_type = "multiple"
+                results.append({
+                    "type": question_type,
+                    "difficulty": difficulty,
+                    "category": quote(name, safe=""),
+                    "question": quote(text, safe=""),
+                    "correct_answer": quote(answers[0], safe=""),
+                    "incorrect_answers": [quote(a, safe="") for a in answers[1]],
+                })
+            questions[(category_id, difficulty)] = results
+    return questions
+
+
+class StubState:
+    """ Questions and tokens shared by every request the stub server handles """
+
+    def __init__(self, per_difficulty=120, interval=0.0, fail_rate=0.0, token_timeout=6 * 3600, overcount=1, seed=0):
+        self.questions = generate_questions(per_difficulty, seed)
+        self.interval = interval
+        self.fail_rate = fail_rate
+        self.token_timeout = token_timeout
+        # The real API's counts aren't always accurate, so the stub over-reports by this much
+        self.overcount = overcount
+        self.rng = random.Random(seed)
+        self.tokens = {}  # token -> {"served": {(category, difficulty): count}, "used": time last used}
+        self.last_request = 0.0
+        self.lock = threading.Lock()
+        self.response_codes = {code: 0 for code in range(6)}
+
+    def respond(self, path, params):
+        with self.lock:
+            response = self.route(path, params)
+            self.response_codes[response.get("response_code", 0)] += 1
+            return response
+
+    def route(self, path, params):
+        now = time.monotonic()
+        if now - self.last_request < self.interval or self.rng.random() < self.fail_rate:
+            return {"response_code": 5, "response_message": "Rate Limit Too many requests have occurred."}
+        self.last_request = now
+
+        if path == "/api_token.php":
+            if params.get("command") == "request":
+                token = uuid.uuid4().hex
+                self.tokens[token] = {"served": {}, "used": now}
+                return {"response_code": 0, "response_message": "Token Generated Successfully!", "token": token}
+            if params.get("command") == "reset" and params.get("token") in self.tokens:
+                self.tokens[params["token"]] = {"served": {}, "used": now}
+                return {"response_code": 0, "token": params["token"]}
+            return {"response_code": 3, "response_message": "Token Not Found"}
+
+        if path == "/api_count.php":
+            try:
+                category_id = int(params.get("category", ""))
+            except ValueError:
+                category_id = None
+            if category_id not in CATEGORY_NAMES:
+                return {"response_code": 2, "response_message": "Invalid Parameter"}
+            counts = {f"total_{difficulty}_question_count": len(self.questions[(category_id, difficulty)]) +
+                      self.overcount for difficulty in DIFFICULTIES}
+            counts["total_question_count"] = sum(counts.values())
+            return {"category_id": category_id, "category_question_count": counts}
+
+        if path == "/api.php":
+            return self.questions_response(params, now)
+        return {"response_code": 2, "response_message": "Invalid Parameter"}
+
+    def questions_response(self, params, now):
+        try:
+            category_id = int(params.get("category", ""))
+            amount = int(params.get("amount", ""))
+        except ValueError:
+            return {"response_code": 2, "response_message": "Invalid Parameter"}
+        difficulty = params.get("difficulty")
+        if category_id not in CATEGORY_NAMES or difficulty not in DIFFICULTIES or not 0 < amount <= MAX_AMOUNT:
+            return {"response_code": 2, "response_message": "Invalid Parameter"}
+
+        token = self.tokens.get(params.get("token"))
+        if token is None or now - token["used"] > self.token_timeout:
+            # Like the real API, tokens are deleted after being idle for a while
+            self.tokens.pop(params.get("token"), None)
+            return {"response_code": 3, "response_message": "Token Not Found"}
+        token["used"] = now
+
+        available = self.questions[(category_id, difficulty)]
+        if amount > len(available):
+            return {"response_code": 1, "response_message": "No Results"}
+        served = token["served"].get((category_id, difficulty), 0)
+        if served + amount > len(available):
+            return {"response_code": 4, "response_message": "Token Empty"}
+        token["served"][(category_id, difficulty)] = served + amount
+        return {"response_code": 0, "results": available[served:served + amount]}
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            body = json.dumps(state.respond(url.path, params)).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=0, **options):
+    """
+    Start a stub server on localhost in a background thread. Options are passed to StubState. Returns (server, state);
+    the server's URL is http://localhost:{server.server_port}. Call server.shutdown() to stop it.
+    """
+    state = StubState(**options)
+    server = ThreadingHTTPServer(("localhost", port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the OpenTDB API")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--questions", type=int, default=120, help="Questions per category and difficulty")
+    parser.add_argument("--interval", type=float, default=5.0,
+                        help="Answer with code 5 if requests come less than this many seconds apart (default: 5)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests to answer with code 5")
+    parser.add_argument("--token-timeout", type=float, default=6 * 3600,
+                        help="Seconds a token can be idle before it's deleted (default: 6 hours, like the real API)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server, state = serve(args.port, per_difficulty=args.questions, interval=args.interval, fail_rate=args.fail_rate,
+                          token_timeout=args.token_timeout, seed=args.seed)
+    print(f"Serving a stub OpenTDB API on http://localhost:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"Response codes sent: {state.response_codes}")
+
+
+if __name__ == "__main__":
+    main()
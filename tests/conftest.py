@@ -0,0 +1,30 @@
+import sys
+from os.path import dirname, abspath
+
+import pytest
+
+# The build scripts and QADPatch are imported from the repository root, as build.py does
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import benchmark
+import build
+from QADPatch.QuizQuestions import QuestionList
+
+# Made-up questions (see benchmark.synthetic_corpus) and the byte reference table used when there's no clean ROM
+CORPUS_RECORDS = benchmark.synthetic_corpus(200, categories=4, vocabulary=600, seed=1)
+BYTE_REFERENCE_TABLE = benchmark.stand_in_byte_reference_table()
+
+
+def make_question_list(records=CORPUS_RECORDS, optimal=False):
+    questions = QuestionList(BYTE_REFERENCE_TABLE, optimal=optimal)
+    for record in records:
+        questions.add(record["category"], record["question"], record["answers"])
+    return questions
+
+
+@pytest.fixture(scope="session")
+def corpus():
+    """ (QuestionList of the synthetic corpus, main dictionary, proper noun dictionary), built like build_rom does """
+    questions = make_question_list()
+    main_dict, proper_noun_dict = build.make_dictionaries(questions)
+    return questions, main_dict, proper_noun_dict
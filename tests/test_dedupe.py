@@ -0,0 +1,42 @@
+from QADPatch.Dedupe import NearDuplicateFilter
+
+
+def record(question, answers, category="Geography"):
+    return {"category": category, "question": question, "answers": answers}
+
+
+def test_exact_duplicates_are_dropped():
+    dedupe = NearDuplicateFilter()
+    records = [record("What is the capital of France?", ["Paris", "Rome", "Berlin", "Madrid"]),
+               record("What is the capital of France?", ["Paris", "Madrid", "Rome", "Berlin"])]
+    assert list(dedupe(records)) == records[:1]
+    assert dedupe.exact_duplicates == 1
+    assert dedupe.report()[0]["duplicates"][0]["similarity"] == 1.0
+
+
+def test_a_different_correct_answer_is_not_a_duplicate():
+    dedupe = NearDuplicateFilter()
+    records = [record("What is the capital of France?", ["Paris", "Lyon", "Berlin", "Madrid"]),
+               record("What is the capital of France?", ["Lyon", "Paris", "Berlin", "Madrid"]),
+               record("Which planet is the largest?", ["Jupiter", "Mercury", "Mars", "Venus"]),
+               record("Which planet is the smallest?", ["Mercury", "Jupiter", "Mars", "Venus"])]
+    assert list(dedupe(records)) == records
+    assert dedupe.exact_duplicates == 0
+    assert dedupe.near_duplicates == 0
+
+
+def test_near_duplicates_are_dropped():
+    dedupe = NearDuplicateFilter()
+    records = [record("Which planet in our solar system is the largest?", ["Jupiter", "Mercury", "Mars", "Venus"]),
+               record("Which planet in our solar system is the largest", ["Jupiter", "Mars", "Mercury", "Venus"]),
+               record("Which planet in the solar system is the largest?", ["Jupiter", "Mercury", "Mars", "Venus"])]
+    assert list(dedupe(records)) == records[:1]
+    assert dedupe.exact_duplicates == 1
+    assert dedupe.near_duplicates == 1
+
+
+def test_rejected_records_pass_through():
+    dedupe = NearDuplicateFilter()
+    records = [record("What is the capital of France?", ["Paris", "Rome", "Berlin", "Madrid"]),
+               dict(record("What is the capital of France?", ["Paris", "Rome", "Berlin", "Madrid"]), error=True)]
+    assert list(dedupe(records)) == records
@@ -0,0 +1,32 @@
+import benchmark
+import build
+from dump_rom import dump_questions, read_rom
+
+
+def expected_questions(questions):
+    """ (category, question text, answers) of every question, as dump_bytes writes them """
+    return [(q.category, q.wrap().rstrip("?").rstrip(), q.answers) for q in questions.sorted_questions()]
+
+
+def test_decode_round_trip(corpus):
+    questions, main_dict, proper_noun_dict = corpus
+    data, metadata = questions.dump_bytes(proper_noun_dict, main_dict)
+    categories = [(name, info["offset"], info["count"]) for name, info in metadata["categories"].items()]
+    decoded = [(q.category, q.question_text, q.answers)
+               for q in questions.decode(data, categories, proper_noun_dict, main_dict)]
+    assert decoded == expected_questions(questions)
+
+
+def test_dump_patched_rom(tmp_path, corpus):
+    questions, main_dict, proper_noun_dict = corpus
+    rom = benchmark.fake_rom(tmp_path)
+    data, metadata = questions.dump_bytes(proper_noun_dict, main_dict)
+    build.patch_rom(rom, data, metadata, proper_noun_dict, main_dict)
+
+    _, categories, rom_proper_noun_dict, rom_main_dict = read_rom(rom)
+    assert [name for name, _, _ in categories] == list(metadata["categories"])
+    assert rom_proper_noun_dict.words[:len(proper_noun_dict.words)] == proper_noun_dict.words
+    assert rom_main_dict.words[:len(main_dict.words)] == main_dict.words
+    dumped = [(q["category"], q["question"], q["answers"]) for q in dump_questions(rom)]
+    assert dumped == [(category, text.replace("\n", " "), answers)
+                      for category, text, answers in expected_questions(questions)]
@@ -0,0 +1,74 @@
+import itertools
+
+import pytest
+
+from QADPatch.EncodeCache import EncodeCache
+from QADPatch.QuizQuestions import QuestionList
+from QADPatch.WordDictionary import WordDictionary
+from conftest import BYTE_REFERENCE_TABLE
+
+
+def copy_dictionary(dictionary, words):
+    copy = WordDictionary(None, {}, dictionary.max_size, dictionary.max_word_count, proper=dictionary.proper)
+    copy.words = list(words)
+    return copy
+
+
+def encode(questions, proper_noun_dict, main_dict, filename):
+    cache = EncodeCache(filename)
+    blocks = questions.encode_questions(questions.sorted_questions(), proper_noun_dict, main_dict, cache=cache)
+    cache.close()
+    return blocks, cache.hits, cache.misses
+
+
+def test_rebuild_reuses_blocks(tmp_path, corpus):
+    questions, main_dict, proper_noun_dict = corpus
+    blocks, hits, misses = encode(questions, proper_noun_dict, main_dict, tmp_path / "cache.sqlite3")
+    assert (hits, misses) == (0, len(questions.store))
+    cached_blocks, hits, misses = encode(questions, proper_noun_dict, main_dict, tmp_path / "cache.sqlite3")
+    assert (hits, misses) == (len(questions.store), 0)
+    assert cached_blocks == blocks
+
+
+@pytest.mark.parametrize("change", ["main", "proper", "table", "optimal"])
+def test_changing_the_encoding_misses(tmp_path, corpus, change):
+    questions, main_dict, proper_noun_dict = corpus
+    blocks, _, _ = encode(questions, proper_noun_dict, main_dict, tmp_path / "cache.sqlite3")
+
+    if change == "main":
+        main_dict = copy_dictionary(main_dict, main_dict.words[1:])
+    elif change == "proper":
+        proper_noun_dict = copy_dictionary(proper_noun_dict, proper_noun_dict.words[:-1])
+    elif change == "table" or change == "optimal":
+        table = bytearray(BYTE_REFERENCE_TABLE)
+        if change == "table":
+            # Swap which bytes stand for the first two proper nouns
+            first, second = table.index(1), table.index(2)
+            table[first], table[second] = 2, 1
+        changed = QuestionList(bytes(table), optimal=change == "optimal")
+        for row in questions.store.rows():
+            changed.add(*row)
+        questions = changed
+    changed_blocks, hits, misses = encode(questions, proper_noun_dict, main_dict, tmp_path / "cache.sqlite3")
+    assert (hits, misses) == (0, len(questions.store))
+    assert changed_blocks == questions.encode_questions(questions.sorted_questions(), proper_noun_dict, main_dict)
+    assert changed_blocks != blocks
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr("QADPatch.EncodeCache.time.time", lambda: next(clock))
+    filename = tmp_path / "cache.sqlite3"
+    cache = EncodeCache(filename)
+    for key in ["a", "b", "c"]:
+        cache.put(key, b"x" * 99)
+    cache.close()
+
+    # Each entry counts 100 bytes. Using "a" makes "b" the least recently used, so it's the one that goes
+    cache = EncodeCache(filename, max_bytes=250)
+    assert cache.get("a") == b"x" * 99
+    cache.close()
+
+    cache = EncodeCache(filename)
+    assert [cache.get(key) is not None for key in ["a", "b", "c"]] == [True, False, True]
+    cache.close()
@@ -0,0 +1,84 @@
+import pytest
+
+from QADPatch import QuizQuestions
+from QADPatch.Estimator import CapacityEstimator
+from conftest import make_question_list
+
+
+def layout(questions, proper_noun_dict, main_dict, capacity, monkeypatch):
+    """ (questions written, store index of the first one dropped or None, bytes used) for a build with capacity """
+    monkeypatch.setattr(QuizQuestions, "MAX_QUESTION_LIST_SIZE", capacity)
+    data, metadata = questions.dump_bytes(proper_noun_dict, main_dict)
+    written = metadata["question_count"]
+    ordered = questions.sorted_questions()
+    return written, ordered[written].index if written < len(ordered) else None, len(data.rstrip(b"\x00"))
+
+
+def edited(questions, index, category=None, question_text=None):
+    """ A copy of questions with one of them changed in place """
+    copy = make_question_list([])
+    for n, (row_category, row_text, answers) in enumerate(questions.store.rows()):
+        if n == index:
+            row_category, row_text = category or row_category, question_text or row_text
+        copy.add(row_category, row_text, answers)
+    return copy
+
+
+@pytest.mark.parametrize("fraction", [0.5, 0.9, 2])
+def test_fitted_matches_layout(corpus, monkeypatch, fraction):
+    questions, main_dict, proper_noun_dict = corpus
+    estimator = CapacityEstimator.for_question_list(questions, proper_noun_dict, main_dict)
+    assert len(estimator.questions) == len(questions.store)
+    capacity = int(estimator.used_bytes() * fraction)
+    estimator.capacity = capacity
+    written, first_dropped, used = layout(questions, proper_noun_dict, main_dict, capacity, monkeypatch)
+    # Keys count up from 0 in store order
+    assert estimator.fitted() == (written, first_dropped)
+    if first_dropped is None:
+        assert estimator.used_bytes() == used
+
+
+def test_add_and_remove(corpus):
+    questions, main_dict, proper_noun_dict = corpus
+    estimator = CapacityEstimator(questions, proper_noun_dict, main_dict)
+    key, estimate = estimator.add("Geography", "What is the capital of France?", ["Paris", "Lyon", "Nice", "Metz"])
+    assert estimator.used_bytes() == estimate["bytes"]
+    other, _ = estimator.add("History", "Who was the first Roman emperor?", ["Augustus", "Nero", "Caesar", "Otho"])
+    assert estimator.used_bytes() == estimate["bytes"] + estimator.questions[other]["bytes"] + 1
+    assert estimator.remove(key) == estimate
+    assert list(estimator.categories) == ["History"]
+    estimator.remove(other)
+    assert (estimator.used_bytes(), estimator.fitted()) == (0, (0, None))
+
+    key, estimate = estimator.add("Geography", "Too long " * 40, ["Paris", "Lyon", "Nice", "Metz"])
+    assert key is None and estimate["errors"]
+    assert not estimator.questions
+
+
+@pytest.mark.parametrize("category", [None, "Moved"])
+def test_replace_keeps_the_question_in_place(corpus, monkeypatch, category):
+    questions, main_dict, proper_noun_dict = corpus
+    estimator = CapacityEstimator.for_question_list(questions, proper_noun_dict, main_dict)
+    estimator.capacity = capacity = estimator.used_bytes() // 2
+    _, first_dropped = estimator.fitted()
+    # Edit the first question of the category the build stops in
+    first_dropped_category = estimator.questions[first_dropped]["category"]
+    key = next(iter(estimator.categories[first_dropped_category]))
+    new_text = questions.store[key].question_text.rstrip("?") + " then?"
+    new_category = category or first_dropped_category
+    assert estimator.replace(key, new_category, new_text, questions.store[key].answers)[0] == key
+
+    written, first_dropped, _ = layout(edited(questions, key, category, new_text), proper_noun_dict, main_dict,
+                                       capacity, monkeypatch)
+    assert estimator.fitted() == (written, first_dropped)
+    for sizes in estimator.categories.values():
+        assert list(sizes) == sorted(sizes)
+
+
+def test_replace_with_errors_keeps_the_old_version(corpus):
+    questions, main_dict, proper_noun_dict = corpus
+    estimator = CapacityEstimator.for_question_list(questions, proper_noun_dict, main_dict)
+    summary = estimator.summary()
+    key, estimate = estimator.replace(3, questions.store[3].category, "Too long " * 40, questions.store[3].answers)
+    assert key is None and estimate["errors"]
+    assert estimator.summary() == summary
@@ -0,0 +1,182 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+import opentdb
+import opentdb_stub
+from opentdb import Fetcher, FetchError, ResponseCache, TokenBucket
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**options):
+        server, state = opentdb_stub.serve(**options)
+        servers.append(server)
+        return f"http://localhost:{server.server_port}", state
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def fetch(cache_fn, base_url, category_ids=(9,), interval=0, **options):
+    """ Run a Fetcher over category_ids. Returns (results, fetcher) """
+    results = []
+    cache = ResponseCache(str(cache_fn))
+    try:
+        fetcher = Fetcher(cache, lambda key, page: results.extend(page), base_url=base_url, interval=interval,
+                          **options)
+        asyncio.run(fetcher.fetch_all(list(category_ids)))
+    finally:
+        cache.close()
+    return results, fetcher
+
+
+def expected(state, category_ids=(9,)):
+    return [result for category_id in category_ids for difficulty in ["easy", "medium"]
+            for result in state.questions[(category_id, difficulty)]]
+
+
+def same_results(a, b):
+    return sorted(r["question"] for r in a) == sorted(r["question"] for r in b)
+
+
+def test_success(stub, tmp_path):
+    base_url, state = stub(per_difficulty=30, overcount=0)
+    results, fetcher = fetch(tmp_path / "cache.sqlite3", base_url, category_ids=(9, 10))
+    assert same_results(results, expected(state, (9, 10)))
+    assert state.response_codes[0] == fetcher.requests
+
+
+def test_no_results_retries_with_fewer(stub, tmp_path):
+    # The count is one too high, so asking for all of them gets code 1
+    base_url, state = stub(per_difficulty=10, overcount=1)
+    results, fetcher = fetch(tmp_path / "cache.sqlite3", base_url)
+    assert state.response_codes[1] == 2
+    assert same_results(results, expected(state))
+
+
+def test_invalid_parameter_skips_category(stub, tmp_path):
+    base_url, state = stub(per_difficulty=10, overcount=0)
+    results, fetcher = fetch(tmp_path / "cache.sqlite3", base_url, category_ids=(99, 9))
+    assert state.response_codes[2] == 1
+    assert same_results(results, expected(state))
+
+
+def test_invalid_amount_skips_difficulty(stub, tmp_path, monkeypatch):
+    monkeypatch.setattr(opentdb, "QUESTION_REQUEST_AMOUNT", opentdb_stub.MAX_AMOUNT + 1)
+    base_url, state = stub(per_difficulty=60, overcount=0)
+    results, fetcher = fetch(tmp_path / "cache.sqlite3", base_url)
+    assert state.response_codes[2] == 2
+    assert results == []
+
+
+def test_token_not_found_gets_new_token(stub, tmp_path):
+    base_url, state = stub(per_difficulty=10, overcount=0)
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"))
+    cache.put_state("token", "expired")
+    cache.close()
+    results, fetcher = fetch(tmp_path / "cache.sqlite3", base_url)
+    assert state.response_codes[3] >= 1
+    assert fetcher.token != "expired"
+    assert same_results(results, expected(state))
+
+
+def test_token_empty_retries_with_fewer(stub, tmp_path):
+    # 50 are asked for, then the 11 left by the count, of which only 10 are left for the token
+    base_url, state = stub(per_difficulty=60, overcount=1)
+    results, fetcher = fetch(tmp_path / "cache.sqlite3", base_url)
+    assert state.response_codes[4] == 2
+    assert same_results(results, expected(state))
+
+
+def test_rate_limit_is_retried(stub, tmp_path):
+    base_url, state = stub(per_difficulty=10, overcount=0, fail_rate=0.3, seed=1)
+    results, fetcher = fetch(tmp_path / "cache.sqlite3", base_url, retry_delay=0.001)
+    assert state.response_codes[5] > 0
+    assert same_results(results, expected(state))
+
+
+def test_rate_limit_backs_off_then_fails(stub, tmp_path, monkeypatch):
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+
+    monkeypatch.setattr(opentdb.asyncio, "sleep", sleep)
+    base_url, state = stub(per_difficulty=10, overcount=0, fail_rate=1)
+    with pytest.raises(FetchError, match="rate limiting"):
+        fetch(tmp_path / "cache.sqlite3", base_url, retry_delay=1, max_retries=3)
+    assert slept == [1, 2, 4]
+    assert state.response_codes[5] == 4
+
+
+def test_token_bucket_spaces_requests(stub, tmp_path):
+    # The stub answers code 5 to requests less than 0.05 seconds apart
+    base_url, state = stub(per_difficulty=10, overcount=0, interval=0.05)
+    results, fetcher = fetch(tmp_path / "cache.sqlite3", base_url, interval=0.1)
+    assert state.response_codes[5] == 0
+    assert same_results(results, expected(state))
+
+
+def test_token_bucket_rate():
+    async def acquire(bucket, n):
+        for _ in range(n):
+            await bucket.acquire()
+
+    bucket = TokenBucket(rate=20)
+    start = time.monotonic()
+    asyncio.run(acquire(bucket, 5))
+    # The first request is free, the other 4 wait 1 / rate each
+    assert time.monotonic() - start >= 4 / 20 * 0.95
+
+
+@pytest.mark.parametrize("retry_delay, delays", [(1, [1, 2, 4]), (40, [40, 60, 60])])
+def test_connection_errors_back_off_then_fail(tmp_path, monkeypatch, retry_delay, delays):
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+
+    monkeypatch.setattr(opentdb.asyncio, "sleep", sleep)
+    # Nothing listens on a port that was just closed
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+    with pytest.raises(FetchError):
+        fetch(tmp_path / "cache.sqlite3", f"http://localhost:{port}", retry_delay=retry_delay, max_retries=3)
+    assert slept == delays
+
+
+def test_resume_from_cache_makes_no_requests(stub, tmp_path):
+    base_url, state = stub(per_difficulty=60, overcount=1)
+    first, fetcher = fetch(tmp_path / "cache.sqlite3", base_url, category_ids=(9, 10))
+
+    base_url, state = stub(per_difficulty=60, overcount=1)
+    second, fetcher = fetch(tmp_path / "cache.sqlite3", base_url, category_ids=(9, 10))
+    assert fetcher.requests == 0
+    assert sum(state.response_codes.values()) == 0
+    assert same_results(first, second)
+
+
+def test_output_order_is_deterministic(stub, tmp_path, monkeypatch):
+    base_url, state = stub(per_difficulty=60, overcount=1)
+
+    def run(cache_fn):
+        source = opentdb.opentdb_source(str(cache_fn), category_ids=[9, 10, 11, 14], base_url=base_url, interval=0)
+        return opentdb.opentdb_pipeline(source).run(list)
+
+    concurrent = run(tmp_path / "concurrent.sqlite3")
+    resumed = run(tmp_path / "concurrent.sqlite3")
+    monkeypatch.setattr(opentdb, "CONCURRENT_CATEGORIES", 1)
+    sequential = run(tmp_path / "sequential.sqlite3")
+    assert concurrent == resumed == sequential
+    # Categories come out whole, in the order they were asked for
+    categories = [record["category"] for record in concurrent]
+    assert categories == sorted(categories, key=categories.index)
+    assert list(dict.fromkeys(categories)) == ["General", "Books", "Film", "TV"]
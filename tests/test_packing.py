@@ -0,0 +1,81 @@
+import pytest
+
+from QADPatch.Packing import PackingPlanner, PackingError
+from QADPatch.QuizQuestions import QuizQuestion
+from QADPatch.Verify import verify
+
+
+def make_questions(*categories):
+    """ (questions, blocks) for (category, count, size) triples, size counting each block's length byte """
+    questions = []
+    blocks = []
+    for category, count, size in categories:
+        for n in range(count):
+            questions.append(QuizQuestion(category, f"{category} {n}", ["a", "b", "c", "d"]))
+            blocks.append(b"x" * (size - 1))
+    return questions, blocks
+
+
+def packed(planner, questions, blocks):
+    indices, report = planner.plan(questions, blocks)
+    assert indices == sorted(indices)
+    assert report["bytes_used"] <= planner.capacity
+    counts = {}
+    for i in indices:
+        counts[questions[i].category] = counts.get(questions[i].category, 0) + 1
+    assert counts == {name: info["packed"] for name, info in report["categories"].items() if info["packed"]}
+    return counts
+
+
+def test_fills_with_the_most_questions():
+    questions, blocks = make_questions(("A", 5, 10), ("B", 5, 20))
+    assert packed(PackingPlanner(capacity=80), questions, blocks) == {"A": 5, "B": 1}
+
+
+def test_minimums_come_first():
+    questions, blocks = make_questions(("A", 5, 10), ("B", 5, 20))
+    assert packed(PackingPlanner(capacity=80, minimums={"B": 3}), questions, blocks) == {"A": 1, "B": 3}
+    assert packed(PackingPlanner(capacity=80, default_minimum=2), questions, blocks) == {"A": 3, "B": 2}
+
+
+def test_weights_favour_categories():
+    questions, blocks = make_questions(("A", 5, 10), ("B", 5, 20))
+    # B's questions are worth 4 times as much for twice the bytes, so they go first
+    assert packed(PackingPlanner(capacity=80, weights={"B": 4}), questions, blocks) == {"A": 1, "B": 3}
+
+
+def test_balance_fills_categories_evenly():
+    questions, blocks = make_questions(("A", 10, 10), ("B", 10, 10), ("C", 2, 10))
+    assert packed(PackingPlanner(capacity=103), questions, blocks) == {"A": 10}
+    assert packed(PackingPlanner(capacity=103, balance=True), questions, blocks) == {"A": 4, "B": 4, "C": 2}
+
+
+def test_balance_follows_weights():
+    questions, blocks = make_questions(("A", 10, 10), ("B", 10, 10), ("C", 10, 10))
+    assert packed(PackingPlanner(capacity=123, balance=True, weights={"A": 2}), questions, blocks) == \
+        {"A": 6, "B": 3, "C": 3}
+
+
+def test_minimums_that_dont_fit():
+    questions, blocks = make_questions(("A", 5, 10), ("B", 5, 20))
+    with pytest.raises(PackingError, match="minimums need 152 bytes"):
+        PackingPlanner(capacity=80, default_minimum=5).plan(questions, blocks)
+
+
+def test_weights_must_be_positive():
+    questions, blocks = make_questions(("A", 5, 10))
+    with pytest.raises(PackingError, match="weight of 0"):
+        PackingPlanner(weights={"A": 0}).plan(questions, blocks)
+
+
+def test_planned_dump_decodes(corpus):
+    questions, main_dict, proper_noun_dict = corpus
+    full, _ = questions.dump_bytes(proper_noun_dict, main_dict)
+    capacity = len(full.rstrip(b"\x00")) // 2
+    planner = PackingPlanner(capacity=capacity, default_minimum=5, balance=True)
+    data, metadata = questions.dump_bytes(proper_noun_dict, main_dict, planner=planner)
+    report = metadata["packing"]
+    assert len(data.rstrip(b"\x00")) <= capacity
+    assert metadata["question_count"] == sum(info["packed"] for info in report["categories"].values())
+    assert all(info["packed"] >= 5 for info in report["categories"].values())
+    assert verify(questions, data, metadata, proper_noun_dict, main_dict) == []
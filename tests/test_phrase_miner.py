@@ -0,0 +1,29 @@
+from QADPatch.PhraseMiner import mine_phrases
+from QADPatch.QuizQuestions import QuestionList
+from QADPatch.WordDictionary import WordDictionary
+from conftest import BYTE_REFERENCE_TABLE
+
+
+def word_dictionary(words, proper=False):
+    d = WordDictionary(None, {}, max_size=0x1000, max_word_count=2048, proper=proper)
+    d.words = list(words)
+    return d
+
+
+def phrases(prefix):
+    questions = QuestionList(BYTE_REFERENCE_TABLE)
+    for place, city in [("capital", "Lima"), ("city", "Rome"), ("town", "Oslo")]:
+        questions.add("Geography", f"{prefix} {place} of the {city}?", ["Paris", "Rome", "Oslo", "Bern"])
+    return mine_phrases(questions, word_dictionary([], proper=True), word_dictionary(["capital", "city", "town"]))
+
+
+def test_savings_line_up_with_the_encoding():
+    # " of the " starts right after a dictionary word, and is 8 literal bytes that a 2 byte code would replace
+    assert phrases("Ca")[" of the "] == 3 * 6
+
+
+def test_non_ascii_text_doesnt_shift_savings():
+    # "Ç" takes 2 bytes in UTF-8. Counted as one character, " of the " would start inside the word before it
+    mined = phrases("Ça")
+    assert mined[" of the "] == 3 * 6
+    assert all(phrase.isascii() for phrase in mined)
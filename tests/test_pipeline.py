@@ -0,0 +1,34 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from QADPatch.Pipeline import MapStage, Pipeline, Source
+from opentdb import opentdb_record
+
+
+def api_results(count):
+    """ OpenTDB-style results, every third one a true/false question that opentdb_record drops """
+    return [{"type": "boolean" if n % 3 == 0 else "multiple", "category": f"Category%20{n % 4}",
+             "question": f"Question%20{n}", "correct_answer": f"Right%20{n}",
+             "incorrect_answers": [f"Wrong%20{n}%20{i}" for i in range(3)]} for n in range(count)]
+
+
+@pytest.mark.parametrize("pool", [ProcessPoolExecutor, ThreadPoolExecutor])
+def test_map_stage_keeps_order_and_drops_none(pool):
+    results = api_results(1000)
+    expected = [record for record in map(opentdb_record, results) if record is not None]
+    with pool(max_workers=2) as executor:
+        stage = MapStage("decode", opentdb_record, executor, workers=2, chunk_size=7)
+        assert list(stage(iter(results))) == expected
+    assert len(expected) == 666
+
+
+def test_map_stage_in_a_pipeline():
+    results = api_results(100)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        pipeline = Pipeline(Source("api", results), [MapStage("decode", opentdb_record, executor, workers=2,
+                                                              chunk_size=8)])
+        records = pipeline.run(list)
+    assert records == [record for record in map(opentdb_record, results) if record is not None]
+    stats = pipeline.stats[1]
+    assert (stats.records_in, stats.records_out) == (100, 66)
@@ -0,0 +1,126 @@
+import pytest
+
+from QADPatch.QuizQuestions import QuestionList, QuestionStore, QuizQuestion, QuestionView, QuestionTooLongError
+from QADPatch.WordDictionary import WordDictionary
+from conftest import make_question_list
+
+# Every printable ASCII character is allowed, and nothing maps to a proper noun
+BYTE_REFERENCE_TABLE = bytes(0xc0)
+TOO_LONG = " ".join(["word"] * 40) + "?"
+
+
+def test_add_does_not_validate():
+    questions = QuestionList(BYTE_REFERENCE_TABLE)
+    questions.add("General", TOO_LONG, ["a", "b", "c", "d"])
+    questions.add_question(QuizQuestion("General", TOO_LONG, ["a", "b", "c", "d"]))
+    assert len(questions.store) == 2
+    with pytest.raises(QuestionTooLongError):
+        questions.store[0].wrap()
+
+
+def test_quiz_question_holds_its_own_fields():
+    question = QuizQuestion("Film", "Who directed Jaws?", ["Spielberg", "Lucas", "Scott", "Cameron"])
+    assert not hasattr(question, "store")
+    assert question.category == "Film"
+    assert question.answers[0] == "Spielberg"
+
+
+def test_store_indexing_and_slices():
+    store = QuestionStore()
+    for n in range(5):
+        store.add("Books" if n % 2 else "Music", f"Question {n}?", [f"Answer {n}", "b"])
+    assert isinstance(store[0], QuestionView)
+    assert store[-1].question_text == "Question 4?"
+    assert [q.question_text for q in store[1:4]] == ["Question 1?", "Question 2?", "Question 3?"]
+    assert [q.category for q in store[::2]] == ["Music", "Music", "Music"]
+    assert store[10:] == []
+    with pytest.raises(IndexError):
+        store[5]
+
+
+def legacy_encode_str(questions, s, proper_noun_dictionary, main_dictionary):
+    """ The encoder before the dictionary trie: repeated longest-word-first substring replacement, one word a pass """
+    output = [{"type": "unencoded", "data": s.encode("utf-8").replace(b'\n', b'\x01')}]
+    for d, proper in [(proper_noun_dictionary, True), (main_dictionary, False)]:
+        while True:
+            new_output = legacy_replacement(questions, output, d, proper)
+            if new_output == output:
+                break
+            output = new_output
+    return b"".join(item["data"] for item in output)
+
+
+def legacy_replacement(questions, items, d, proper):
+    new_items = []
+    replaced = False
+    for item in items:
+        if item["type"] == "encoded" or replaced:
+            new_items.append(item)
+            continue
+        for w in sorted(d.words, key=len, reverse=True):
+            word_encoded = w.encode("utf-8")
+            if word_encoded in item["data"]:
+                d_index = d.words.index(w)
+                word_index = item["data"].index(word_encoded)
+                if proper:
+                    replacement_bytes = questions.byte_reference_table.index(d_index + 1).to_bytes(1, 'big')
+                else:
+                    # The old space checks compared a byte with a str, so they never matched
+                    replacement_bytes = questions.encode_word(d_index)
+                before = item["data"][0:word_index]
+                after = item["data"][word_index + len(word_encoded):]
+                if before:
+                    new_items.append({"type": "unencoded", "data": before})
+                new_items.append({"type": "encoded", "data": replacement_bytes})
+                if after:
+                    new_items.append({"type": "unencoded", "data": after})
+                replaced = True
+                break
+        if not replaced:
+            new_items.append(item)
+    return new_items
+
+
+def test_trie_encoder_matches_legacy_encoder(corpus):
+    questions, main_dict, proper_noun_dict = corpus
+    strings = list(questions.encodable_strings())
+    encoded = b"".join(questions.encode_str(s, proper_noun_dict, main_dict) for s in strings)
+    legacy = b"".join(legacy_encode_str(questions, s, proper_noun_dict, main_dict) for s in strings)
+    assert encoded == legacy
+    # The corpus is one the dictionaries actually compress
+    assert len(encoded) < sum(len(s) for s in strings) * 0.8
+
+
+def word_dictionary(words, proper=False):
+    d = WordDictionary(None, {}, max_size=0x1000, max_word_count=2048, proper=proper)
+    d.words = list(words)
+    return d
+
+
+def test_optimal_encoder_round_trips_and_never_loses(corpus):
+    questions, main_dict, proper_noun_dict = corpus
+    optimal = make_question_list(optimal=True)
+    for s in questions.encodable_strings():
+        greedy_bytes = questions.encode_str(s, proper_noun_dict, main_dict)
+        optimal_bytes = optimal.encode_str(s, proper_noun_dict, main_dict)
+        assert optimal.decode_str(optimal_bytes, proper_noun_dict, main_dict) == s
+        assert len(optimal_bytes) <= len(greedy_bytes)
+
+
+@pytest.mark.parametrize("s, greedy_size, optimal_size", [
+    # Taking the longest word first leaves "fgh" as literals, where "abc" + "defgh" covers everything
+    ("abcdefgh", 5, 4),
+    # Only the optimal encoder folds the space into a word's code
+    ("the cat", 5, 4),
+    # or matches a word with its first letter's case flipped
+    ("The cat", 6, 4),
+])
+def test_optimal_encoder_beats_greedy(s, greedy_size, optimal_size):
+    main_dict = word_dictionary(["abcde", "abc", "defgh", "the", "cat"])
+    proper_noun_dict = word_dictionary([], proper=True)
+    greedy = QuestionList(BYTE_REFERENCE_TABLE)
+    optimal = QuestionList(BYTE_REFERENCE_TABLE, optimal=True)
+    assert len(greedy.encode_str(s, proper_noun_dict, main_dict)) == greedy_size
+    encoded = optimal.encode_str(s, proper_noun_dict, main_dict)
+    assert len(encoded) == optimal_size
+    assert optimal.decode_str(encoded, proper_noun_dict, main_dict) == s
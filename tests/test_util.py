@@ -0,0 +1,127 @@
+import json
+import os
+import random
+import zipfile
+
+import pytest
+
+import util
+from util import PROGRAM_ROMS, rewrite_zip, RomImage
+
+
+def make_zip(path):
+    """ A zip laid out like qad.zip: 4 interleaved program ROMs and some other members, deflated and stored """
+    rng = random.Random(0)
+    members = {name: bytes(rng.getrandbits(8) for _ in range(0x20000)) for name in PROGRAM_ROMS}
+    members["gfx.bin"] = bytes(rng.getrandbits(8) for _ in range(5000)) + bytes(20000)
+    members["snd/voice.bin"] = bytes(range(256)) * 40
+    members["Überschrift.txt"] = "Quiz & Dragons".encode()
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("snd/", b"")
+        for name, data in members.items():
+            zf.writestr(zipfile.ZipInfo(name, (1992, 5, 6, 7, 8, 10)), data,
+                        zipfile.ZIP_STORED if name == "gfx.bin" else zipfile.ZIP_DEFLATED)
+        zf.comment = b"clean"
+    return members
+
+
+@pytest.mark.parametrize("compress_type", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_rewrite_zip_round_trip(tmp_path, compress_type):
+    members = make_zip(tmp_path / "qad.zip")
+    replacements = {PROGRAM_ROMS[0]: bytes(0x20000), PROGRAM_ROMS[3]: b"\x01" * 0x20000}
+    rewrite_zip(tmp_path / "qad.zip", tmp_path / "out.zip", replacements, compress_type)
+
+    with zipfile.ZipFile(tmp_path / "qad.zip") as src, zipfile.ZipFile(tmp_path / "out.zip") as out:
+        assert out.testzip() is None
+        assert out.comment == b"clean"
+        assert out.namelist() == [name for name in src.namelist() if not name.endswith("/")]
+        for info in out.infolist():
+            src_info = src.getinfo(info.filename)
+            assert out.read(info) == replacements.get(info.filename, members[info.filename])
+            assert info.date_time == src_info.date_time
+            assert info.external_attr == src_info.external_attr
+            if info.filename in replacements:
+                assert info.compress_type == compress_type
+            else:
+                assert (info.compress_type, info.compress_size) == (src_info.compress_type, src_info.compress_size)
+
+
+def test_write_zip_round_trip(tmp_path):
+    make_zip(tmp_path / "qad.zip")
+    rom = RomImage.from_zip(tmp_path, "qad.zip")
+    rom.patch(0x100, b"QAD")
+    rom.write_zip(tmp_path, "qad.zip", tmp_path / "patched")
+
+    with zipfile.ZipFile(tmp_path / "patched" / "qad.zip") as zf:
+        assert zf.testzip() is None
+        for name, data in rom.roms().items():
+            assert zf.read(name) == data
+    assert RomImage.from_zip(tmp_path / "patched", "qad.zip").read(0x100, 3) == b"QAD"
+    assert not [fn for fn in os.listdir(tmp_path / "patched") if fn.endswith(".tmp")]
+
+
+def test_check_zip_hash(tmp_path, monkeypatch):
+    make_zip(tmp_path / "qad.zip")
+    sidecar = tmp_path / ("qad.zip" + util.HASH_SIDECAR_SUFFIX)
+    # A zip that doesn't match is never remembered
+    assert not util.check_zip_hash(tmp_path, "qad.zip")
+    assert not util.check_zip_hash(tmp_path, "qad.zip", by_member=True)
+    assert not sidecar.exists()
+
+    monkeypatch.setattr(util, "CLEAN_ZIP_SHA256", util.file_sha256(tmp_path / "qad.zip"))
+    assert util.check_zip_hash(tmp_path, "qad.zip")
+    assert sidecar.exists()
+
+    # Once it's passed, an unchanged zip isn't hashed again
+    def file_sha256(path):
+        raise AssertionError("hashed again")
+
+    monkeypatch.setattr(util, "file_sha256", file_sha256)
+    assert util.check_zip_hash(tmp_path, "qad.zip")
+
+
+def test_check_zip_hash_by_member(tmp_path, monkeypatch):
+    make_zip(tmp_path / "qad.zip")
+    rewrite_zip(tmp_path / "qad.zip", tmp_path / "repacked.zip", {}, zipfile.ZIP_STORED)
+    monkeypatch.setattr(util, "PROGRAM_ROM_CRCS", util.zip_member_crcs(tmp_path / "qad.zip"))
+    assert not util.check_zip_hash(tmp_path, "repacked.zip")
+    assert util.check_zip_hash(tmp_path, "repacked.zip", by_member=True)
+
+    # Passing saves the repacked zip's own digest, so it isn't hashed again while it's unchanged
+    with open(tmp_path / ("repacked.zip" + util.HASH_SIDECAR_SUFFIX)) as f:
+        sidecar = json.load(f)
+    assert sidecar["sha256"] == util.file_sha256(tmp_path / "repacked.zip")
+    hashed = []
+    file_sha256 = util.file_sha256
+    monkeypatch.setattr(util, "file_sha256", lambda path: hashed.append(path) or file_sha256(path))
+    assert util.check_zip_hash(tmp_path, "repacked.zip", by_member=True)
+    assert hashed == []
+
+    # Replacing the zip misses the saved digest, and different program ROMs don't pass
+    rewrite_zip(tmp_path / "qad.zip", tmp_path / "repacked.zip", {PROGRAM_ROMS[0]: bytes(0x20000)})
+    assert not util.check_zip_hash(tmp_path, "repacked.zip", by_member=True)
+    assert len(hashed) == 1
+
+
+def test_copied_members_keep_their_versions(tmp_path):
+    with zipfile.ZipFile(tmp_path / "qad.zip", "w") as zf:
+        for name in PROGRAM_ROMS:
+            zf.writestr(name, bytes(0x20000), zipfile.ZIP_DEFLATED)
+        # LZMA needs version 6.3 to extract, and a zip64 header 4.5
+        zf.writestr("lzma.bin", b"lzma" * 1000, zipfile.ZIP_LZMA)
+        with zf.open("zip64.bin", "w", force_zip64=True) as f:
+            f.write(b"zip64" * 1000)
+    rewrite_zip(tmp_path / "qad.zip", tmp_path / "out.zip", {PROGRAM_ROMS[0]: b"\x01" * 0x20000})
+
+    with zipfile.ZipFile(tmp_path / "qad.zip") as src, zipfile.ZipFile(tmp_path / "out.zip") as out:
+        assert out.testzip() is None
+        assert src.getinfo("lzma.bin").extract_version == 63
+        assert src.getinfo("zip64.bin").extract_version == 45
+        for info in out.infolist():
+            src_info = src.getinfo(info.filename)
+            if info.filename == PROGRAM_ROMS[0]:
+                assert (info.create_version, info.extract_version) == (util.ZIP_VERSION, util.ZIP_VERSION)
+            else:
+                assert (info.create_version, info.extract_version) == (src_info.create_version,
+                                                                       src_info.extract_version)
+        assert out.read("zip64.bin") == b"zip64" * 1000
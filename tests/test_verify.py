@@ -0,0 +1,29 @@
+import pytest
+
+from QADPatch.Verify import verify, format_mismatch
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_verify_clean_dump(corpus, workers):
+    questions, main_dict, proper_noun_dict = corpus
+    data, metadata = questions.dump_bytes(proper_noun_dict, main_dict)
+    assert verify(questions, data, metadata, proper_noun_dict, main_dict, workers=workers) == []
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_verify_reports_corrupted_block(corpus, workers):
+    questions, main_dict, proper_noun_dict = corpus
+    questions_bin, metadata = questions.dump_bytes(proper_noun_dict, main_dict)
+    category = list(metadata["categories"].values())[1]
+    # The last byte of a block always terminates its last answer, so this runs an "x" onto the end of it
+    block_offset = category["offset"]
+    data = bytearray(questions_bin)
+    data[block_offset + data[block_offset] - 1] = ord("x")
+
+    mismatches = verify(questions, data, metadata, proper_noun_dict, main_dict, workers=workers)
+    assert len(mismatches) == 1
+    mismatch = mismatches[0]
+    assert (mismatch["category"], mismatch["index"], mismatch["offset"]) == (category["name"], 0, block_offset)
+    assert mismatch["field"] == "answer 4"
+    assert mismatch["decoded"] == mismatch["expected"] + "x"
+    assert format_mismatch(mismatch, base_address=0x29370).startswith(f"{category['name']} question 0 at ")
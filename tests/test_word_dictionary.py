@@ -0,0 +1,68 @@
+import pytest
+
+from QADPatch.WordDictionary import WordDictionary, build_dictionaries
+
+
+def dictionary(words, max_size, proper=False):
+    d = WordDictionary(None, {}, max_size=max_size, max_word_count=100, proper=proper)
+    d.words = list(words)
+    return d
+
+
+@pytest.mark.parametrize("remaining", [0, 2, 3, 4, 5, 10, 11])
+def test_serialize_padded_fills_max_size(remaining):
+    d = dictionary(["Paris", "London"], len(b"\x05Paris\x06London") + remaining)
+    padded = d.serialize_padded()
+    assert len(padded) == d.max_size
+    # Every dummy word parses back, so the entry count covers the whole region
+    parsed = WordDictionary.from_bytes(padded)
+    assert len(parsed.words) == len(d.words) + d.dummy_words
+
+
+def test_serialize_padded_one_byte_short():
+    d = dictionary(["Paris", "London"], len(b"\x05Paris\x06London") + 1)
+    with pytest.raises(ValueError):
+        d.serialize_padded()
+
+
+def test_build_never_leaves_one_byte():
+    # "Rome" would end the dictionary at max_size - 1, so the next word that fits is taken instead
+    frequency = {"Paris": 9, "Rome": 8, "Oslo": 7, "Bern": 6, "Ab": 5}
+    d = WordDictionary(None, frequency, max_size=len(b"\x05Paris") + 6, max_word_count=100)
+    d.build()
+    assert "Rome" not in d.words
+    assert len(d.serialize_padded()) == d.max_size
+
+
+def test_build_by_savings_never_leaves_one_byte():
+    # Each 5 letter word takes 6 bytes, so a 3rd in 19 bytes would leave 1
+    frequency = {"Paris": 9, "Rouen": 8, "Lille": 7, "Bern": 1}
+    d = WordDictionary(None, frequency, max_size=19, max_word_count=100)
+    d.build_by_savings()
+    assert d.fits(0, "Paris") and not d.fits(12, "Lille")
+    assert len(d.serialize_padded()) == d.max_size
+
+
+def test_proper_nouns_ranked_by_their_own_savings():
+    # Used as often as "Mozart", but saves a byte less per use and per dictionary byte
+    frequency = {"Mozart": 10, "Ivy": 10}
+    main_dict, proper_noun_dict = build_dictionaries(None, frequency, main_max_size=100, main_max_word_count=10,
+                                                     proper_max_size=9, proper_max_word_count=10)
+    assert proper_noun_dict.words == ["Mozart"]
+    assert main_dict.words == ["Ivy"]
+
+
+@pytest.mark.parametrize("words", [[], ["Paris"] * 3, ["Paris"] * 80])
+def test_serialize_padded_within_max_entries(words):
+    d = dictionary(words, 0x30e, proper=True)
+    padded = d.serialize_padded(max_entries=0xfe)
+    assert len(padded) == d.max_size
+    assert len(d.words) + d.dummy_words <= 0xfe
+    parsed = WordDictionary.from_bytes(padded)
+    assert len(parsed.words) == len(d.words) + d.dummy_words
+
+
+def test_serialize_padded_too_few_entries():
+    d = dictionary(["Paris"] * 3, 0x30e, proper=True)
+    with pytest.raises(ValueError):
+        d.serialize_padded(max_entries=4)
@@ -0,0 +1,26 @@
+import pytest
+
+from benchmark import legacy_count_words
+from conftest import CORPUS_RECORDS
+from QADPatch.WordFrequency import count_words, count_words_parallel, ranked_words, record_strings, top_words
+
+STRINGS = list(record_strings(CORPUS_RECORDS)) + ['The "{Odyssey}" (book) - by Homer, c. 700 BC?', "A|B|C", "x y"]
+
+
+def test_count_words_matches_legacy():
+    assert count_words(STRINGS) == legacy_count_words(STRINGS)
+
+
+@pytest.mark.parametrize("workers, shard_size", [(1, 4096), (2, 50), (3, 7)])
+def test_count_words_parallel_matches_count_words(workers, shard_size):
+    # A generator, like a file read line by line, which can only be read once
+    counts = count_words_parallel((s for s in STRINGS), workers, shard_size=shard_size)
+    assert counts == count_words(STRINGS)
+
+
+def test_ranked_words_matches_a_full_sort():
+    counts = count_words(STRINGS)
+    full_sort = sorted(counts.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+    assert list(ranked_words(counts, first=10)) == full_sort
+    assert list(ranked_words(counts, min_count=3, first=10)) == [kv for kv in full_sort if kv[1] >= 3]
+    assert top_words(counts, 25, min_count=2) == [kv for kv in full_sort if kv[1] >= 2][:25]
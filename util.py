@@ -1,10 +1,22 @@
 """ Various functions used for unpacking, patching, and re-packing the QAD ROM """
 
-from zipfile import ZipFile
+import zipfile
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 import os
 from os.path import join
 import shutil
 import hashlib
+import json
+import mmap
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 WORKING_DIR = join(".", "temp")
 OUTPUT_DIR = join(".", "patched")
@@ -13,140 +25,180 @@ ROM1A = "qdu_36a.12f"
 ROM1B = "qdu_42a.12h"
 ROM2A = "qdu_37a.13f"
 ROM2B = "qdu_43a.13h"
+PROGRAM_ROMS = [ROM1A, ROM1B, ROM2A, ROM2B]
+SPLIT_ADDRESS = 0x40000
+CLEAN_ZIP_SHA256 = "0f2a54c9639d52120a76154eac2f0531964fbd1f7693614ca7c355468dedf6c5"
+# CRC32s of the clean program ROMs, as listed for the qad set in MAME's cps1 driver
+PROGRAM_ROM_CRCS = {ROM1A: 0xde9c24a0, ROM1B: 0xcfe36f0c, ROM2A: 0x10d22320, ROM2B: 0x15e6beb9}
+# Written next to a zip, e.g. clean_rom/qad.zip.verified.json. See check_zip_hash
+HASH_SIDECAR_SUFFIX = ".verified.json"
+# Members are copied between zips in pieces this big
+COPY_CHUNK_SIZE = 1 << 20
+LOCAL_HEADER_SIZE = 30
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+CENTRAL_HEADER_SIGNATURE = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x05\x06"
+# Zip spec version 2.0, which covers deflate
+ZIP_VERSION = 20
+# General purpose flag bits: sizes and CRC written after the data instead of in the local header, and UTF-8 names
+DATA_DESCRIPTOR_FLAG = 0x08
+UTF8_FLAG = 0x800
+ZIP64_EXTRA_ID = 0x0001
+# Limits of a zip without zip64 records
+ZIP_MAX_SIZE = 0xFFFFFFFF
+ZIP_MAX_MEMBERS = 0xFFFF
+
+
+def file_sha256(path):
+    """ SHA-256 hex digest of a file, hashed straight out of a memory map instead of being read in chunks """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files can't be mapped
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+
+def file_identity(path):
+    """ What a cached digest of path is keyed on. If any of it changes, the file is hashed again """
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+
+def read_sidecar(path):
+    """ The sidecar saved for path, or an empty dict if there isn't a readable one """
+    try:
+        with open(path + HASH_SIDECAR_SUFFIX, "r") as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return sidecar if isinstance(sidecar, dict) else {}
+
+
+def write_sidecar(path, sidecar):
+    """ Save the sidecar for path. It's only a cache, so failing to write it (e.g. a read-only directory) is ignored """
+    temp_fn = f"{path}{HASH_SIDECAR_SUFFIX}.{os.getpid()}.tmp"
+    try:
+        with open(temp_fn, "w") as f:
+            json.dump(sidecar, f, indent=4)
+        os.replace(temp_fn, path + HASH_SIDECAR_SUFFIX)
+    except OSError:
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+
+
+def cached_sha256(path, use_cache=True):
+    """
+    file_sha256 of path, reusing the digest saved in its sidecar if the file's path, size, mtime and inode are all
+    unchanged since. Nothing is saved here. Returns (digest, identity), identity being the file_identity to save the
+    digest under once it's been checked
+    """
+    identity = file_identity(path)
+    sidecar = read_sidecar(path) if use_cache else {}
+    if sidecar.get("sha256") and all(sidecar.get(key) == value for key, value in identity.items()):
+        return sidecar["sha256"], identity
+    return file_sha256(path), identity
 
 
-def check_zip_hash(src_dir, fname):
-    correct_hash = "0f2a54c9639d52120a76154eac2f0531964fbd1f7693614ca7c355468dedf6c5"
-    hash = hashlib.sha256()
-    with open(join(src_dir, fname), 'rb') as f:
-        while True:
-            data = f.read(65536)
-            if not data:
-                break
-            hash.update(data)
-    return hash.hexdigest() == correct_hash
-
-
-def extract_zip(src_dir, fname):
-    if os.path.isdir(WORKING_DIR):
-        shutil.rmtree(WORKING_DIR)
-
-    os.mkdir(WORKING_DIR)
-    with ZipFile(join(src_dir, fname), 'r') as zip_f:
-        zip_f.extractall(WORKING_DIR)
-
-
-def add_dir_to_zip(zf, dir):
-    """ https://stackoverflow.com/a/670635 """
-    for file in os.listdir(dir):
-        full_path = join(dir, file)
-        if os.path.isfile(full_path):
-            zf.write(full_path)
-        elif os.path.isdir(full_path):
-            add_dir_to_zip(zf, full_path)
+def zip_member_crcs(path, names=PROGRAM_ROMS):
+    """ {name: CRC32} for members of a zip, as listed in its central directory, so nothing is decompressed """
+    with ZipFile(path, 'r') as zip_f:
+        return {name: zip_f.getinfo(name).CRC for name in names}
 
 
-def build_zip():
-    os.chdir(WORKING_DIR)
-    with ZipFile(join("..", "temp.zip"), "w") as zf:
-        for file in os.listdir():
-            if os.path.isfile(file):
-                zf.write(file)
-            else:
-                add_dir_to_zip(zf, file)
-    os.chdir("..")
-    if os.path.isdir(OUTPUT_DIR):
-        shutil.rmtree(OUTPUT_DIR)
+def check_zip_hash(src_dir, fname, use_cache=True, by_member=False):
+    """
+    Whether src_dir/fname is the clean qad.zip the patcher expects. Once a zip passes, its SHA-256 is saved in a sidecar
+    next to it (see cached_sha256), so an unchanged zip isn't hashed again.
 
-    os.mkdir(OUTPUT_DIR)
+    With by_member, a zip that doesn't match as a whole still passes if its program ROMs' CRC32s match
+    PROGRAM_ROM_CRCS, as happens when a ROM manager recompresses the zip. Only the central directory is read for this;
+    the program ROMs themselves are checked against those CRC32s as they're decompressed (ZipFile raises BadZipFile if
+    they differ), and the zip's other members are never decompressed.
+    """
+    path = join(src_dir, fname)
+    digest, identity = cached_sha256(path, use_cache)
+    if digest == CLEAN_ZIP_SHA256:
+        clean = True
+    elif by_member:
+        try:
+            clean = zip_member_crcs(path) == PROGRAM_ROM_CRCS
+        except KeyError:
+            # A program ROM is missing
+            clean = False
+    else:
+        clean = False
+    if clean and use_cache:
+        write_sidecar(path, dict(identity, sha256=digest))
+    return clean
 
-    # Copy uncompressed raw files to output dir too in order to make IPS patches
-    for fn in [ROM1A, ROM1B, ROM2A, ROM2B]:
-        shutil.copyfile(join(WORKING_DIR, fn), join(OUTPUT_DIR, fn))
 
+def extract_zip(src_dir, fname, members=None):
+    """ Extract the zip into WORKING_DIR. With a list of member names, only those are decompressed """
     if os.path.isdir(WORKING_DIR):
         shutil.rmtree(WORKING_DIR)
 
+    os.mkdir(WORKING_DIR)
+    with ZipFile(join(src_dir, fname), 'r') as zip_f:
+        zip_f.extractall(WORKING_DIR, members)
 
 
-    shutil.move("temp.zip", join(OUTPUT_DIR, "qad.zip"))
-
-
-def deinterleave(fn1, fn2, outfn):
-    """ Read 1 byte from fn1, 1 byte from fn2, 1 from fn1 etc until eof and write to out_fn """
-
-    fp1 = open(join(WORKING_DIR, fn1), "rb")
-    fp2 = open(join(WORKING_DIR, fn2), "rb")
-    fps = [fp1, fp2]
-    outfp = open(join(WORKING_DIR, outfn), "wb")
-
-    i = 0
-    while True:
-        b = fps[i].read(1)
-        if not b:
-            break
-
-        outfp.write(b)
-
-        i = (i + 1) % 2
-
-    fp1.close()
-    fp2.close()
-    outfp.close()
-
-
-def interleave(fn, outfn1, outfn2):
-    """ Opposite of deinterleave. Write every even byte from 'fn' to 'outfn1' and every odd byte to 'outfn2' """
-
-    fp = open(join(WORKING_DIR, fn), "rb")
-    outfp1 = open(join(WORKING_DIR, outfn1), "wb")
-    outfp2 = open(join(WORKING_DIR, outfn2), "wb")
-    outfps = [outfp1, outfp2]
-
-    i = 0
-    while True:
-        b = fp.read(1)
-        if not b:
-            break
-
-        outfps[i].write(b)
-        i = (i + 1) % 2
-
-    fp.close()
-    outfp1.close()
-    outfp2.close()
-
+def read_buffer(src):
+    """ Filenames are read from WORKING_DIR. Anything else is treated as an in-memory buffer and returned as is """
+    if isinstance(src, str):
+        with open(join(WORKING_DIR, src), "rb") as f:
+            return f.read()
+    return src
 
-def concatenate(fn1, fn2, outfn):
-    """ Write fn1 + fn2 to outfn """
 
-    fp2 = open(join(WORKING_DIR, fn2), "rb")
+def deinterleave(fn1, fn2, outfn=None, use_numpy=False):
+    """
+    Merge fn1 and fn2 so that even bytes come from fn1 and odd bytes from fn2. Inputs can be filenames or buffers.
+    The result is written to 'outfn' if one is given and returned as a bytearray.
+    """
 
-    shutil.move(join(WORKING_DIR, fn1), join(WORKING_DIR, outfn))
+    even = read_buffer(fn1)
+    odd = read_buffer(fn2)
+    if len(even) != len(odd):
+        raise ValueError(f"Interleaved ROM pair must be the same size ({len(even)} != {len(odd)} bytes).")
 
-    outfp = open(join(WORKING_DIR, outfn), "ab")
-    outfp.write(fp2.read())
+    out = bytearray(len(even) + len(odd))
+    if use_numpy and numpy is not None:
+        out_array = numpy.frombuffer(out, dtype=numpy.uint8)
+        out_array[0::2] = numpy.frombuffer(even, dtype=numpy.uint8)
+        out_array[1::2] = numpy.frombuffer(odd, dtype=numpy.uint8)
+    else:
+        out[0::2] = even
+        out[1::2] = odd
 
-    fp2.close()
-    outfp.close()
+    if outfn:
+        with open(join(WORKING_DIR, outfn), "wb") as outfp:
+            outfp.write(out)
+    return out
 
 
-def split(fn, outfn1, outfn2, split_address):
+def interleave(fn, outfn1=None, outfn2=None, use_numpy=False):
     """
-    Read 'fn' until the byte before 'split_address' and write to 'outfn1'. Then write remaining bytes to 'outfn2'.
-    In other words, size of outfn1 will equal split_address.
+    Opposite of deinterleave. Every even byte from 'fn' goes to 'outfn1' and every odd byte to 'outfn2'. 'fn' can be a
+    filename or a buffer. Returns (even bytes, odd bytes), writing them to outfn1/outfn2 if given.
     """
 
-    fp = open(join(WORKING_DIR, fn), "rb")
-    outfp1 = open(join(WORKING_DIR, outfn1), "wb")
-    outfp2 = open(join(WORKING_DIR, outfn2), "wb")
-
-    outfp1.write(fp.read(split_address))
-    outfp2.write(fp.read())
+    data = read_buffer(fn)
+    if use_numpy and numpy is not None:
+        data_array = numpy.frombuffer(data, dtype=numpy.uint8)
+        even = data_array[0::2].tobytes()
+        odd = data_array[1::2].tobytes()
+    else:
+        # Strided slices of a memoryview are slow to copy, so take a contiguous copy first
+        data = bytes(data)
+        even = data[0::2]
+        odd = data[1::2]
 
-    fp.close()
-    outfp1.close()
-    outfp2.close()
+    for outfn, out in [(outfn1, even), (outfn2, odd)]:
+        if outfn:
+            with open(join(WORKING_DIR, outfn), "wb") as outfp:
+                outfp.write(out)
+    return even, odd
 
 
 def patch(fn, address, patch_value=None, patch_fn=None):
@@ -164,21 +216,310 @@ def patch(fn, address, patch_value=None, patch_fn=None):
         with open(join(WORKING_DIR, patch_fn), "rb") as rep_f:
             replacement_bytes = rep_f.read()
 
-    fp = open(join(WORKING_DIR, fn), "rb")
-    temp_outf = open(join(WORKING_DIR, "in_place_edit.bin"), "wb")
+    path = join(WORKING_DIR, fn)
+    plan = PatchPlan(os.path.getsize(path))
+    plan.add(address, replacement_bytes)
+    plan.apply_to_file(path)
 
-    # Read up to the address that will change and write it
-    temp_outf.write(fp.read(address))
 
-    # Write the new bytes
-    temp_outf.write(replacement_bytes)
+def encode_bps_number(n):
+    """ Variable length integer encoding used by BPS patches """
+    out = bytearray()
+    while True:
+        x = n & 0x7f
+        n >>= 7
+        if n == 0:
+            out.append(0x80 | x)
+            return out
+        out.append(x)
+        n -= 1
+
+
+class PatchPlan:
+    """
+    A batch of (address, bytes) edits against an image of a fixed size. Edits are validated as they are added and
+    kept sorted, so the whole plan can be applied in a single pass or exported as an IPS/BPS delta.
+    """
 
-    # Skip over the changed bytes and write the rest
-    fp.seek(len(replacement_bytes), 1)
-    temp_outf.write(fp.read())
+    IPS_MAX_OFFSET = 0xFFFFFF
+    IPS_MAX_RECORD_SIZE = 0xFFFF
+    IPS_EOF = 0x454F46  # "EOF" can't be used as a record offset
+
+    def __init__(self, size):
+        self.size = size
+        self.edits = []  # Sorted list of (address, bytes)
+
+    def add(self, address, patch_value):
+        """ Queue 'patch_value' to be written at 'address'. Raises ValueError if it's out of bounds or overlaps """
+        patch_value = bytes(patch_value)
+        if not patch_value:
+            raise ValueError(f"Empty patch at {hex(address)}.")
+        end = address + len(patch_value)
+        if address < 0 or end > self.size:
+            raise ValueError(f"Patch at {hex(address)} of {len(patch_value)} bytes is outside of the image "
+                             f"({hex(self.size)} bytes).")
+
+        i = bisect_left(self.edits, (address,))
+        if i < len(self.edits) and self.edits[i][0] < end:
+            raise ValueError(f"Patch at {hex(address)} overlaps patch at {hex(self.edits[i][0])}.")
+        if i > 0 and self.edits[i - 1][0] + len(self.edits[i - 1][1]) > address:
+            raise ValueError(f"Patch at {hex(address)} overlaps patch at {hex(self.edits[i - 1][0])}.")
+        self.edits.insert(i, (address, patch_value))
+        return self
+
+    def runs(self):
+        """ Edits with adjacent addresses merged together. Returns a list of (address, bytes) """
+        runs = []
+        for address, value in self.edits:
+            if runs and runs[-1][0] + len(runs[-1][1]) == address:
+                runs[-1] = (runs[-1][0], runs[-1][1] + value)
+            else:
+                runs.append((address, value))
+        return runs
+
+    def apply(self, buf):
+        """ Write every edit into a writable buffer (bytearray, memoryview or mmap) the same size as the plan """
+        if len(buf) != self.size:
+            raise ValueError(f"Patch plan is for {hex(self.size)} bytes but buffer is {hex(len(buf))} bytes.")
+        for address, value in self.edits:
+            buf[address:address + len(value)] = value
+
+    def apply_to_file(self, path):
+        """ Apply the plan in place to a file through mmap. Filesize will not be changed. """
+        with open(path, "r+b") as f, mmap.mmap(f.fileno(), 0) as mm:
+            self.apply(mm)
+            mm.flush()
+
+    def to_ips(self):
+        """ Export the plan as an IPS patch against the image """
+        out = bytearray(b"PATCH")
+        for address, value in self.runs():
+            for i in range(0, len(value), self.IPS_MAX_RECORD_SIZE):
+                offset = address + i
+                if offset > self.IPS_MAX_OFFSET or offset == self.IPS_EOF:
+                    raise ValueError(f"Offset {hex(offset)} can't be represented in an IPS patch.")
+                chunk = value[i:i + self.IPS_MAX_RECORD_SIZE]
+                out += offset.to_bytes(3, "big")
+                out += len(chunk).to_bytes(2, "big")
+                out += chunk
+        out += b"EOF"
+        return bytes(out)
+
+    def to_bps(self, source):
+        """ Export the plan as a BPS patch. 'source' is the unpatched image, which BPS checksums """
+        if len(source) != self.size:
+            raise ValueError(f"Patch plan is for {hex(self.size)} bytes but source is {hex(len(source))} bytes.")
+        target = bytearray(source)
+        self.apply(target)
+
+        out = bytearray(b"BPS1")
+        out += encode_bps_number(self.size)  # Source size
+        out += encode_bps_number(self.size)  # Target size
+        out += encode_bps_number(0)  # No metadata
+        position = 0
+        for address, value in self.runs():
+            if address > position:
+                out += encode_bps_number(((address - position - 1) << 2) | 0)  # SourceRead
+            out += encode_bps_number(((len(value) - 1) << 2) | 1)  # TargetRead
+            out += value
+            position = address + len(value)
+        if position < self.size:
+            out += encode_bps_number(((self.size - position - 1) << 2) | 0)
+        out += zlib.crc32(source).to_bytes(4, "little")
+        out += zlib.crc32(target).to_bytes(4, "little")
+        out += zlib.crc32(out).to_bytes(4, "little")
+        return bytes(out)
+
+
+def strip_zip64_extra(extra):
+    """ A member's extra field without its zip64 record, which RawZipWriter doesn't write """
+    out = b""
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, size = struct.unpack("<HH", extra[pos:pos + 4])
+        if header_id != ZIP64_EXTRA_ID:
+            out += extra[pos:pos + 4 + size]
+        pos += 4 + size
+    return out
+
+
+def read_raw_member(f, info):
+    """ Yield the stored (still compressed) bytes of a member of the zip open as f, without inflating them """
+    f.seek(info.header_offset)
+    header = f.read(LOCAL_HEADER_SIZE)
+    if len(header) != LOCAL_HEADER_SIZE or header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+    # The local header's name and extra lengths can differ from the central directory's
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    f.seek(info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length)
+    remaining = info.compress_size
+    while remaining:
+        chunk = f.read(min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile(f"{info.filename} is truncated")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def compress_member(data, compress_type=ZIP_DEFLATED, level=zlib.Z_DEFAULT_COMPRESSION):
+    """ (CRC32, stored bytes) of data for a zip member. zlib releases the GIL, so this can run in a thread pool """
+    crc = zlib.crc32(data)
+    if compress_type == ZIP_STORED:
+        return crc, bytes(data)
+    # Raw deflate, without a zlib header, is what zip members hold
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return crc, compressor.compress(data) + compressor.flush()
+
+
+class RawZipWriter:
+    """
+    Writes a zip to a binary file from members' already stored (e.g. still compressed) bytes, local headers and
+    central directory included. ZipFile can only add a member by compressing it itself. There are no zip64 records, so
+    members and the whole zip have to stay under 4GB, which ROM zips are far from.
+    """
 
-    temp_outf.close()
-    fp.close()
+    def __init__(self, f):
+        self.f = f
+        self.central_directory = []
+
+    def add(self, info, file_size, compress_size, crc, chunks, compress_type=None):
+        """
+        Write a member with the name, date, attributes and extra fields of 'info' (a ZipInfo, e.g. from another zip)
+        and the stored bytes in chunks, compressed with compress_type (by default info's)
+        """
+        if compress_type is None:
+            # Copied as it was stored, so it keeps the versions its compression method and flags were written with
+            compress_type = info.compress_type
+            create_version, extract_version = info.create_version, info.extract_version
+        else:
+            create_version = extract_version = ZIP_VERSION
+        # The sizes and CRC always go in the local header, so there's no data descriptor
+        flags = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+        try:
+            name = info.filename.encode("ascii")
+        except UnicodeEncodeError:
+            name = info.filename.encode("utf-8")
+            flags |= UTF8_FLAG
+        extra = strip_zip64_extra(info.extra)
+        offset = self.f.tell()
+        if max(file_size, compress_size, offset) > ZIP_MAX_SIZE or len(self.central_directory) == ZIP_MAX_MEMBERS:
+            raise zipfile.LargeZipFile(f"{info.filename} doesn't fit in a zip without zip64")
+        year, month, day, hour, minute, second = info.date_time
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        dos_time = hour << 11 | minute << 5 | second // 2
+
+        self.f.write(struct.pack("<4s5H3L2H", LOCAL_HEADER_SIGNATURE, extract_version, flags, compress_type, dos_time,
+                                 dos_date, crc, compress_size, file_size, len(name), len(extra)))
+        self.f.write(name + extra)
+        written = 0
+        for chunk in chunks:
+            self.f.write(chunk)
+            written += len(chunk)
+        if written != compress_size:
+            raise zipfile.BadZipFile(f"{info.filename} should be {compress_size} bytes, got {written}")
+
+        self.central_directory.append(
+            struct.pack("<4s6H3L5H2L", CENTRAL_HEADER_SIGNATURE, info.create_system << 8 | create_version,
+                        extract_version, flags, compress_type, dos_time, dos_date, crc, compress_size, file_size,
+                        len(name), len(extra), len(info.comment), 0, info.internal_attr, info.external_attr, offset)
+            + name + extra + info.comment)
+
+    def close(self, comment=b""):
+        """ Write the central directory and end of central directory record. Doesn't close the file """
+        start = self.f.tell()
+        for entry in self.central_directory:
+            self.f.write(entry)
+        size = self.f.tell() - start
+        if start + size > ZIP_MAX_SIZE:
+            raise zipfile.LargeZipFile("The central directory doesn't fit in a zip without zip64")
+        count = len(self.central_directory)
+        self.f.write(struct.pack("<4s4H2LH", END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, count, count, size, start,
+                                 len(comment)))
+        self.f.write(comment)
+
+
+def rewrite_zip(src_path, out_path, replacements, compress_type=ZIP_DEFLATED, workers=None):
+    """
+    Write out_path with every member of the zip at src_path, in the same order, replacing the contents of the members
+    named in replacements ({filename: bytes}). Untouched members are copied across still compressed, so they're never
+    inflated or deflated again. The replacements are compressed with compress_type (ZIP_STORED skips compressing them)
+    in a pool of 'workers' threads, one per replacement by default. Directory entries are left out.
+    """
+    with ZipFile(src_path, 'r') as src_zip:
+        infos = [info for info in src_zip.infolist() if not info.is_dir()]
+        comment = src_zip.comment
+    with ThreadPoolExecutor(max_workers=workers or max(len(replacements), 1)) as executor:
+        compressed = {name: executor.submit(compress_member, data, compress_type)
+                      for name, data in replacements.items()}
+        with open(src_path, "rb") as src, open(out_path, "wb") as out:
+            writer = RawZipWriter(out)
+            for info in infos:
+                if info.filename in compressed:
+                    crc, data = compressed[info.filename].result()
+                    writer.add(info, len(replacements[info.filename]), len(data), crc, [data], compress_type)
+                else:
+                    writer.add(info, info.file_size, info.compress_size, info.CRC, read_raw_member(src, info))
+            writer.close(comment)
+
+
+class RomImage:
+    """
+    The deinterleaved and concatenated program ROMs held in a single bytearray. Replaces the extract -> deinterleave ->
+    concatenate -> patch -> split -> interleave -> zip round trip through WORKING_DIR with in-memory operations.
+    """
 
-    os.remove(join(WORKING_DIR, fn))
-    shutil.move(join(WORKING_DIR, "in_place_edit.bin"), join(WORKING_DIR, fn))
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.view = memoryview(self.data)
+
+    @classmethod
+    def from_zip(cls, src_dir, fname):
+        """ Read the four program ROMs straight out of the zip and combine them """
+        with ZipFile(join(src_dir, fname), 'r') as zip_f:
+            rom1 = deinterleave(zip_f.read(ROM1A), zip_f.read(ROM1B))
+            rom2 = deinterleave(zip_f.read(ROM2A), zip_f.read(ROM2B))
+        return cls(rom1 + rom2)
+
+    def read(self, address, length):
+        return bytes(self.view[address:address + length])
+
+    def patch(self, address, patch_value):
+        """ Replace bytes at 'address' with 'patch_value'. Size of the image will not be changed. """
+        self.apply(PatchPlan(len(self.data)).add(address, patch_value))
+
+    def plan(self):
+        """ An empty PatchPlan sized for this image """
+        return PatchPlan(len(self.data))
+
+    def apply(self, plan):
+        """ Apply every edit in a PatchPlan in one pass """
+        plan.apply(self.view)
+
+    def roms(self):
+        """ Split and interleave the image back into the four program ROMs. Returns {filename: bytes} """
+        roms = {}
+        roms[ROM1A], roms[ROM1B] = interleave(self.view[:SPLIT_ADDRESS])
+        roms[ROM2A], roms[ROM2B] = interleave(self.view[SPLIT_ADDRESS:])
+        return roms
+
+    def write_zip(self, src_dir, fname, out_dir=OUTPUT_DIR, store_only=False):
+        """
+        Write out_dir/fname with every member of the clean zip, replacing the program ROMs with the patched image (see
+        rewrite_zip). The program ROMs are deflated unless store_only is set, which is faster for test builds.
+        The raw program ROMs are written to out_dir too in order to make IPS patches.
+        """
+        roms = self.roms()
+        os.makedirs(out_dir, exist_ok=True)
+        # Write to a unique temp name and swap it in so concurrent builds never see a half written zip
+        temp_fn = join(out_dir, f"{fname}.{os.getpid()}.tmp")
+        try:
+            rewrite_zip(join(src_dir, fname), temp_fn, roms, ZIP_STORED if store_only else ZIP_DEFLATED)
+        except BaseException:
+            if os.path.exists(temp_fn):
+                os.remove(temp_fn)
+            raise
+        os.replace(temp_fn, join(out_dir, fname))
+
+        for fn, data in roms.items():
+            with open(join(out_dir, fn), "wb") as f:
+                f.write(data)